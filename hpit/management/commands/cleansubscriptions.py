@@ -0,0 +1,44 @@
+from datetime import timedelta
+from sqlalchemy import func
+
+from hpit.server.app import ServerApp
+app_instance = ServerApp.get_instance()
+app = app_instance.app
+db = app_instance.db
+
+from hpit.server.models import Subscription
+
+class Command:
+    description = "Removes subscriptions plugins no longer make. Run it periodically, e.g. from cron."
+
+    def __init__(self, manager, parser):
+        self.manager = manager
+
+        parser.add_argument('--days', type=float, default=1, help="Remove a plugin's subscriptions not renewed within this many days of its latest subscribe.")
+
+    def run(self, arguments, configuration):
+        self.arguments = arguments
+        self.configuration = configuration
+
+        #Plugins renew their subscriptions when they start, so anything much older
+        #than a plugin's latest subscription was not asked for at its last start.
+        #Comparing against the latest subscription instead of the clock keeps
+        #the subscriptions of plugins that have been running for a long time.
+        max_age = timedelta(days=arguments.days)
+
+        removed = Subscription.query.filter(Subscription.time == None).delete(synchronize_session=False)
+
+        latest = db.session.query(Subscription.plugin_id, func.max(Subscription.time)).group_by(Subscription.plugin_id)
+        for plugin_id, latest_time in latest.all():
+            removed += Subscription.query.filter(
+                Subscription.plugin_id == plugin_id,
+                Subscription.time <= latest_time - max_age
+            ).delete(synchronize_session=False)
+
+        db.session.commit()
+
+        if removed:
+            with app.app_context():
+                app_instance.router.invalidate()
+
+        print("DONE! - Removed " + str(removed) + " stale subscriptions.")
@@ -0,0 +1,49 @@
+import os
+from datetime import datetime
+from pymongo import MongoClient
+
+from hpit.utils.knowledge_tracing_fit import transaction_sequences, fit_skills
+
+from hpit.management.settings_manager import SettingsManager
+plugin_settings = SettingsManager.get_plugin_settings()
+
+class Command:
+    description = "Fits knowledge tracing priors for each skill to the recorded transactions."
+
+    def __init__(self, manager, parser):
+        self.manager = manager
+
+        parser.add_argument('--processes', type=int, default=os.cpu_count(), help="Number of processes fitting skills at once. Defaults to the number of CPUs.")
+        parser.add_argument('--min-observations', type=int, default=50, help="Skip skills with fewer correct or incorrect steps than this.")
+        parser.add_argument('--sender', type=str, help="Only fit the skills of this tutor's entity id.")
+
+    def run(self, arguments, configuration):
+        self.arguments = arguments
+        self.configuration = configuration
+
+        plugin_db = MongoClient(plugin_settings.MONGODB_URI)[plugin_settings.MONGO_DBNAME]
+
+        query = {}
+        if arguments.sender:
+            query['edit_allowed_id'] = arguments.sender
+
+        #_id order is the order the transactions were recorded in.
+        transactions = plugin_db.hpit_transactions.find(query,
+            fields=['edit_allowed_id', 'student_id', 'skill_ids', 'outcome']).sort('_id', 1)
+
+        sequences = transaction_sequences(transactions)
+        print("Fitting " + str(len(sequences)) + " skills...")
+
+        fitted = fit_skills(sequences, arguments.processes, arguments.min_observations)
+
+        if fitted:
+            now = datetime.now()
+            bulk = plugin_db.hpit_knowledge_tracing_priors.initialize_unordered_bulk_op()
+            for (sender_entity_id, skill_id), parameters in fitted.items():
+                bulk.find({'sender_entity_id': sender_entity_id, 'skill_id': skill_id}).upsert().replace_one(dict(parameters,
+                    sender_entity_id=sender_entity_id,
+                    skill_id=skill_id,
+                    date_fitted=now))
+            bulk.execute()
+
+        print("DONE! - Fitted priors for " + str(len(fitted)) + " skills.")
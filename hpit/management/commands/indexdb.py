@@ -1,5 +1,7 @@
 import os
 from hpit.server.app import ServerApp
+from hpit.server.sessions import INVALIDATION_RETENTION
+from hpit.server.versioning import SharedKeys
 from pymongo import MongoClient
 app_instance = ServerApp.get_instance()
 app = app_instance.app
@@ -11,6 +13,33 @@ settings = SettingsManager.get_server_settings()
 plugin_settings = SettingsManager.get_plugin_settings()
 
 
+def ensure_ttl_index(collection, field, seconds):
+    """
+    Index field on collection, expiring documents seconds after the date stored
+    in it. With seconds set to None the index is kept but nothing expires.
+
+    An existing index on the field with a different expiry is replaced, since
+    MongoDB will not change it in place.
+    """
+    name = field + '_1'
+    existing = collection.index_information().get(name)
+
+    if existing is not None:
+        expire = existing.get('expireAfterSeconds')
+        if expire is not None:
+            expire = int(expire)
+
+        if expire == seconds:
+            return
+
+        collection.drop_index(name)
+
+    if seconds is None:
+        collection.create_index(field)
+    else:
+        collection.create_index(field, expireAfterSeconds=int(seconds))
+
+
 class Command:
     description = "Indexes the Mongo Database."
     
@@ -24,19 +53,54 @@ class Command:
         #server dbs
         with app.app_context():
             mongo.db.plugin_messages.create_index('receiver_entity_id')
+            #Superseded by the index below, which also covers the _id tie-break of claims.
+            if 'receiver_entity_id_1_time_created_1' in mongo.db.plugin_messages.index_information():
+                mongo.db.plugin_messages.drop_index('receiver_entity_id_1_time_created_1')
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('time_created', 1),
+                ('_id', 1)
+            ])
+            mongo.db.plugin_messages.create_index('claim_token', sparse=True)
+            mongo.db.plugin_messages.create_index([
+                ('receiver_entity_id', 1),
+                ('_id', 1)
+            ])
             mongo.db.plugin_transactions.create_index('receiver_entity_id')
 
-            mongo.db.sent_messages_and_transactions.create_index('time_received')
-            #mongo.db.sent_responses.create_index('time_response_received')
+            #retention, None keeps documents forever
+            ensure_ttl_index(mongo.db.plugin_messages, 'time_created',
+                getattr(settings, 'PLUGIN_MESSAGES_RETENTION', 86400))
+            ensure_ttl_index(mongo.db.responses, 'time_created',
+                getattr(settings, 'RESPONSES_RETENTION', 86400))
+            ensure_ttl_index(mongo.db.sent_messages_and_transactions, 'time_received',
+                getattr(settings, 'SENT_MESSAGES_RETENTION', None))
+            ensure_ttl_index(mongo.db.sent_responses, 'time_response_received',
+                getattr(settings, 'SENT_RESPONSES_RETENTION', None))
 
             mongo.db.sent_messages_and_transactions.create_index([
                 ("receiver_entity_id", -1),
                 ("message_id", 1)
             ])
+            mongo.db.sent_messages_and_transactions.create_index([
+                ("receiver_entity_id", 1),
+                ("_id", 1)
+            ])
             mongo.db.responses.create_index([
                     ('receiver_entity_id',1),
                     ('session_token',1)
             ])
+
+            #server-side sessions, removed once they expire
+            mongo.db.sessions.create_index('entity_id')
+            ensure_ttl_index(mongo.db.sessions, 'expiration', 0)
+            ensure_ttl_index(mongo.db.session_invalidations, 'time', INVALIDATION_RETENTION)
+            #per key cache invalidations, see SharedKeys
+            ensure_ttl_index(mongo.db.cache_invalidations, 'time', SharedKeys.RETENTION)
+            mongo.db.cache_invalidations.create_index([
+                ('cache', 1),
+                ('time', 1)
+            ])
             
         #plugin dbs
         plugin_mongo = MongoClient(plugin_settings.MONGODB_URI)
@@ -50,6 +114,23 @@ class Command:
             ('student_id', 1),
             ('sender_entity_id', 1)
         ])
-        plugin_db.hpit_knowledge_tracing.create_index('student_id')
+
+        #student model fragments, read whole or changed since a version
+        plugin_db.hpit_knowledge_tracing.create_index([
+            ('student_id', 1),
+            ('kt_version', 1)
+        ])
+        plugin_db.hpit_problems_worked.create_index([
+            ('student_id', 1),
+            ('fragment_version', 1)
+        ])
+        plugin_db.hpit_hints.create_index([
+            ('student_id', 1),
+            ('fragment_version', 1)
+        ])
+        plugin_db.hpit_knowledge_tracing_priors.create_index([
+            ('sender_entity_id', 1),
+            ('skill_id', 1)
+        ], unique=True)
 
         print("DONE! - Indexed the mongo database.")
\ No newline at end of file
@@ -1,4 +1,5 @@
 import os
+from sqlalchemy import inspect
 from hpit.server.app import ServerApp
 app_instance = ServerApp.get_instance()
 app = app_instance.app
@@ -8,6 +9,31 @@ mongo = app_instance.mongo
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_server_settings()
 
+def add_missing_columns():
+    """
+    Add the columns a model has gained to its existing table, which
+    create_all() leaves alone. Only nullable columns without a default can be
+    added this way; returns the 'table.column' names added.
+    """
+    engine = db.engine
+    inspector = inspect(engine)
+    quote = engine.dialect.identifier_preparer.quote
+
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = {c['name'] for c in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing or not column.nullable or column.default is not None:
+                continue
+
+            engine.execute("ALTER TABLE {} ADD COLUMN {} {}".format(quote(table.name),
+                quote(column.name), column.type.compile(dialect=engine.dialect)))
+            added.append(table.name + "." + column.name)
+
+    return added
+
+
 class Command:
     description = "Creates all the tables in the database."
     
@@ -20,6 +46,9 @@ class Command:
 
         db.create_all()
 
+        for column in add_missing_columns():
+            print("Added column " + column + ".")
+
         with app.app_context():
             mongo.db.plugin_messages.create_index('receiver_entity_id')
 
@@ -1,12 +1,22 @@
 import argparse
+import importlib
+import json
 import logging
 from logging.handlers import RotatingFileHandler
 import os
 import random
+import shlex
 import signal
+import sys
+import threading
+import time
 import uuid
 from datetime import datetime
 
+from requests.adapters import HTTPAdapter
+
+from hpit.utils.dispatch import ConcurrentDispatcher
+
 import platform
 
 from hpit.management.settings_manager import SettingsManager
@@ -63,17 +73,39 @@ main_parser.add_argument('type', type=str, help=subtype_help)
 main_parser.add_argument("name", type=str,help="The name of the entity")
 main_parser.add_argument('--once', action='store_true', help="Only run one loop of the tutor.")
 main_parser.add_argument('--args', type=str, help = "JSON string of command line arguments.")
+main_parser.add_argument('--dispatch', type=str, help = "JSON object of concurrent dispatch options for a plugin. (workers, order_by)")
+main_parser.add_argument('--runtime', type=str, default='threads', help = "The runtime a plugin runs on. (threads, async)")
+
+host_parser = argparse.ArgumentParser(
+    description='Runs several HPIT plugins in one process.',
+    usage=argparse.SUPPRESS)
+host_parser.add_argument('--host', type=str, required=True, help="The name of the plugin host.")
+host_parser.add_argument('plugins', type=str, help="JSON list of the plugins to host, as they appear in the configuration.")
+
+
+def create_logger(name, path):
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    log_handler = RotatingFileHandler(path,maxBytes = 10000000, backupCount = 1) #10mb
+    log_handler.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s:----:%(message)s')
+    log_handler.setFormatter(formatter)
+    logger.addHandler(log_handler)
+
+    return logger
 
 
 class BaseDaemon:
 
-    def __init__(self, entity_type, entity_subtype, entity_id, api_key, run_once, args):
+    def __init__(self, entity_type, entity_subtype, entity_id, api_key, run_once, args, dispatch=None, runtime='threads'):
         self.entity_type = entity_type
         self.entity_subtype = entity_subtype
         self.entity_id = entity_id
         self.api_key = api_key
         self.run_once = run_once
         self.args = args
+        self.dispatch = dispatch
+        self.runtime = runtime
 
     def get_entity_class(self):
         plugin_classes = {
@@ -89,6 +121,12 @@ class BaseDaemon:
             'boredom_detector': BoredomDetectorPlugin,
             'transaction_management': TransactionManagementPlugin,
         }
+        #Plugins ported to the asyncio runtime, by module, imported only when it
+        #is asked for since they need a newer Python than the rest of HPIT.
+        async_plugin_classes = {
+            'data': ('hpit.plugins.async_data_storage', 'AsyncDataStoragePlugin'),
+            'transaction_management': ('hpit.plugins.async_transaction_management', 'AsyncTransactionManagementPlugin'),
+        }
         tutor_classes = {
             'example': ExampleTutor,
             'knowledge_tracing': KnowledgeTracingTutor,
@@ -101,6 +139,11 @@ class BaseDaemon:
         if self.entity_type == 'plugin':
             if self.entity_subtype not in plugin_classes.keys():
                 raise Exception("Internal Error: Plugin type not supported.")
+            if self.runtime == 'async':
+                if self.entity_subtype not in async_plugin_classes.keys():
+                    raise Exception("Internal Error: Plugin type not supported by the async runtime.")
+                module, name = async_plugin_classes[self.entity_subtype]
+                plugin_classes = {self.entity_subtype: getattr(importlib.import_module(module), name)}
         elif self.entity_type == 'tutor':
             if self.entity_subtype not in tutor_classes.keys():
                 raise Exception("Internal Error: Tutor type not supported.")
@@ -112,21 +155,26 @@ class BaseDaemon:
             logger_arg = None
             
         if self.entity_type == 'plugin':
-            entity = plugin_classes[entity_subtype](self.entity_id, self.api_key, logger_arg, args=self.args)
+            entity = plugin_classes[self.entity_subtype](self.entity_id, self.api_key, logger_arg, args=self.args)
+
+            #The async runtime runs each message's callback in its own task already.
+            if self.dispatch and self.runtime != 'async':
+                workers = max(1, self.dispatch.get('workers', 1))
+                ConcurrentDispatcher.install(entity, workers, self.dispatch.get('order_by'))
+
+                #Each worker has a request in flight, more than requests' default pool of 10 keeps.
+                #A PluginHost mounts its shared adapter over this one.
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+                entity.session.mount('http://', adapter)
+                entity.session.mount('https://', adapter)
         elif self.entity_type == 'tutor':
-            entity = tutor_classes[entity_subtype](self.entity_id, self.api_key, logger=logger_arg, run_once=self.run_once, args=self.args)
+            entity = tutor_classes[self.entity_subtype](self.entity_id, self.api_key, logger=logger_arg, run_once=self.run_once, args=self.args)
 
         return entity
 
     def start(self):
                
-        self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(logging.DEBUG)
-        log_handler = RotatingFileHandler(logger_path,maxBytes = 10000000, backupCount = 1) #10mb
-        log_handler.setLevel(logging.DEBUG)
-        formatter = logging.Formatter('%(asctime)s %(levelname)s:----:%(message)s')
-        log_handler.setFormatter(formatter)
-        self.logger.addHandler(log_handler)
+        self.logger = create_logger(__name__, logger_path)
 
         self.logger.debug("Retrieving entity class.")
         try:
@@ -137,13 +185,105 @@ class BaseDaemon:
 
         if self.entity:
             self.logger.debug("Entity: " + str(self.entity) + " Found.")
-            signal.signal(signal.SIGTERM, self.entity.disconnect)
             self.entity.set_hpit_root_url(plugin_settings.HPIT_URL_ROOT)
+
+            if self.runtime == 'async':
+                self.entity.run()
+                return
+
+            signal.signal(signal.SIGTERM, self.entity.disconnect)
             self.entity.start()
 
 
+class PluginHost:
+    """
+    Runs several plugins in one process, each polling in its own thread.
+
+    The plugins share the process's MongoClient (see hpit.utils.mongo) and one
+    HTTP connection pool to the HPIT server. Each keeps its own requests session,
+    since the session cookie is what identifies the plugin to HPIT.
+    """
+
+    def __init__(self, name, plugins):
+        self.name = name
+        self.plugins = plugins
+        self.entities = []
+
+        #One connection per polling or dispatch thread, they each have one request in flight.
+        connections = sum(max(1, p.get('dispatch', {}).get('workers', 1)) for p in plugins)
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+
+    def create_entity(self, plugin):
+        name = plugin.get('name', 'Unknown')
+
+        args = None
+        if 'args' in plugin:
+            #Plugins expect their args quoted as they are on the command line.
+            args = shlex.quote(json.dumps(plugin['args']))
+
+        daemon = BaseDaemon('plugin', plugin['type'], plugin['entity_id'], plugin['api_key'], False, args, plugin.get('dispatch'))
+        daemon.logger = create_logger(__name__ + '.' + plugin['entity_id'],
+            os.path.join(os.getcwd(), 'log/' + name + '_plugin_' + plugin['entity_id'] + '.log'))
+
+        entity = daemon.get_entity_class()
+        entity.session.mount('http://', self.adapter)
+        entity.session.mount('https://', self.adapter)
+        entity.set_hpit_root_url(plugin_settings.HPIT_URL_ROOT)
+
+        #Plugin.start() busy waits between polls, which would starve the other
+        #threads of the GIL. Sleep in the pre_poll_messages hook instead.
+        poll_wait = entity.poll_wait / 1000
+        hook = getattr(entity, 'pre_poll_messages', None)
+
+        def pre_poll_messages():
+            time.sleep(poll_wait)
+            return hook() if hook else True
+
+        entity.poll_wait = 0
+        entity.pre_poll_messages = pre_poll_messages
+
+        return entity
+
+    def stop(self, signum=None, frame=None):
+        for entity in self.entities:
+            entity.stop()
+
+    def start(self):
+        for plugin in self.plugins:
+            if plugin['type'] not in plugin_types:
+                raise ValueError("Invalid Example Plugin Type. Choices are: " + repr(plugin_types))
+            if plugin.get('runtime', 'threads') != 'threads':
+                raise ValueError("Plugin " + plugin.get('name', 'Unknown') + " runs on the async runtime and can't be hosted.")
+
+            self.entities.append(self.create_entity(plugin))
+
+        signal.signal(signal.SIGTERM, self.stop)
+
+        threads = [threading.Thread(target=entity.start, name=entity.entity_id) for entity in self.entities]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        #Join with a timeout so the main thread still receives SIGTERM.
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+            for thread in threads:
+                thread.join()
+
+
 if __name__ == '__main__':
 
+    if '--host' in sys.argv[1:]:
+        arguments = host_parser.parse_args()
+
+        host = PluginHost(arguments.host, json.loads(arguments.plugins))
+        host.start()
+        sys.exit(0)
+
     main_parser.print_help()
 
     arguments = main_parser.parse_args()
@@ -161,6 +301,10 @@ if __name__ == '__main__':
     else:
         raise ValueError("Invalid entity argument:  must be tutor or plugin.")
 
-    daemon = BaseDaemon(arguments.entity, entity_subtype, arguments.entity_id, arguments.api_key, arguments.once, arguments.args)
+    dispatch = None
+    if arguments.dispatch:
+        dispatch = json.loads(arguments.dispatch)
+
+    daemon = BaseDaemon(arguments.entity, entity_subtype, arguments.entity_id, arguments.api_key, arguments.once, arguments.args, dispatch, arguments.runtime)
     daemon.start()
 
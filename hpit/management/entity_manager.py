@@ -116,6 +116,14 @@ class EntityManager:
             
         if 'once' in entity:
             subp_args.append("--once")
+
+        if 'dispatch' in entity:
+            subp_args.append("--dispatch")
+            subp_args.append(json.dumps(entity['dispatch']))
+
+        if 'runtime' in entity:
+            subp_args.append("--runtime")
+            subp_args.append(entity['runtime'])
             
         subp_args.extend([entity_id, api_key, entity_type, entity_subtype, name])
         
@@ -130,6 +138,44 @@ class EntityManager:
             pfile.write(str(subp.pid))
 
 
+    def spin_up_host(self, host, plugins):
+        """
+        Start the plugins configured with the same 'host' in a single process.
+        """
+        subp_args = [sys.executable, '-m', 'hpit.management.entity_daemon', '--host', host, json.dumps(plugins)]
+
+        print("Starting plugin host: " + host + " (" + str(len(plugins)) + " plugins)")
+
+        with open("log/output_"+host+"_plugin_host.txt","w") as f:
+            subp = subprocess.Popen(subp_args, stdout = f, stderr = f)
+
+        pidfile = os.path.join('tmp', host + '_plugin_host.pid')
+
+        with open(pidfile,"w") as pfile:
+            pfile.write(str(subp.pid))
+
+
+    def wind_down_host(self, host):
+        """
+        Shut down a plugin host started by spin_up_host.
+        """
+        print("Stopping plugin host: " + host)
+        pidfile = os.path.join('tmp', host + '_plugin_host.pid')
+
+        try:
+            with open(pidfile) as f:
+                pid = f.read()
+
+                try:
+                    os.kill(int(pid), signal.SIGTERM)
+                except OSError:
+                    print("Failed to kill plugin host " + host)
+
+            os.remove(pidfile)
+        except FileNotFoundError:
+            print("Error: Could not find PIDfile for plugin host: " + host)
+
+
     def wind_down_entity(self, entity, entity_type):
         """
         Shut down all entities of a given type from a collection
@@ -175,12 +221,20 @@ class EntityManager:
             print("Starting plugins...")
             entity_collection = configuration['plugins']
 
+            #Plugins with a 'host' share a process with the other plugins of that host.
+            hosts = {}
             for item in entity_collection:
                 if item['active']:
                     continue;
 
                 item['active'] = True
-                self.spin_up_entity(item, 'plugin')
+                if 'host' in item:
+                    hosts.setdefault(item['host'], []).append(item)
+                else:
+                    self.spin_up_entity(item, 'plugin')
+
+            for host, plugins in hosts.items():
+                self.spin_up_host(host, plugins)
 
             for i in range(0, 10):
                 print("Waiting " + str(10 - i) + " seconds for the plugins to boot.\r", end='')
@@ -210,12 +264,19 @@ class EntityManager:
             print("Stopping plugins...")
             entity_collection = configuration['plugins']
 
+            hosts = set()
             for item in entity_collection:
                 if not item['active']:
                     continue;
 
                 item['active'] = False
-                self.wind_down_entity(item, 'plugin')
+                if 'host' in item:
+                    hosts.add(item['host'])
+                else:
+                    self.wind_down_entity(item, 'plugin')
+
+            for host in hosts:
+                self.wind_down_host(host)
 
         if 'tutors' in configuration:
             print("Stopping tutors...")
@@ -0,0 +1,69 @@
+from hpit.utils.async_plugin import AsyncPlugin
+from hpit.utils.mongo import shared_motor_client
+
+from hpit.plugins.data_storage import DataStoragePlugin
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_plugin_settings()
+
+class AsyncDataStoragePlugin(AsyncPlugin):
+    """
+    DataStoragePlugin on the asyncio runtime, with MongoDB reached through motor
+    so the callbacks of many messages can wait on the database at once.
+    """
+
+    def __init__(self, entity_id, api_key, logger, args=None):
+        super().__init__(entity_id, api_key)
+        self.logger = logger
+        self.mongo = shared_motor_client()
+        self.db = self.mongo[settings.MONGO_DBNAME].data_storage
+
+    post_connect = DataStoragePlugin.post_connect
+
+    async def store_data_callback(self, message):
+        if self.logger:
+            self.send_log_entry("STORE_DATA")
+            self.send_log_entry(message)
+        try:
+            key = message["key"]
+            data = message["data"]
+        except KeyError:
+            self.send_response(message["message_id"],{"error":"Error: store_data message must contain a 'key' and 'data'","success":False})
+            return
+
+        await self.db.update_one({"key":key,"entity_id":message["sender_entity_id"]},{"$set":{"data":data,}},upsert=True)
+        self.send_response(message["message_id"],{"success":True})
+
+    async def retrieve_data_callback(self, message):
+        if self.logger:
+            self.send_log_entry("RETRIEVE_DATA")
+            self.send_log_entry(message)
+
+        try:
+            key = message["key"]
+        except KeyError:
+            self.send_response(message["message_id"],{"error":"Error: retrieve_data message must contain a 'key'","success":False})
+            return
+
+        data = await self.db.find_one({"key":key,"entity_id":message["sender_entity_id"]})
+        if data == None:
+            self.send_response(message["message_id"],{"error":"Key "+ str(key)+ " does not exist.","success":False})
+        else:
+            self.send_response(message["message_id"],{"data":data["data"],"success":True})
+
+    async def remove_data_callback(self, message):
+        if self.logger:
+            self.send_log_entry("REMOVE_DATA")
+            self.send_log_entry(message)
+
+        try:
+            key  = message["key"]
+        except KeyError:
+            self.send_response(message["message_id"],{"error":"Error: remove_data message must contain a 'key'","success":False})
+            return
+
+        response = await self.db.delete_one({"key":key,"entity_id":message["sender_entity_id"]})
+        if response.deleted_count == 0:
+            self.send_response(message["message_id"],{"error":"Key "+ str(key)+ " does not exist.", "success":False})
+        else:
+            self.send_response(message["message_id"],{"success":True})
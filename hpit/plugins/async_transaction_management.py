@@ -0,0 +1,18 @@
+from hpit.utils.async_plugin import AsyncPlugin
+
+from hpit.plugins.transaction_management import TransactionManagementPlugin
+
+class AsyncTransactionManagementPlugin(AsyncPlugin):
+    """
+    TransactionManagementPlugin on the asyncio runtime. Sends don't block there,
+    so a single process keeps the sub-messages of many transactions in flight.
+    """
+
+    def __init__(self, entity_id, api_key, logger, args = None):
+        super().__init__(entity_id, api_key)
+        self.logger = logger
+
+        self.tracker = {}
+
+    post_connect = TransactionManagementPlugin.post_connect
+    transaction_callback_method = TransactionManagementPlugin.transaction_callback_method
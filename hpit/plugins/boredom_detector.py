@@ -1,6 +1,6 @@
 from hpitclient import Plugin
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
 import pymongo
 
 from bson import ObjectId
@@ -25,7 +25,7 @@ class BoredomDetectorPlugin(Plugin):
     def __init__(self, entity_id, api_key, logger, args = None):
         super().__init__(entity_id, api_key)
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.db = self.mongo[settings.MONGO_DBNAME].hpit_boredom_detection
         self.config_db = self.mongo[settings.MONGO_DBNAME].hpit_boredom_config
         
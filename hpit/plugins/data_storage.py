@@ -1,6 +1,6 @@
 from hpitclient import Plugin
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
 
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_plugin_settings()
@@ -10,7 +10,7 @@ class DataStoragePlugin(Plugin):
     def __init__(self, entity_id, api_key, logger, args=None):
         super().__init__(entity_id, api_key)
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.db = self.mongo[settings.MONGO_DBNAME].data_storage
 
     def post_connect(self):
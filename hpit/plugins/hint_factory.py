@@ -7,7 +7,8 @@ import sys
 from hpitclient import Plugin
 from hpit.utils.hint_factory_state import *
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
+from hpit.utils.fragments import new_version, fragment_options, fragment_find, fragment_response
 from bson.objectid import ObjectId
 import bson
 
@@ -304,7 +305,7 @@ class HintFactoryPlugin(Plugin):
         self.logger = logger
         self.hf = SimpleHintFactory()
         
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.hint_db = self.mongo[settings.MONGO_DBNAME].hpit_hints
         
         if args:
@@ -557,7 +558,7 @@ class HintFactoryPlugin(Plugin):
                 if hint:
                     self.send_response(message["message_id"],{"status":"OK","exists":"YES","hint_text":hint["hint_text"],"hint_result":hint["hint_result"]})
                     if "student_id" in message:
-                        self.hint_db.update({"student_id":str(message["student_id"]),"state":state,"hint_text":hint["hint_text"],"hint_result":hint["hint_result"]},{"$set":{"hint_text":hint["hint_text"],"hint_result":hint["hint_result"],}},upsert=True)
+                        self.hint_db.update({"student_id":str(message["student_id"]),"state":state,"hint_text":hint["hint_text"],"hint_result":hint["hint_result"]},{"$set":{"hint_text":hint["hint_text"],"hint_result":hint["hint_result"],"fragment_version":new_version()}},upsert=True)
                 else:
                     self.send_response(message["message_id"],{"status":"OK","exists":"NO"})
             except HintDoesNotExistException as e:
@@ -590,13 +591,18 @@ class HintFactoryPlugin(Plugin):
                 })
                 return
                 
-            hints_received = self.hint_db.find({"student_id":student_id})
+            try:
+                fields, since = fragment_options(message, "hint_factory")
+            except ValueError as e:
+                self.send_response(message["message_id"],{
+                    "error":"hint_factory get_student_model_fragment: " + str(e)
+                })
+                return
+                
+            hints_received, version = fragment_find(self.hint_db, {"student_id":student_id}, fields, since)
             hints = [h for h in hints_received]
             
-            self.send_response(message["message_id"],{
-                   "name":"hint_factory",
-                   "fragment": hints,
-            })
+            self.send_response(message["message_id"],fragment_response("hint_factory", hints, "_id", version, since))
             
         except Exception as e:
             self.send_response(message["message_id"],{
@@ -642,7 +648,7 @@ class HintFactoryPlugin(Plugin):
                     hint = new_hint
                     hint_exists = True
                     if "student_id" in message:
-                        self.hint_db.update({"student_id":str(message["student_id"]),"state":state,"hint_text":hint},{"$set":{"hint_text":hint,}},upsert=True)
+                        self.hint_db.update({"student_id":str(message["student_id"]),"state":state,"hint_text":hint},{"$set":{"hint_text":hint,"fragment_version":new_version()}},upsert=True)
                 else:
                     hint = ""
                     hint_exists = False       
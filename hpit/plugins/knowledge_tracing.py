@@ -1,6 +1,8 @@
 from hpitclient import Plugin
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
+from hpit.plugins.knowledge_tracing_cache import KnowledgeTracingCache
+from hpit.utils.fragments import fragment_options, fragment_find, fragment_response
 
 from bson import ObjectId
 import bson
@@ -8,21 +10,36 @@ import bson
 import time
 import json
 
+import numpy
+
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_plugin_settings()
 
+#The fields of a skill row sent in the student model fragment.
+FRAGMENT_FIELDS = ['skill_id', 'probability_known', 'probability_learned', 'probability_guess', 'probability_mistake', 'student_id']
+
 class KnowledgeTracingPlugin(Plugin):
 
     def __init__(self, entity_id, api_key, logger, args = None):
         super().__init__(entity_id, api_key)
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.db = self.mongo[settings.MONGO_DBNAME].hpit_knowledge_tracing
         self.db.ensure_index([
                 ("sender_entity_id", 1),
                 ("skill_id", 1),
                 ("student_id",1)
             ])
+
+        self.cache = KnowledgeTracingCache(self.db,
+            lambda kt_configs, correct: self._kt_trace_batch(kt_configs, correct),
+            size=getattr(settings, 'KT_CACHE_SIZE', 100000),
+            flush_interval=getattr(settings, 'KT_FLUSH_INTERVAL', 2),
+            max_age=getattr(settings, 'KT_CACHE_MAX_AGE', 60))
+
+        #Priors fitted by the fitkt command, by sender_entity_id.
+        self.priors_db = self.mongo[settings.MONGO_DBNAME].hpit_knowledge_tracing_priors
+        self.priors = {}
         
         self.shared_messages = self.get_shared_messages(args)
         if not self.shared_messages:
@@ -40,13 +57,21 @@ class KnowledgeTracingPlugin(Plugin):
     def post_connect(self):
         super().post_connect()
         
-        self.subscribe({
+        callbacks = {
             "tutorgen.kt_set_initial":self.kt_set_initial_callback,
             "tutorgen.kt_reset":self.kt_reset,
             "tutorgen.kt_trace":self.kt_trace,
             "tutorgen.kt_batch_trace":self.kt_batch_trace,
             "tutorgen.kt_transaction":self.transaction_callback_method,
-            "get_student_model_fragment":self.get_student_model_fragment})
+            "get_student_model_fragment":self.get_student_model_fragment}
+
+        shard_group = getattr(settings, 'KT_SHARD_GROUP', None)
+        if shard_group:
+            #Each plugin of the group gets the messages of its own share of the students.
+            self.callbacks.update(callbacks)
+            self._post_data("plugin/subscribe",{"message_names":list(callbacks.keys()),"shard_key":"student_id","shard_group":shard_group})
+        else:
+            self.subscribe(callbacks)
         
         #self.register_transaction_callback(self.transaction_callback_method)
         
@@ -58,6 +83,22 @@ class KnowledgeTracingPlugin(Plugin):
         
         for k,v in self.shared_messages.items():
             self._post_data("share-message",{"message_name":k,"other_entity_ids":self.shared_messages[k]})
+
+    def post_dispatch_messages(self):
+        self.cache.flush_due()
+        return True
+
+    def pre_disconnect(self):
+        self.cache.flush()
+        return True
+
+    def _uncache(self,sender_entity_id,skill_id,student_id):
+        """
+        Write out the cache and drop a row from it, before changing the row in
+        the database.
+        """
+        self.cache.flush()
+        self.cache.invalidate(sender_entity_id,skill_id,student_id)
             
         
     def check_skill_manager(self, message):
@@ -67,6 +108,7 @@ class KnowledgeTracingPlugin(Plugin):
 
         def _callback_sm(response):
             if not "error" in response: #response from skill manager
+                self._uncache(message['sender_entity_id'],str(message['skill_id']),str(message['student_id']))
                 existing = self.db.find_one({'student_id':str(message['student_id']),'skill_id':str(message['skill_id'])})
                 if not existing:
                     self.db.insert({
@@ -77,6 +119,7 @@ class KnowledgeTracingPlugin(Plugin):
                         'probability_guess': message['probability_guess'],
                         'probability_mistake': message['probability_mistake'],
                         'student_id': message['student_id'],
+                        'kt_version': self.cache.new_version(),
                     })
                 else:
                     self.db.update(
@@ -86,6 +129,7 @@ class KnowledgeTracingPlugin(Plugin):
                              'probability_learned': message['probability_learned'],
                              'probability_guess': message['probability_guess'],
                              'probability_mistake': message['probability_mistake'],
+                             'kt_version': self.cache.new_version(),
                          }
                         }    
                     )
@@ -108,10 +152,19 @@ class KnowledgeTracingPlugin(Plugin):
         
         self.send("tutorgen.get_skill_name",{"skill_id":str(message["skill_id"])}, _callback_sm)
           
-    def _default_values(self,sender_id,skill_id,student_id):
-        if self.logger:
-            self.send_log_entry("INFO: No initial settings for KT_TRACE message. Using defaults.")
+    def _priors(self,sender_id):
+        """
+        The fitted priors of sender_id's skills by skill_id, reloaded every
+        KT_CACHE_MAX_AGE seconds.
+        """
+        loaded = self.priors.get(sender_id)
+        if loaded is None or time.time() - loaded[0] > self.cache.max_age:
+            loaded = (time.time(), {prior['skill_id']: prior for prior in self.priors_db.find({'sender_entity_id': sender_id})})
+            self.priors[sender_id] = loaded
 
+        return loaded[1]
+
+    def _default_values(self,sender_id,skill_id,student_id):
         new_trace = {
             'sender_entity_id': sender_id,
             'skill_id': skill_id,
@@ -122,37 +175,78 @@ class KnowledgeTracingPlugin(Plugin):
             'probability_mistake': 0.33,
         }
 
+        prior = self._priors(sender_id).get(skill_id)
+        if prior:
+            if self.logger:
+                self.send_log_entry("INFO: No initial settings for KT_TRACE message. Using fitted priors.")
+
+            for field in ['probability_known', 'probability_learned', 'probability_guess', 'probability_mistake']:
+                new_trace[field] = prior[field]
+        elif self.logger:
+            self.send_log_entry("INFO: No initial settings for KT_TRACE message. Using defaults.")
+
         return new_trace
         
     def _kt_trace(self,kt_config,correct):
+        return self._kt_trace_batch([kt_config],[correct])[0]
 
-        p_known = float(kt_config['probability_known'])
-        p_learned = float(kt_config['probability_learned'])
-        p_guess = float(kt_config['probability_guess'])
-        p_mistake = float(kt_config['probability_mistake'])
+    def _kt_trace_batch(self,kt_configs,correct):
+        """
+        Bayesian knowledge tracing of many skills at once. correct holds whether
+        the step was correct for each of kt_configs. The posteriors are computed
+        in one vectorized pass and returned in the order of kt_configs.
+        """
+        if not kt_configs:
+            return []
 
-        numer = 0
-        denom = 1
+        p_known, p_learned, p_guess, p_mistake = numpy.array([[
+            float(kt_config['probability_known']),
+            float(kt_config['probability_learned']),
+            float(kt_config['probability_guess']),
+            float(kt_config['probability_mistake']),
+        ] for kt_config in kt_configs]).T
 
-        if correct:
-            numer = p_known * (1 - p_mistake)
-            denom = numer + (1 - p_known) * p_guess
-        else:
-            numer = p_known * p_mistake
-            denom = numer + (1 - p_known) * (1 - p_guess)
+        correct = numpy.array(correct, dtype=bool)
+
+        numer = numpy.where(correct, p_known * (1 - p_mistake), p_known * p_mistake)
+        denom = numer + (1 - p_known) * numpy.where(correct, p_guess, 1 - p_guess)
 
-        p_known_prime = numer / denom if denom != 0 else 0
+        p_known_prime = numpy.zeros_like(numer)
+        numpy.divide(numer, denom, out=p_known_prime, where=denom != 0)
         p_known = p_known_prime + (1 - p_known_prime) * p_learned
 
-        return {
+        return [{
             'skill_id': kt_config['skill_id'],
             'student_id': kt_config['student_id'],
-            'probability_known': p_known,
-            'probability_learned': p_learned,
-            'probability_guess': p_guess,
-            'probability_mistake': p_mistake,
-            }
-        
+            'probability_known': float(p_known[i]),
+            'probability_learned': float(p_learned[i]),
+            'probability_guess': float(p_guess[i]),
+            'probability_mistake': float(p_mistake[i]),
+            } for i, kt_config in enumerate(kt_configs)]
+
+    def _trace_skills(self,sender_entity_id,student_id,skill_outcomes):
+        """
+        Trace the skills of one step for a student. skill_outcomes maps each
+        skill_id to whether it was applied correctly. Skills seen for the first
+        time get the default values. The skills are traced in the cache, which
+        writes them back with its next flush. Returns skill_id -> trace.
+        """
+        traces, new_rows = self.cache.trace(sender_entity_id,student_id,skill_outcomes,
+            lambda skill_id: self._default_values(sender_entity_id,skill_id,student_id))
+
+        if self.logger and traces:
+            self.send_log_entry("SUCCESS: kt_trace with new data: " + str(traces))
+
+        response_skills = {}
+        for trace in traces:
+            response_skills[trace["skill_id"]] = dict(trace)
+
+        for row in new_rows:
+            del row["sender_entity_id"]
+            response_skills[row["skill_id"]] = row
+
+        return response_skills
+
     def kt_batch_trace(self,message):
         try:
             if self.logger:
@@ -170,34 +264,7 @@ class KnowledgeTracingPlugin(Plugin):
                 self.send_response(message["message_id"],{"error":"kt_batch_trace requires 'skill_list' to be dict"})
                 return
             
-            skills = list(skill_list.keys())
-            
-            kt_configs = self.db.find({"student_id":student_id,"sender_entity_id":sender_entity_id,"skill_id":{"$in":skills}})
-            
-            response_skills = {}
-            for kt_config in kt_configs:
-                trace = self._kt_trace(kt_config,skill_list[kt_config["skill_id"]])
-                self.db.update({'_id': kt_config['_id']}, {'$set': {
-                    'probability_known': trace["probability_known"]
-                }})
-            
-                if self.logger:
-                    self.send_log_entry("SUCCESS: kt_trace with new data: " + str(kt_config))
-                    
-                response = dict(trace)
-                response_skills[kt_config["skill_id"]] = response
-            
-            insert_list = []
-            for skill in skills:
-                if skill not in response_skills:
-                    trace = self._default_values(sender_entity_id,skill,student_id)
-                    insert_list.append(trace)
-                    
-                    response_skills[skill] = dict(trace)
-                    del response_skills[skill]["sender_entity_id"]
-                    
-            if insert_list:
-                self.db.insert(insert_list,manipulate=False)
+            response_skills = self._trace_skills(sender_entity_id,student_id,skill_list)
             
             self.send_response(message['message_id'],{"traced_skills":response_skills})
         
@@ -234,25 +301,7 @@ class KnowledgeTracingPlugin(Plugin):
                 self.send_response(message["message_id"],{"error":"kt_trace 'skill_id' is not a valid skill id"})
                 return
             
-            kt_config = self.db.find_one({
-                'sender_entity_id':sender_entity_id,
-                'skill_id': skill_id,
-                'student_id':student_id
-            })
-            
-            if not kt_config:
-                response = self._default_values(sender_entity_id,skill_id,student_id)
-                self.db.insert(dict(response))
-                del response["sender_entity_id"]
-            else:   
-                trace = self._kt_trace(kt_config,correct)
-                self.db.update({'_id': kt_config['_id']}, {'$set': {
-                    'probability_known': trace["probability_known"]
-                }})
-                response = dict(trace)
-        
-            if self.logger:
-                self.send_log_entry("SUCCESS: kt_trace with new data: " + str(kt_config))
+            response = self._trace_skills(sender_entity_id,student_id,{skill_id:correct})[skill_id]
             
             self.send_response(message['message_id'],response)
         
@@ -280,6 +329,7 @@ class KnowledgeTracingPlugin(Plugin):
                 self.send_response(message["message_id"],{"error":"kt_trace 'skill_id' is not a valid skill id"})
                 return
                 
+            self._uncache(message['sender_entity_id'],str(message['skill_id']),str(message['student_id']))
             kt_config = self.db.find_one({
                 'sender_entity_id': message['sender_entity_id'],
                 'skill_id': str(message['skill_id']),
@@ -294,7 +344,8 @@ class KnowledgeTracingPlugin(Plugin):
                         'probability_known' : message['probability_known'],
                         'probability_learned' : message['probability_learned'],
                         'probability_guess' : message['probability_guess'],
-                        'probability_mistake' : message['probability_mistake']
+                        'probability_mistake' : message['probability_mistake'],
+                        'kt_version' : self.cache.new_version()
                     }})
     
                 self.send_response(message['message_id'], {
@@ -327,6 +378,7 @@ class KnowledgeTracingPlugin(Plugin):
                 self.send_response(message["message_id"],{"error":"kt_trace 'skill_id' is not a valid skill id"})
                 return
                
+            self._uncache(message['sender_entity_id'],str(message['skill_id']),str(message['student_id']))
             kt_config = self.db.find_one({
                 'sender_entity_id': message['sender_entity_id'],
                 'skill_id': str(message['skill_id']),
@@ -338,7 +390,8 @@ class KnowledgeTracingPlugin(Plugin):
                     'probability_known': 0.75,
                     'probability_learned': 0.33,
                     'probability_guess': 0.33,
-                    'probability_mistake': 0.33
+                    'probability_mistake': 0.33,
+                    'kt_version': self.cache.new_version()
                 }})
                 self.send_response(message['message_id'], {
                     'skill_id': str(message['skill_id']),
@@ -370,26 +423,30 @@ class KnowledgeTracingPlugin(Plugin):
                     "error":"knowledge tracing get_student_model_fragment requires 'student_id'",
                 })
                 return
+
+            try:
+                fields, since = fragment_options(message, "knowledge_tracing")
+            except ValueError as e:
+                self.send_response(message['message_id'],{
+                    "error":"knowledge tracing get_student_model_fragment: " + str(e),
+                })
+                return
+            fields = [f for f in (fields or FRAGMENT_FIELDS) if f in FRAGMENT_FIELDS]
             
-            skill_list = []
-            skills = self.db.find({
-                'student_id': str(message['student_id'])
-            })
+            self.cache.flush()
+
+            #Every write to a skill row gives it a new kt_version, see KnowledgeTracingCache.
+            skills, version = fragment_find(self.db, {'student_id': str(message['student_id'])}, fields, since, 'kt_version')
             
+            skill_list = []
             for skill in skills:
-                skill_list.append({
-                    'skill_id': str(skill['skill_id']),
-                    'probability_known': skill['probability_known'],
-                    'probability_learned': skill['probability_learned'],
-                    'probability_guess': skill['probability_guess'],
-                    'probability_mistake': skill['probability_mistake'],
-                    'student_id':str(skill['student_id'])
-                })
+                row = {f: skill[f] for f in fields if f in skill}
+                for f in ['skill_id', 'student_id']:
+                    if f in row:
+                        row[f] = str(row[f])
+                skill_list.append(row)
             
-            self.send_response(message['message_id'],{
-                "name":"knowledge_tracing",
-                "fragment":skill_list,
-            })
+            self.send_response(message['message_id'],fragment_response("knowledge_tracing", skill_list, "skill_id", version, since))
             
         except Exception as e:
             self.send_response(message["message_id"],{
@@ -437,35 +494,8 @@ class KnowledgeTracingPlugin(Plugin):
                 
             
             
-            skills = list(skill_ids.values())
-            skill_ids_to_names = {y:x for x,y in skill_ids.items()}
-            
-            kt_configs = self.db.find({"student_id":student_id,"sender_entity_id":sender_entity_id,"skill_id":{"$in":skills}})
-            
-            response_skills = {}
-            for kt_config in kt_configs:
-                trace = self._kt_trace(kt_config,outcome)
-                self.db.update({'_id': kt_config['_id']}, {'$set': {
-                    'probability_known': trace["probability_known"]
-                }})
-            
-                if self.logger:
-                    self.send_log_entry("SUCCESS: kt_trace with new data: " + str(kt_config))
-                    
-                response = dict(trace)
-                response_skills[skill_ids_to_names[kt_config["skill_id"]]] = response
-            
-            insert_list = []
-            for skill in skills:
-                if skill not in response_skills:
-                    trace = self._default_values(sender_entity_id,skill,student_id)
-                    insert_list.append(trace)
-                    
-                    response_skills[skill_ids_to_names[skill]] = dict(trace)
-                    del response_skills[skill_ids_to_names[skill]]["sender_entity_id"]
-                    
-            if insert_list:
-                self.db.insert(insert_list,manipulate=False)
+            traced_skills = self._trace_skills(sender_entity_id,student_id,{skill_id:correct for skill_id in skill_ids.values()})
+            response_skills = {name:traced_skills[skill_id] for name,skill_id in skill_ids.items()}
     
             response ={}
             response["traced_skills"] = response_skills
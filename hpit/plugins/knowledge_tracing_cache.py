@@ -0,0 +1,240 @@
+import threading
+import time
+from collections import OrderedDict
+
+from bson.objectid import ObjectId
+
+class KnowledgeTracingCache:
+    """
+    A write-behind LRU of knowledge tracing rows, keyed by (sender_entity_id,
+    skill_id, student_id), so the skills a student is working on are traced in
+    memory and written back in one bulk write every flush_interval seconds.
+
+    It holds at most size rows. Dirty rows pushed out of the LRU are written
+    with the next flush, and put back in the LRU if traced again before then.
+
+    Several plugin processes may trace the same students. Each row carries a
+    kt_version, replaced on every write, and a flush only updates rows still at
+    the version it read. A row changed elsewhere in the meantime is reloaded
+    and the outcomes traced here since the last flush are replayed on top of
+    it, so no trace is lost. Clean rows are reloaded once they are max_age
+    seconds old, which bounds how stale a trace can start from.
+
+    Anything writing the rows directly must call invalidate() first and give
+    the row a new kt_version (see new_version()).
+    """
+
+    def __init__(self, collection, tracer, size=100000, flush_interval=2, max_age=60):
+        self.collection = collection
+        self.tracer = tracer
+        self.size = size
+        self.flush_interval = flush_interval
+        self.max_age = max_age
+
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.evicted = OrderedDict()
+        self.last_flush = time.time()
+
+    @staticmethod
+    def new_version():
+        return ObjectId()
+
+    @staticmethod
+    def _key(row):
+        return (row['sender_entity_id'], row['skill_id'], row['student_id'])
+
+    def _entry(self, row, version):
+        return {
+            'row': row,
+            'version': version,
+            'pending': [],
+            'dirty': False,
+            'loaded': time.time(),
+        }
+
+    def _add(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.size:
+            key, entry = self.entries.popitem(last=False)
+            if entry['dirty']:
+                self.evicted[key] = entry
+
+    def _load(self, sender_entity_id, student_id, skill_ids):
+        """
+        Cache the rows of skill_ids that aren't cached yet, or are too old, with
+        one query.
+        """
+        now = time.time()
+        missing = []
+        for skill_id in skill_ids:
+            key = (sender_entity_id, skill_id, student_id)
+
+            #Its pending outcomes aren't written yet, so the stored row is behind it.
+            if key in self.evicted:
+                self._add(key, self.evicted.pop(key))
+                continue
+
+            entry = self.entries.get(key)
+            if entry is None or (not entry['dirty'] and now - entry['loaded'] > self.max_age):
+                missing.append(skill_id)
+
+        if not missing:
+            return
+
+        for row in self.collection.find({"student_id":student_id,"sender_entity_id":sender_entity_id,"skill_id":{"$in":missing}}):
+            self._add(self._key(row), self._entry(row, row.get('kt_version')))
+
+    def trace(self, sender_entity_id, student_id, skill_outcomes, default):
+        """
+        Trace the skills of one step, skill_outcomes mapping each skill_id to
+        whether it was applied correctly. Skills without a row get default(skill_id),
+        untraced. Returns the traces and the new rows.
+        """
+        with self.lock:
+            self._load(sender_entity_id, student_id, list(skill_outcomes.keys()))
+
+            entries = []
+            new_rows = []
+            for skill_id in skill_outcomes:
+                key = (sender_entity_id, skill_id, student_id)
+                entry = self.entries.get(key)
+
+                if entry is None:
+                    entry = self._entry(default(skill_id), None)
+                    entry['dirty'] = True
+                    self._add(key, entry)
+                    new_rows.append(entry['row'])
+                else:
+                    self.entries.move_to_end(key)
+                    entries.append((entry, skill_outcomes[skill_id]))
+
+            traces = self.tracer([entry['row'] for entry, correct in entries], [correct for entry, correct in entries])
+
+            for (entry, correct), trace in zip(entries, traces):
+                entry['row']['probability_known'] = trace['probability_known']
+                entry['pending'].append(correct)
+                entry['dirty'] = True
+
+            return traces, [dict(row) for row in new_rows]
+
+    def invalidate(self, sender_entity_id, skill_id, student_id):
+        """
+        Forget a row, and any outcomes traced on it but not yet written.
+        """
+        key = (sender_entity_id, skill_id, student_id)
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.evicted.pop(key, None)
+
+    def flush_due(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the dirty rows with one unordered bulk write. Returns how many
+        rows were written.
+        """
+        with self.lock:
+            self.last_flush = time.time()
+
+            evicted = self.evicted
+            self.evicted = OrderedDict()
+            entries = [entry for entry in self.entries.values() if entry['dirty']] + list(evicted.values())
+
+            if not entries:
+                return 0
+
+            version = self.new_version()
+            bulk = self.collection.initialize_unordered_bulk_op()
+            updates = 0
+            for entry in entries:
+                row = entry['row']
+                if '_id' in row:
+                    bulk.find({'_id': row['_id'], 'kt_version': entry['version']}).update_one({'$set': {
+                        'probability_known': row['probability_known'],
+                        'kt_version': version,
+                    }})
+                    updates += 1
+                else:
+                    bulk.find({
+                        'sender_entity_id': row['sender_entity_id'],
+                        'skill_id': row['skill_id'],
+                        'student_id': row['student_id'],
+                    }).upsert().update_one({'$setOnInsert': dict(row, kt_version=version)})
+
+            try:
+                result = bulk.execute()
+            except:
+                self.evicted.update(evicted)
+                raise
+
+            for upserted in result.get('upserted', []):
+                entries[upserted['index']]['row']['_id'] = upserted['_id']
+
+            conflicts = []
+            if result['nMatched'] != updates or len(result.get('upserted', [])) != len(entries) - updates:
+                conflicts = self._conflicts(entries, version)
+
+            conflicted = set(id(entry) for entry in conflicts)
+            for entry in entries:
+                if id(entry) in conflicted:
+                    continue
+
+                entry['version'] = version
+                entry['pending'] = []
+                entry['dirty'] = False
+
+            evicted = set(id(entry) for entry in evicted.values())
+            for entry in conflicts:
+                self._replay(entry)
+                if id(entry) in evicted:
+                    self.evicted[self._key(entry['row'])] = entry
+
+            return len(entries) - len(conflicts)
+
+    def _conflicts(self, entries, version):
+        """
+        The entries whose row was changed by someone else, so wasn't written.
+        """
+        conflicts = []
+        for entry in entries:
+            row = entry['row']
+            if '_id' in row:
+                stored = self.collection.find_one({'_id': row['_id']})
+            else:
+                stored = self.collection.find_one({
+                    'sender_entity_id': row['sender_entity_id'],
+                    'skill_id': row['skill_id'],
+                    'student_id': row['student_id'],
+                })
+
+            if stored is None or stored.get('kt_version') != version:
+                entry['stored'] = stored
+                conflicts.append(entry)
+
+        return conflicts
+
+    def _replay(self, entry):
+        """
+        Start the entry over from the stored row, tracing its pending outcomes
+        again on top of it. It stays dirty for the next flush.
+        """
+        stored = entry.pop('stored')
+        if stored is None:
+            #Removed elsewhere, write it back as a new row.
+            entry['row'].pop('_id', None)
+            entry['version'] = None
+            return
+
+        row = stored
+        for correct in entry['pending']:
+            row = dict(row, probability_known=self.tracer([row], [correct])[0]['probability_known'])
+
+        entry['row'] = row
+        entry['version'] = stored.get('kt_version')
+        entry['loaded'] = time.time()
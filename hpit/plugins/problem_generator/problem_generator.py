@@ -4,6 +4,8 @@ import importlib
 import pkgutil
 import types
 import random
+import json
+from concurrent.futures import ProcessPoolExecutor
 from hpit.plugins.problem_generator import problems
 
 from hpitclient import Plugin
@@ -11,93 +13,131 @@ from hpitclient import Plugin
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_plugin_settings()
 
-class ProblemGeneratorPlugin(Plugin):
+def load_problem_library():
+    """
+    Import every enabled problem class under problems/, returning a dict of
+    subject -> category -> skill -> problem.
+    """
+    problem_library = {}
+    root_directory = os.path.dirname(problems.__file__)
 
-    def __init__(self, entity_id, api_key, logger, args = None):
-        self.logger = logger
-        self.load_problem_library()
-        super().__init__(entity_id, api_key)
+    for dirpath, dirnames, filenames in os.walk(root_directory):
+        if dirpath.endswith('__pycache__'):
+            continue
 
+        filenames = [fn for fn in filenames if fn != '__init__.py']
 
-    def load_problem_library(self):
-        self.problem_library = {}
-        root_directory = os.path.dirname(problems.__file__)
+        if not filenames:
+            continue
 
-        for dirpath, dirnames, filenames in os.walk(root_directory):
-            if dirpath.endswith('__pycache__'):
-                continue
+        for fn in filenames:
+            import_path = dirpath.replace(settings.PROJECT_DIR, '')[1:].split(os.sep)
 
-            filenames = [fn for fn in filenames if fn != '__init__.py']
+            category_name = fn.split('.')[0]
+            subject_name = import_path[-1]
+            import_path.append(category_name)
 
-            if not filenames:
+            if not category_name:
                 continue
+                
+            imported = importlib.import_module('.'.join(import_path))
 
-            for fn in filenames:
-                import_path = dirpath.replace(settings.PROJECT_DIR, '')[1:].split(os.sep)
+            functions = {}
+            for attr in dir(imported):
+                if attr.endswith('Problem'):
+                    cls_inst = getattr(imported, attr, None)()
+                    if cls_inst.problem_enabled:
+                        functions[attr] = cls_inst
 
-                category_name = fn.split('.')[0]
-                subject_name = import_path[-1]
-                import_path.append(category_name)
+            if functions:
+                if subject_name not in problem_library:
+                    problem_library[subject_name] = {}
 
-                if not category_name:
-                    continue
-                    
-                imported = importlib.import_module('.'.join(import_path))
+                subject_dict = problem_library[subject_name]
+                subject_dict[category_name] = functions
 
-                functions = {}
-                for attr in dir(imported):
-                    if attr.endswith('Problem'):
-                        cls_inst = getattr(imported, attr, None)()
-                        if cls_inst.problem_enabled:
-                            functions[attr] = cls_inst
+    return problem_library
 
-                if functions:
-                    if subject_name not in self.problem_library:
-                        self.problem_library[subject_name] = {}
 
-                    subject_dict = self.problem_library[subject_name]
-                    subject_dict[category_name] = functions
+def generate_problem(problem_library, subject=None, category=None, skill=None, **kwargs):
+    if subject is None:
+        subject = random.choice(list(problem_library.keys()))
+    elif subject not in problem_library:
+        raise Exception("Subject is invalid.")
 
-        self.update_problem_list()
+    subject_obj = problem_library[subject]
 
+    if category is None:
+        category = random.choice(list(subject_obj.keys()))
+    elif category not in subject_obj:
+        raise Exception("Category is invalid.")
 
-    def update_problem_list(self):
-        self.problem_list = {
-            subjects: {category: list(skills.keys()) for category, skills in categories.items()}
-        for subjects, categories in self.problem_library.items() }
+    category_obj = subject_obj[category]
 
+    if skill is None:
+        skill = random.choice(list(category_obj.keys()))
+    elif skill not in category_obj:
+        raise Exception("Skill is invalid.")
 
-    def generate_problem(self, subject=None, category=None, skill=None, **kwargs):
-        if subject is None:
-            subject = random.choice(list(self.problem_library.keys()))
-        elif subject not in self.problem_library:
-            raise Exception("Subject is invalid.")
+    skill_obj = category_obj[skill]
+
+    problem_text, answer_text = skill_obj(**kwargs)
 
-        subject_obj = self.problem_library[subject]
+    return {
+        'subject': subject,
+        'category': category,
+        'skill': skill,
+        'problem_text': problem_text,
+        'answer_text': answer_text
+    }
 
-        if category is None:
-            category = random.choice(list(subject_obj.keys()))
-        elif category not in subject_obj:
-            raise Exception("Category is invalid.")
 
-        category_obj = subject_obj[category]
+#The problem library of a process pool worker, loaded by its first job.
+_worker_problem_library = None
 
-        if skill is None:
-            skill = random.choice(list(category_obj.keys()))
-        elif skill not in category_obj:
-            raise Exception("Skill is invalid.")
+def generate_problems(subject, category, skill, count, options):
+    """
+    Generate count problems in a process pool worker.
+    """
+    global _worker_problem_library
 
-        skill_obj = category_obj[skill]
+    if _worker_problem_library is None:
+        #Forked workers start with the parent's random state, don't hand out the same problems.
+        random.seed()
+        _worker_problem_library = load_problem_library()
 
-        problem_text, answer_text = skill_obj(**kwargs)
+    return [generate_problem(_worker_problem_library, subject, category, skill, **options) for i in range(0, count)]
 
-        return {
-            'subject': subject,
-            'category': category,
-            'skill': skill,
-            'problem_text': problem_text,
-            'answer_text': answer_text
-        }
+
+class ProblemGeneratorPlugin(Plugin):
+
+    def __init__(self, entity_id, api_key, logger, args = None):
+        self.logger = logger
+        self.load_problem_library()
+        super().__init__(entity_id, api_key)
+
+        #Generating problems is CPU bound. With args {"processes": n} it is done
+        #in a pool of n processes, so concurrent dispatch can use more than one core.
+        self.process_pool = None
+        if args:
+            self.args = json.loads(args[1:-1])
+            if self.args.get('processes'):
+                self.process_pool = ProcessPoolExecutor(self.args['processes'])
+
+
+    def load_problem_library(self):
+        self.problem_library = load_problem_library()
+        self.update_problem_list()
+
+
+    def update_problem_list(self):
+        self.problem_list = {
+            subjects: {category: list(skills.keys()) for category, skills in categories.items()}
+        for subjects, categories in self.problem_library.items() }
+
+
+    def generate_problem(self, subject=None, category=None, skill=None, **kwargs):
+        return generate_problem(self.problem_library, subject, category, skill, **kwargs)
 
 
     def post_connect(self):
@@ -178,8 +218,11 @@ class ProblemGeneratorPlugin(Plugin):
 
         problems = []
         try:
-            for i in range(0, count):
-                problems.append(self.generate_problem(subject, category, skill, **options))
+            if self.process_pool:
+                problems = self.process_pool.submit(generate_problems, subject, category, skill, count, options).result()
+            else:
+                for i in range(0, count):
+                    problems.append(self.generate_problem(subject, category, skill, **options))
         except Exception as e:
             self.send_response(message['message_id'], {
                 'error': str(e),
@@ -2,7 +2,8 @@ from hpitclient import Plugin
 
 from datetime import datetime
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
+from hpit.utils.fragments import new_version, fragment_options, fragment_find, fragment_response
 from bson.objectid import ObjectId
 import bson
 
@@ -16,7 +17,7 @@ class ProblemManagementPlugin(Plugin):
     def __init__(self, entity_id, api_key, logger,args = None):
         super().__init__(entity_id, api_key)
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
 
         self.db = self.mongo[settings.MONGO_DBNAME].hpit_problems
         self.step_db = self.mongo[settings.MONGO_DBNAME].hpit_steps
@@ -392,7 +393,7 @@ class ProblemManagementPlugin(Plugin):
                 })
                 return
                 
-            self.worked_db.insert({"student_id":student_id,"problem_id":problem_id})
+            self.worked_db.insert({"student_id":student_id,"problem_id":problem_id,"fragment_version":new_version()})
             self.send_response(message["message_id"],{
                         "success":True
                 })
@@ -897,13 +898,18 @@ class ProblemManagementPlugin(Plugin):
                 })
                 return
             
-            problems_worked = self.worked_db.find({"student_id":student_id})
+            try:
+                fields, since = fragment_options(message, "problem_management")
+            except ValueError as e:
+                self.send_response(message["message_id"],{
+                    "error":"problem_managment get_student_model_fragment: " + str(e)
+                })
+                return
+            
+            problems_worked, version = fragment_find(self.worked_db, {"student_id":student_id}, fields, since)
             problems = [p for p in problems_worked]
             
-            self.send_response(message["message_id"],{
-                   "name":"problem_management",
-                   "fragment": problems,
-            })
+            self.send_response(message["message_id"],fragment_response("problem_management", problems, "problem_id", version, since))
         
         except Exception as e:
             self.send_response(message["message_id"],{
@@ -1055,7 +1061,7 @@ class ProblemManagementPlugin(Plugin):
                 transaction_id = transaction["_id"]      
             
             #update problem worked db
-            self.worked_db.update({"student_id":student_id,"problem_id":problem_id},{"student_id":student_id,"problem_id":problem_id},upsert=True)
+            self.worked_db.update({"student_id":student_id,"problem_id":problem_id},{"student_id":student_id,"problem_id":problem_id,"fragment_version":new_version()},upsert=True)
             
             self.send_response(message["message_id"],{
                 "transaction_id": str(transaction_id),
@@ -1,6 +1,6 @@
 from hpitclient import Plugin
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
 from bson.objectid import ObjectId
 import bson
 
@@ -14,7 +14,7 @@ class SkillManagementPlugin(Plugin):
     def __init__(self, entity_id, api_key, logger, args = None):
         super().__init__(entity_id, api_key)
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.db = self.mongo[settings.MONGO_DBNAME].hpit_skills
         self.db.ensure_index("skill_name")
         
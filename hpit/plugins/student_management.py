@@ -1,10 +1,11 @@
 from hpitclient import Plugin
 
-from pymongo import MongoClient
+from hpit.utils.mongo import shared_mongo_client
 from bson.objectid import ObjectId
 import bson
 
-from threading import Timer
+from threading import Timer, Lock
+from collections import OrderedDict
 
 from datetime import datetime
 
@@ -21,7 +22,7 @@ class StudentManagementPlugin(Plugin):
     def __init__(self, entity_id, api_key, logger, args = None):
         super().__init__(entity_id, api_key) 
         self.logger = logger
-        self.mongo = MongoClient(settings.MONGODB_URI)
+        self.mongo = shared_mongo_client()
         self.db = self.mongo[settings.MONGO_DBNAME].hpit_students
         self.session_db = self.mongo[settings.MONGO_DBNAME].hpit_sessions
         
@@ -29,6 +30,15 @@ class StudentManagementPlugin(Plugin):
         self.student_model_fragment_names = ["knowledge_tracing","problem_management","hint_factory"]
         self.student_models = {}
         self.timeout_threads = {}
+
+        #The fragments of recently modelled students, student_id -> fragment
+        #name -> version and rows by key, so the next get_student_model only
+        #asks for the rows changed since. Students with a get_student_model in
+        #flight are pinned, message_id -> student_id, and never evicted.
+        self.fragment_cache = OrderedDict()
+        self.fragment_cache_size = getattr(settings, 'STUDENT_MODEL_CACHE_SIZE', 1000)
+        self.fragment_cache_lock = Lock()
+        self.fragment_pins = {}
         
         if args:
             try:
@@ -263,17 +273,99 @@ class StudentManagementPlugin(Plugin):
             self.student_models[message["message_id"]] = {}
             self.timeout_threads[message["message_id"]] = Timer(self.TIMEOUT, self.kill_timeout, [message, student_id])
             self.timeout_threads[message["message_id"]].start()
-    
-            self.send("get_student_model_fragment",{
+
+            fragment_message = {
                     "update": update,
                     "student_id" : str(message["student_id"]),
-            },self.get_populate_student_model_callback_function(student_id,message))
+            }
+
+            changed_since = self._pin_fragments(message["message_id"], str(message["student_id"]))
+            if changed_since:
+                fragment_message["changed_since"] = changed_since
+    
+            self.send("get_student_model_fragment",fragment_message,self.get_populate_student_model_callback_function(student_id,message))
         except Exception as e:
             self.send_response(message["message_id"],{
                 "error":"Unexpected error; please consult the docs. " + str(e)      
             })
 
+    def _cached_versions(self, student_id):
+        """
+        The version of each fragment cached for student_id, to ask for the rows
+        changed since.
+        """
+        with self.fragment_cache_lock:
+            fragments = self.fragment_cache.get(student_id, {})
+            return {name: fragment["version"] for name, fragment in fragments.items()}
+
+    def _pin_fragments(self, message_id, student_id):
+        """
+        Keep the fragments cached for student_id until _unpin_fragments(message_id),
+        so the changes asked for on their behalf can be merged into them, and
+        return their versions as _cached_versions() does.
+        """
+        with self.fragment_cache_lock:
+            self.fragment_pins[message_id] = student_id
+
+            fragments = self.fragment_cache.get(student_id, {})
+            return {name: fragment["version"] for name, fragment in fragments.items()}
+
+    def _unpin_fragments(self, message_id):
+        with self.fragment_cache_lock:
+            self.fragment_pins.pop(message_id, None)
+
+    def _merge_fragment(self, student_id, response):
+        """
+        Fold a fragment reply into the fragments cached for student_id, and
+        return the whole fragment and whether the cache was used.
+
+        Replies to requests made at the same time may arrive in any order, so
+        changes are merged into whatever is cached, and changes older than
+        what is cached keep the cached version, which makes the next request
+        fetch anything merged out of order again.
+
+        Raises KeyError for changes with nothing cached to merge them into,
+        rather than pass them off as the whole fragment. Pinning the student
+        while its request is in flight keeps that from happening.
+        """
+        name = response["name"]
+        key = response.get("key")
+        version = response.get("version")
+        since = response.get("changed_since")
+
+        #A plugin that doesn't version its fragment, nothing to cache.
+        if not key or not version or not isinstance(response["fragment"], list):
+            return response["fragment"], False
+
+        with self.fragment_cache_lock:
+            cached = self.fragment_cache.get(student_id, {}).get(name)
+            if since is None:
+                rows = OrderedDict()
+            elif cached is not None:
+                rows = cached["rows"]
+                if since < cached["version"]:
+                    version = min(version, cached["version"])
+            else:
+                raise KeyError(name)
+
+            fragments = self.fragment_cache.setdefault(student_id, {})
+            self.fragment_cache.move_to_end(student_id)
+
+            for row in response["fragment"]:
+                rows[str(row.get(key))] = row
+            fragments[name] = {"version": version, "rows": rows}
+
+            excess = len(self.fragment_cache) - self.fragment_cache_size
+            if excess > 0:
+                pinned = set(self.fragment_pins.values()) | {student_id}
+                for evicted in [s for s in self.fragment_cache if s not in pinned][:excess]:
+                    del self.fragment_cache[evicted]
+
+            return list(rows.values()), since is not None
+
     def get_populate_student_model_callback_function(self, student_id, message):
+        cached_fragments = set()
+
         def populate_student_model(response):
             
             #check if values exist
@@ -289,7 +381,11 @@ class StudentManagementPlugin(Plugin):
 
             #fill student model
             try:
-                self.student_models[message["message_id"]][response["name"]] = response["fragment"]
+                student_model = self.student_models[message["message_id"]]
+                fragment, cached = self._merge_fragment(str(student_id), response)
+                student_model[response["name"]] = fragment
+                if cached:
+                    cached_fragments.add(response["name"])
                 if self.logger:
                     self.send_log_entry("GOT FRAGMENT " + str(response["fragment"]) + str(message["message_id"]))
                     
@@ -310,11 +406,13 @@ class StudentManagementPlugin(Plugin):
                     self.send_response(message["message_id"], {
                         "student_id": str(student_id),
                         "student_model" : self.student_models[message["message_id"]],       
-                        "cached":False,
+                        "cached":bool(cached_fragments),
                         "resource_id":student["resource_id"],
                         "message_id":str(message["message_id"]),
                     })
                    
+                    self._unpin_fragments(message["message_id"])
+
                     try: 
                         
                         self.timeout_threads[message["message_id"]].cancel()
@@ -330,6 +428,8 @@ class StudentManagementPlugin(Plugin):
     def kill_timeout(self, message, student_id):
         if self.logger:
             self.send_log_entry("TIMEOUT " + str(message))
+
+        self._unpin_fragments(message["message_id"])
         
         student = self.db.find_one({'_id':ObjectId(str(message["student_id"]))})
         
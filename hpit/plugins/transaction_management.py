@@ -126,9 +126,3 @@ class TransactionManagementPlugin(Plugin):
             self.send_response(message["message_id"],{
                 "error":"Unexpected error; please consult the docs. " + str(e)      
             })
-        
-        
-        
-    
-    
-
@@ -18,11 +18,23 @@ from gears_coffeescript import CoffeeScriptCompiler
 
 #Comment out this block if you run this file directly. (Strictly for development purposes only)
 from .flask_gears import Gears
-from .sessions import MongoSessionInterface
+from .sessions import CachedSessionInterface, MongoSessionStore, MemorySessionStore
+from .notifier import MessageNotifier
+from .routing import SubscriptionRouter
+from .versioning import SharedVersion, SharedKeys
+from .message_bus import MongoMessageBus, MemoryMessageBus
+from .entities import EntityRegistry
+from .authorization import AuthorizationService
 
 #For running this file directly uncomment this and comment the block above it.
 #from flask_gears import Gears
-#from sessions import MongoSessionInterface
+#from sessions import CachedSessionInterface, MongoSessionStore, MemorySessionStore
+#from notifier import MessageNotifier
+#from routing import SubscriptionRouter
+#from versioning import SharedVersion, SharedKeys
+#from message_bus import MongoMessageBus, MemoryMessageBus
+#from entities import EntityRegistry
+#from authorization import AuthorizationService
 #from settings import MONGO_DBNAME, SECRET_KEY, DEBUG_MODE
 
 from hpit.management.settings_manager import SettingsManager
@@ -63,7 +75,6 @@ class ServerApp:
 
         try:
             self.mongo = PyMongo(self.app)
-            #self.app.session_interface = MongoSessionInterface(self.app, self.mongo)
         except ConnectionFailure:
             self.mongo = None
 
@@ -72,6 +83,34 @@ class ServerApp:
         self.mail = Mail(self.app)
         self.md = Markdown(self.app)
         self.csrf = CsrfProtect(self.app)
+        self.notifier = MessageNotifier()
+
+        version_check_interval = getattr(settings, 'CACHE_VERSION_CHECK_INTERVAL', 1)
+        self.router = SubscriptionRouter(self.db,
+            SharedVersion(self.mongo, 'subscriptions', version_check_interval),
+            getattr(settings, 'SHARD_STALE_AFTER', 300))
+        self.entities = EntityRegistry(self.db,
+            SharedVersion(self.mongo, 'entities', version_check_interval),
+            getattr(settings, 'HEARTBEAT_FLUSH_INTERVAL', 5), self.app)
+        self.authorization = AuthorizationService(self.db,
+            SharedVersion(self.mongo, 'authorization', version_check_interval),
+            SharedKeys(self.mongo, 'authorization', version_check_interval))
+
+        if self.mongo is not None and getattr(settings, 'SESSION_STORE', 'mongo') == 'mongo':
+            session_store = MongoSessionStore(self.app, self.mongo)
+        else:
+            session_store = MemorySessionStore()
+        self.sessions = CachedSessionInterface(session_store,
+            SharedVersion(self.mongo, 'sessions', version_check_interval),
+            getattr(settings, 'SESSION_LIFETIME', 86400),
+            getattr(settings, 'SESSION_CACHE_SIZE', 10000))
+        self.app.session_interface = self.sessions
+
+        message_retention = getattr(settings, 'PLUGIN_MESSAGES_RETENTION', 86400)
+        if getattr(settings, 'MESSAGE_BUS', 'mongo') == 'memory':
+            self.message_bus = MemoryMessageBus(message_retention)
+        else:
+            self.message_bus = MongoMessageBus(self.mongo, message_retention)
 
         self.user_bootstrapped = False
 
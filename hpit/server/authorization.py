@@ -0,0 +1,234 @@
+import threading
+
+class AuthorizationService:
+    """
+    Process-local cache of the MessageAuth and ResourceAuth tables.
+
+    Grants are cached per message_name and per resource_id as a dict of
+    entity_id -> is_owner, loaded the first time the name or resource is asked
+    about, so checks on the hot routes are dictionary lookups. A name or resource
+    with no grants is cached as an empty dict.
+
+    Grants should be made through grant_message(), grant_resource() and
+    add_resource(), which write all the rows with one commit. The first two then
+    drop the names or resource they changed from every server process's cache
+    through changes, a SharedKeys. add_resource() caches its new resource as it
+    is, since nobody can have asked about it before. Anything else that changes
+    the tables must call invalidate(), which clears every server process's
+    whole cache through the shared 'authorization' version.
+    """
+
+    #Resource ids are created freely, so their cache is dropped when it grows past this.
+    MAX_CACHED_RESOURCES = 10000
+
+    def __init__(self, db, version, changes=None):
+        self.db = db
+        self.version = version
+        self.changes = changes
+
+        self.lock = threading.Lock()
+        self.messages = {}
+        self.resources = {}
+        self.loaded_version = None
+
+        #Bumped whenever entries are dropped, so a load racing the drop isn't cached.
+        self.generation = 0
+
+    def _check_version(self):
+        #Called with the lock held.
+        version = self.version.current()
+        changed = self.changes.since_last_check() if self.changes else []
+
+        if version != self.loaded_version or changed is None:
+            self.messages = {}
+            self.resources = {}
+            self.loaded_version = version
+            self.generation += 1
+        elif changed:
+            self._drop(changed)
+
+    def _drop(self, keys):
+        #Called with the lock held.
+        for key in keys:
+            kind, _, name = key.partition(':')
+            (self.messages if kind == 'message' else self.resources).pop(name, None)
+
+        self.generation += 1
+
+    def _forget(self, message_names=(), resource_ids=()):
+        """
+        Drop message_names and resource_ids from the cache of every server process.
+        """
+        keys = ['message:' + m for m in message_names] + ['resource:' + r for r in resource_ids]
+
+        with self.lock:
+            self._drop(keys)
+
+        if self.changes:
+            self.changes.changed(keys)
+
+    def _message_grants(self, message_names):
+        """
+        Return message_name -> {entity_id: is_owner} for message_names, loading
+        the ones not cached with one query.
+        """
+        with self.lock:
+            self._check_version()
+            generation = self.generation
+            found = {m: self.messages[m] for m in message_names if m in self.messages}
+
+        missing = [m for m in message_names if m not in found]
+        if missing:
+            loaded = self._load_messages(missing)
+
+            with self.lock:
+                if generation == self.generation:
+                    self.messages.update(loaded)
+
+            found.update(loaded)
+
+        return found
+
+    def _resource_grants(self, resource_id):
+        with self.lock:
+            self._check_version()
+            generation = self.generation
+            if resource_id in self.resources:
+                return self.resources[resource_id]
+
+        grants = self._load_resource(resource_id)
+
+        with self.lock:
+            if generation == self.generation:
+                self._cache_resource(resource_id, grants)
+
+        return grants
+
+    def _cache_resource(self, resource_id, grants):
+        #Called with the lock held.
+        if len(self.resources) >= self.MAX_CACHED_RESOURCES:
+            self.resources = {}
+        self.resources[resource_id] = grants
+
+    def message_owner(self, message_name):
+        """
+        Return the entity_id that owns message_name, or None if it has no owner.
+        """
+        return self.message_owners([message_name])[message_name]
+
+    def message_owners(self, message_names):
+        """
+        Return a dict of message_name -> owning entity_id, or None, for message_names.
+        """
+        owners = {}
+        for message_name, entities in self._message_grants(list(set(message_names))).items():
+            owners[message_name] = next((e for e, is_owner in entities.items() if is_owner), None)
+
+        return owners
+
+    def is_message_owner(self, message_name, entity_id):
+        return self._message_grants([message_name])[message_name].get(str(entity_id), False)
+
+    def authorized_message_names(self, entity_id, message_names):
+        """
+        Return the set of message_names entity_id holds a grant for.
+        """
+        entity_id = str(entity_id)
+        grants = self._message_grants(list(set(message_names)))
+
+        return {m for m, entities in grants.items() if entity_id in entities}
+
+    def is_resource_owner(self, resource_id, entity_id):
+        return self._resource_grants(resource_id).get(str(entity_id), False)
+
+    def grant_message(self, message_name, entity_ids, is_owner=False):
+        """
+        Grant message_name to every entity in entity_ids that does not already
+        hold a grant for it, with a single commit.
+        """
+        self.grant_messages([(message_name, e) for e in entity_ids], is_owner)
+
+    def grant_messages(self, grants, is_owner=False):
+        """
+        Grant each (message_name, entity_id) in grants the entity does not
+        already hold, with a single commit.
+        """
+        from .models import MessageAuth
+
+        grants = {(m, str(e)) for m, e in grants}
+        existing = self._message_grants(list({m for m, e in grants}))
+
+        new_grants = [(m, e) for m, e in grants if e not in existing[m]]
+        if not new_grants:
+            return
+
+        for message_name, entity_id in new_grants:
+            message_auth = MessageAuth()
+            message_auth.entity_id = entity_id
+            message_auth.message_name = message_name
+            message_auth.is_owner = is_owner
+            self.db.session.add(message_auth)
+
+        self.db.session.commit()
+        self._forget(message_names={m for m, e in new_grants})
+
+    def grant_resource(self, resource_id, entity_ids, is_owner=False):
+        """
+        Grant resource_id to every entity in entity_ids that does not already
+        hold a grant for it, with a single commit.
+        """
+        from .models import ResourceAuth
+
+        existing = self._resource_grants(resource_id)
+
+        new_ids = {str(e) for e in entity_ids} - set(existing)
+        if not new_ids:
+            return
+
+        for entity_id in new_ids:
+            resource_auth = ResourceAuth()
+            resource_auth.entity_id = entity_id
+            resource_auth.resource_id = resource_id
+            resource_auth.is_owner = is_owner
+            self.db.session.add(resource_auth)
+
+        self.db.session.commit()
+        self._forget(resource_ids=[resource_id])
+
+    def add_resource(self, resource_id, owner_id):
+        """
+        Record a newly created resource_id, owned by owner_id.
+        """
+        from .models import ResourceAuth
+
+        resource_auth = ResourceAuth()
+        resource_auth.entity_id = str(owner_id)
+        resource_auth.resource_id = resource_id
+        resource_auth.is_owner = True
+        self.db.session.add(resource_auth)
+        self.db.session.commit()
+
+        with self.lock:
+            self._check_version()
+            self._cache_resource(resource_id, {str(owner_id): True})
+
+    def invalidate(self):
+        with self.lock:
+            self.messages = {}
+            self.resources = {}
+            self.generation += 1
+        self.version.bump()
+
+    def _load_messages(self, message_names):
+        from .models import MessageAuth
+
+        grants = {m: {} for m in message_names}
+        for message_auth in MessageAuth.query.filter(MessageAuth.message_name.in_(message_names)):
+            grants[message_auth.message_name][message_auth.entity_id] = message_auth.is_owner
+
+        return grants
+
+    def _load_resource(self, resource_id):
+        from .models import ResourceAuth
+
+        return {r.entity_id: r.is_owner for r in ResourceAuth.query.filter_by(resource_id=resource_id)}
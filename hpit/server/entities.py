@@ -0,0 +1,125 @@
+import atexit
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+class CachedEntity(namedtuple('CachedEntity', [
+        'model', 'id', 'entity_id', 'name', 'description', 'api_key_salt', 'api_key_result'])):
+    """
+    A detached copy of the Tutor or Plugin fields needed to authenticate a connection.
+    """
+
+    def authenticate(self, key):
+        #The model's authenticate() only reads the salt and hash, which we carry.
+        return self.model.authenticate(self, key)
+
+
+class EntityRegistry:
+    """
+    Process-local cache of entity_id -> CachedEntity, plus a buffer of heartbeats.
+
+    Lookups only hit the database on a miss. Anything that changes an entity's
+    name, description or key, or deletes it, must call invalidate(), which clears
+    every server process's cache through the shared 'entities' version.
+
+    touch() records a heartbeat in memory. The first heartbeat buffered starts a
+    timer that writes them all flush_interval seconds later, with one UPDATE per
+    entity type and poll time, so time_last_polled lags by at most that long.
+    What is still buffered when the process exits is written by an atexit hook;
+    only a process that is killed outright loses its last heartbeats.
+    """
+
+    def __init__(self, db, version, flush_interval=5, app=None):
+        self.db = db
+        self.version = version
+        self.flush_interval = flush_interval
+        self.app = app
+
+        self.lock = threading.Lock()
+        self.entities = {}
+        self.loaded_version = None
+
+        self.heartbeats = {}
+        self.timer = None
+
+        atexit.register(self._timed_flush)
+
+    def get(self, entity_id):
+        """
+        Return the CachedEntity for entity_id, or None if no tutor or plugin has it.
+        """
+        version = self.version.current()
+
+        with self.lock:
+            if version != self.loaded_version:
+                self.entities = {}
+                self.loaded_version = version
+
+            if entity_id in self.entities:
+                return self.entities[entity_id]
+
+        entity = self._load(entity_id)
+
+        if entity:
+            with self.lock:
+                if version == self.loaded_version:
+                    self.entities[entity_id] = entity
+
+        return entity
+
+    def invalidate(self):
+        with self.lock:
+            self.entities = {}
+        self.version.bump()
+
+    def touch(self, entity):
+        with self.lock:
+            self.heartbeats[(entity.model, entity.entity_id)] = datetime.now()
+
+            if self.timer is None:
+                self.timer = threading.Timer(self.flush_interval, self._timed_flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _timed_flush(self):
+        #Runs outside of any request, so it needs its own app context.
+        if self.app is None:
+            self.flush()
+        else:
+            with self.app.app_context():
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            heartbeats = self.heartbeats
+            self.heartbeats = {}
+
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+        if not heartbeats:
+            return
+
+        #Heartbeats are only seconds apart, so most share a poll time at
+        #second resolution and one UPDATE covers them.
+        by_time = {}
+        for (model, entity_id), polled in heartbeats.items():
+            by_time.setdefault((model, polled.replace(microsecond=0)), []).append(entity_id)
+
+        for (model, polled), ids in by_time.items():
+            model.query.filter(model.entity_id.in_(ids)).update(
+                {'time_last_polled': polled}, synchronize_session=False)
+
+        self.db.session.commit()
+
+    def _load(self, entity_id):
+        from .models import Plugin, Tutor
+
+        for model in [Tutor, Plugin]:
+            found = model.query.filter_by(entity_id=entity_id).first()
+            if found:
+                return CachedEntity(model, found.id, found.entity_id, found.name,
+                    found.description, found.api_key_salt, found.api_key_result)
+
+        return None
@@ -0,0 +1,471 @@
+import threading
+from collections import OrderedDict
+from uuid import uuid4
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+class MessageBus:
+    """
+    Where the API keeps messages, the per-receiver queue, responses and the record
+    of what was sent.
+
+    Documents going in and out are plain dicts shaped like the MongoDB documents
+    the routes have always used, ids are bson ObjectIds:
+        message  - sender_entity_id, session_token, time_created, message_name, payload
+        delivery - message_id, sender_entity_id, session_token, receiver_entity_id,
+                   time_created, message_name
+        response - message_id, session_token, sender_entity_id, receiver_entity_id,
+                   message, response, time_created
+
+    A delivery handed out by claim() is recorded as sent under its own _id, and
+    responses refer back to that record.
+    """
+
+    #Lease used when a poller does not ack explicitly. The messages are removed
+    #straight after the claim, the lease only matters if we die in between.
+    AUTO_ACK_LEASE = 60
+
+    def add_messages(self, messages):
+        """Store messages, returning their ids in order."""
+        raise NotImplementedError()
+
+    def message_payloads(self, message_ids):
+        """Return a dict of message_id -> payload for the messages that exist."""
+        raise NotImplementedError()
+
+    def queue(self, deliveries):
+        """Queue deliveries for their receivers."""
+        raise NotImplementedError()
+
+    def queued(self, entity_id, after=None, limit=None):
+        """
+        Return the deliveries queued for entity_id, claimed or not, in _id order.
+        after and limit page through them: only deliveries with an _id greater
+        than after, at most limit of them.
+        """
+        raise NotImplementedError()
+
+    def claim(self, entity_id, limit, visibility=None):
+        """
+        Lease up to limit deliveries queued for entity_id, oldest first, and record
+        them as sent.
+
+        With a visibility timeout (in seconds) the deliveries must be acked before it
+        runs out or they will be handed out again. Without one they are acked as
+        part of the claim.
+        """
+        raise NotImplementedError()
+
+    def ack(self, entity_id, message_ids):
+        """Remove claimed deliveries entity_id has finished with, returning how many."""
+        raise NotImplementedError()
+
+    def reassign(self, entity_id, receivers):
+        """
+        Move deliveries queued for entity_id to other receivers, receivers mapping
+        each delivery's _id to its new receiver_entity_id. Deliveries claimed and
+        still leased stay put. Returns how many were moved.
+        """
+        raise NotImplementedError()
+
+    def sent(self, sent_ids):
+        """Return the sent records with the given _ids."""
+        raise NotImplementedError()
+
+    def sent_to(self, entity_id, message_ids=None, exclude_message_name=None, after=None, limit=None):
+        """
+        Return the sent records delivered to entity_id in _id order, optionally
+        only for the given message_ids, or leaving out one message_name. after and
+        limit page through them as with queued().
+        """
+        raise NotImplementedError()
+
+    def mark_responded(self, sent_ids, when):
+        raise NotImplementedError()
+
+    def add_responses(self, responses):
+        """Queue responses, returning their ids in order."""
+        raise NotImplementedError()
+
+    def take_responses(self, entity_id, session_token):
+        """Remove and return the responses queued for entity_id's session."""
+        raise NotImplementedError()
+
+    def return_responses(self, responses):
+        """
+        Queue responses from take_responses() again, ahead of newer ones, when
+        they could not be passed on after all.
+        """
+        raise NotImplementedError()
+
+
+class MongoMessageBus(MessageBus):
+    """
+    The MongoDB message bus, using the messages_and_transactions, plugin_messages,
+    sent_messages_and_transactions, responses and sent_responses collections.
+
+    claim() leases a batch with a conditional update, so two pollers sharing an
+    entity_id never get the same message at the same time. Sent records are
+    keyed by the delivery's _id, so a redelivery does not duplicate them.
+
+    Deliveries older than max_age seconds are never handed out. They are left for
+    the plugin_messages TTL index (see the indexdb command) to remove.
+    """
+
+    #Messages sent together share a time_created. Their _ids are assigned in
+    #order on insert, so they break the tie and keep the batch in order.
+    CLAIM_ORDER = [('time_created', 1), ('_id', 1)]
+
+    def __init__(self, mongo, max_age=None):
+        self.mongo = mongo
+        self.max_age = max_age
+
+    def _available(self, entity_id, now):
+        available = {
+            'receiver_entity_id': entity_id,
+            '$or': [
+                {'claimed_until': {'$exists': False}},
+                {'claimed_until': {'$lt': now}},
+            ]
+        }
+
+        if self.max_age:
+            available['time_created'] = {'$gte': now - timedelta(seconds=self.max_age)}
+
+        return available
+
+    def add_messages(self, messages):
+        return self.mongo.db.messages_and_transactions.insert(messages)
+
+    def message_payloads(self, message_ids):
+        found = self.mongo.db.messages_and_transactions.find({'_id': {'$in': message_ids}}, {'payload': 1})
+        return {m['_id']: m['payload'] for m in found}
+
+    def queue(self, deliveries):
+        self.mongo.db.plugin_messages.insert(deliveries)
+
+    def _page(self, collection, query, after, limit):
+        if after is not None:
+            query['_id'] = {'$gt': after}
+
+        cursor = collection.find(query).sort('_id', 1)
+        if limit:
+            cursor = cursor.limit(limit)
+
+        return list(cursor)
+
+    def queued(self, entity_id, after=None, limit=None):
+        return self._page(self.mongo.db.plugin_messages, {'receiver_entity_id': entity_id}, after, limit)
+
+    def claim(self, entity_id, limit, visibility=None):
+        now = datetime.now()
+        available = self._available(entity_id, now)
+
+        candidates = list(self.mongo.db.plugin_messages.find(available).sort(self.CLAIM_ORDER).limit(limit))
+        if not candidates:
+            return []
+
+        token = str(uuid4())
+        lease = visibility if visibility is not None else self.AUTO_ACK_LEASE
+        claimed_until = now + timedelta(seconds=lease)
+
+        available['_id'] = {'$in': [c['_id'] for c in candidates]}
+        result = self.mongo.db.plugin_messages.update(
+            available,
+            {'$set': {'claim_token': token, 'claimed_until': claimed_until}},
+            multi=True
+        )
+
+        #Someone else claimed part of the batch between our find and update.
+        if result['n'] < len(candidates):
+            candidates = list(self.mongo.db.plugin_messages.find({'claim_token': token}).sort(self.CLAIM_ORDER))
+            if not candidates:
+                return []
+
+        for c in candidates:
+            c['claim_token'] = token
+            c['claimed_until'] = claimed_until
+            c['time_received'] = now
+
+        try:
+            self.mongo.db.sent_messages_and_transactions.insert(candidates, continue_on_error=True)
+        except DuplicateKeyError:
+            pass #redelivered, already recorded as sent
+
+        if visibility is None:
+            self.mongo.db.plugin_messages.remove({'claim_token': token})
+
+        return candidates
+
+    def ack(self, entity_id, message_ids):
+        if not message_ids:
+            return 0
+
+        result = self.mongo.db.plugin_messages.remove({
+            'receiver_entity_id': entity_id,
+            'message_id': {'$in': message_ids},
+            'claim_token': {'$exists': True},
+        })
+
+        return result['n']
+
+    def reassign(self, entity_id, receivers):
+        now = datetime.now()
+
+        by_receiver = {}
+        for delivery_id, receiver_entity_id in receivers.items():
+            by_receiver.setdefault(receiver_entity_id, []).append(delivery_id)
+
+        moved = 0
+        for receiver_entity_id, delivery_ids in by_receiver.items():
+            available = self._available(entity_id, now)
+            available['_id'] = {'$in': delivery_ids}
+
+            result = self.mongo.db.plugin_messages.update(
+                available,
+                {
+                    '$set': {'receiver_entity_id': receiver_entity_id},
+                    '$unset': {'claim_token': "", 'claimed_until': ""},
+                },
+                multi=True
+            )
+            moved += result['n']
+
+        return moved
+
+    def sent(self, sent_ids):
+        return list(self.mongo.db.sent_messages_and_transactions.find({'_id': {'$in': sent_ids}}))
+
+    def sent_to(self, entity_id, message_ids=None, exclude_message_name=None, after=None, limit=None):
+        query = {'receiver_entity_id': entity_id}
+
+        if message_ids is not None:
+            query['message_id'] = {'$in': message_ids}
+        if exclude_message_name is not None:
+            query['message_name'] = {'$ne': exclude_message_name}
+
+        return self._page(self.mongo.db.sent_messages_and_transactions, query, after, limit)
+
+    def mark_responded(self, sent_ids, when):
+        self.mongo.db.sent_messages_and_transactions.update(
+            {'_id': {'$in': sent_ids}},
+            {"$set": {'time_responded': when}},
+            multi=True
+        )
+
+    def add_responses(self, responses):
+        return self.mongo.db.responses.insert(responses)
+
+    def take_responses(self, entity_id, session_token):
+        my_responses = list(self.mongo.db.responses.find({
+            'receiver_entity_id': entity_id,
+            'session_token': session_token,
+        }))
+
+        #Move sent responses to another collection.
+        if my_responses:
+            now = datetime.now()
+            for t in my_responses:
+                t['time_response_received'] = now
+            self.mongo.db.sent_responses.insert(my_responses)
+
+            self.mongo.db.responses.remove({
+                '_id': {'$in': [t['_id'] for t in my_responses]}
+            })
+
+        return my_responses
+
+    def return_responses(self, responses):
+        if not responses:
+            return
+
+        ids = [t['_id'] for t in responses]
+        self.mongo.db.sent_responses.remove({'_id': {'$in': ids}})
+
+        for t in responses:
+            t.pop('time_response_received', None)
+        self.mongo.db.responses.insert(responses)
+
+
+class MemoryMessageBus(MessageBus):
+    """
+    A message bus kept in this process's memory, for single process deployments
+    and for benchmarking the routing layer without a database.
+
+    Nothing survives a restart, and nothing is shared with other server processes,
+    so run the server with a single process when using it. Everything is forgotten
+    retention seconds after it was created. Delivered responses are not archived.
+    """
+
+    def __init__(self, retention=86400):
+        self.retention = retention
+
+        self.lock = threading.Lock()
+        self.messages = OrderedDict()
+        self.deliveries = {}
+        self.sent_records = OrderedDict()
+        self.responses = {}
+        self.last_expired = datetime.now()
+
+    def _expire(self, now):
+        #Called with the lock held. Everything is stored oldest first.
+        if now - self.last_expired < timedelta(seconds=60):
+            return
+        self.last_expired = now
+
+        cutoff = now - timedelta(seconds=self.retention)
+
+        for store, field in [(self.messages, 'time_created'), (self.sent_records, 'time_received')]:
+            while store and next(iter(store.values()))[field] < cutoff:
+                store.popitem(last=False)
+
+        for store in [self.deliveries, self.responses]:
+            for entity_id in list(store.keys()):
+                kept = OrderedDict((k, v) for k, v in store[entity_id].items() if v['time_created'] >= cutoff)
+                if kept:
+                    store[entity_id] = kept
+                else:
+                    del store[entity_id]
+
+    def _insert(self, store, documents):
+        ids = []
+        for document in documents:
+            document['_id'] = ObjectId()
+            store[document['_id']] = dict(document)
+            ids.append(document['_id'])
+        return ids
+
+    def add_messages(self, messages):
+        with self.lock:
+            self._expire(datetime.now())
+            return self._insert(self.messages, messages)
+
+    def message_payloads(self, message_ids):
+        with self.lock:
+            return {m: self.messages[m]['payload'] for m in message_ids if m in self.messages}
+
+    def queue(self, deliveries):
+        with self.lock:
+            for delivery in deliveries:
+                self._insert(self.deliveries.setdefault(delivery['receiver_entity_id'], OrderedDict()), [delivery])
+
+    def _page(self, documents, after, limit):
+        documents = sorted(documents, key=lambda d: d['_id'])
+
+        if after is not None:
+            documents = [d for d in documents if d['_id'] > after]
+        if limit:
+            documents = documents[:limit]
+
+        return [dict(d) for d in documents]
+
+    def queued(self, entity_id, after=None, limit=None):
+        with self.lock:
+            return self._page(self.deliveries.get(entity_id, {}).values(), after, limit)
+
+    def claim(self, entity_id, limit, visibility=None):
+        now = datetime.now()
+        lease = visibility if visibility is not None else self.AUTO_ACK_LEASE
+        stale = now - timedelta(seconds=self.retention)
+
+        token = str(uuid4())
+
+        with self.lock:
+            self._expire(now)
+            queue = self.deliveries.get(entity_id, {})
+
+            claimed = []
+            for delivery in queue.values():
+                if len(claimed) >= limit:
+                    break
+                if delivery['time_created'] < stale:
+                    continue
+                if delivery.get('claimed_until') and delivery['claimed_until'] >= now:
+                    continue
+
+                delivery['claim_token'] = token
+                delivery['claimed_until'] = now + timedelta(seconds=lease)
+                delivery['time_received'] = now
+                claimed.append(dict(delivery))
+
+                if delivery['_id'] not in self.sent_records:
+                    self.sent_records[delivery['_id']] = dict(delivery)
+
+            if visibility is None:
+                for delivery in claimed:
+                    del queue[delivery['_id']]
+
+            return claimed
+
+    def ack(self, entity_id, message_ids):
+        message_ids = set(message_ids)
+
+        with self.lock:
+            queue = self.deliveries.get(entity_id, {})
+            acked = [k for k, d in queue.items() if d['message_id'] in message_ids and 'claim_token' in d]
+            for k in acked:
+                del queue[k]
+
+            return len(acked)
+
+    def reassign(self, entity_id, receivers):
+        now = datetime.now()
+
+        with self.lock:
+            queue = self.deliveries.get(entity_id, {})
+
+            moved = 0
+            for delivery_id, receiver_entity_id in receivers.items():
+                delivery = queue.get(delivery_id)
+                if delivery is None or (delivery.get('claimed_until') and delivery['claimed_until'] >= now):
+                    continue
+
+                del queue[delivery_id]
+                delivery.pop('claim_token', None)
+                delivery.pop('claimed_until', None)
+                delivery['receiver_entity_id'] = receiver_entity_id
+                self.deliveries.setdefault(receiver_entity_id, OrderedDict())[delivery_id] = delivery
+                moved += 1
+
+            return moved
+
+    def sent(self, sent_ids):
+        with self.lock:
+            return [dict(self.sent_records[s]) for s in sent_ids if s in self.sent_records]
+
+    def sent_to(self, entity_id, message_ids=None, exclude_message_name=None, after=None, limit=None):
+        if message_ids is not None:
+            message_ids = set(message_ids)
+
+        with self.lock:
+            return self._page([s for s in self.sent_records.values()
+                if s['receiver_entity_id'] == entity_id
+                and (message_ids is None or s['message_id'] in message_ids)
+                and (exclude_message_name is None or s['message_name'] != exclude_message_name)], after, limit)
+
+    def mark_responded(self, sent_ids, when):
+        with self.lock:
+            for s in sent_ids:
+                if s in self.sent_records:
+                    self.sent_records[s]['time_responded'] = when
+
+    def add_responses(self, responses):
+        with self.lock:
+            ids = []
+            for response in responses:
+                ids += self._insert(self.responses.setdefault(response['receiver_entity_id'], OrderedDict()), [response])
+            return ids
+
+    def take_responses(self, entity_id, session_token):
+        with self.lock:
+            queue = self.responses.get(entity_id, {})
+            taken = [k for k, r in queue.items() if r['session_token'] == session_token]
+            return [queue.pop(k) for k in taken]
+
+    def return_responses(self, responses):
+        with self.lock:
+            for response in reversed(responses):
+                queue = self.responses.setdefault(response['receiver_entity_id'], OrderedDict())
+                queue[response['_id']] = response
+                queue.move_to_end(response['_id'], last=False)
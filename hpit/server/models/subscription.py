@@ -8,3 +8,8 @@ class Subscription(db.Model):
     plugin_id = db.Column(db.Integer, db.ForeignKey('plugin.id', ondelete='CASCADE'))
     message_name = db.Column(db.String(255), nullable=False)
     time = db.Column(db.DateTime(), nullable = False)
+
+    #Plugins subscribed with the same shard_group split the messages between
+    #them by the payload's shard_key, see SubscriptionRouter.
+    shard_key = db.Column(db.String(255))
+    shard_group = db.Column(db.String(255))
@@ -0,0 +1,90 @@
+import threading
+import time
+
+class MessageNotifier:
+    """
+    Lets long-polling requests sleep until something is queued for them.
+
+    Every key (usually a receiver entity_id) has a generation number. Routes that
+    queue data for a key call notify(), which bumps the generation and wakes up
+    any request waiting on that key. Waiters take a snapshot of the generation
+    before they query, so a notification that lands between the query and the
+    wait is never lost.
+
+    Generations are drawn from one counter, so a key never goes back to a
+    generation someone may have snapshotted. Keys nobody has been notified on
+    for PRUNE_AGE seconds are forgotten, checked at most that often by notify();
+    no snapshot is held that long before its wait.
+
+    This is process local. Requests in other server processes will not be woken,
+    so callers should wait in bounded slices and re-check when a slice expires.
+    """
+
+    PRUNE_AGE = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counter = 0
+        self.generations = {}
+        self.notified = {}
+        self.conditions = {}
+        self.waiters = {}
+        self.last_pruned = time.time()
+
+    def generation(self, key):
+        with self.lock:
+            return self.generations.get(key, 0)
+
+    def notify(self, keys):
+        now = time.time()
+
+        with self.lock:
+            for key in set(keys):
+                self.counter += 1
+                self.generations[key] = self.counter
+                self.notified[key] = now
+
+                if key in self.conditions:
+                    self.conditions[key].notify_all()
+
+            if now - self.last_pruned >= self.PRUNE_AGE:
+                self._prune(now)
+
+    def _prune(self, now):
+        #Called with the lock held.
+        stale = [key for key, when in self.notified.items()
+            if now - when >= self.PRUNE_AGE and key not in self.waiters]
+
+        for key in stale:
+            del self.generations[key]
+            del self.notified[key]
+
+        self.last_pruned = now
+
+    def wait(self, key, generation, timeout):
+        """
+        Block until key is notified after the given generation or timeout seconds pass.
+
+        Returns True if a notification arrived, False on timeout.
+        """
+        deadline = time.time() + timeout
+
+        with self.lock:
+            if key not in self.conditions:
+                self.conditions[key] = threading.Condition(self.lock)
+            condition = self.conditions[key]
+            self.waiters[key] = self.waiters.get(key, 0) + 1
+
+            try:
+                while self.generations.get(key, 0) == generation:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    condition.wait(remaining)
+
+                return True
+            finally:
+                self.waiters[key] -= 1
+                if not self.waiters[key]:
+                    del self.waiters[key]
+                    del self.conditions[key]
@@ -0,0 +1,150 @@
+import bisect
+import hashlib
+import threading
+import time
+from datetime import datetime, timedelta
+
+def _hash(value):
+    """
+    A hash of a string that is the same in every process, unlike hash().
+    """
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class ShardRing:
+    """
+    A consistent hash ring over the plugins of one shard group, placing each
+    plugin at replicas points so the shards come out about even.
+
+    A message goes to the plugin owning the hash of its payload's shard_key.
+    Messages without the key all go to the same plugin. A plugin joining or
+    leaving the ring only moves the keys on its own points, about 1/K of them.
+    """
+
+    def __init__(self, shard_key, entity_ids, replicas=64):
+        self.shard_key = shard_key
+
+        points = sorted((_hash(entity_id + "#" + str(i)), entity_id)
+            for entity_id in entity_ids for i in range(replicas))
+
+        self.hashes = [h for h, entity_id in points]
+        self.entity_ids = [entity_id for h, entity_id in points]
+
+    def owner(self, payload):
+        value = payload.get(self.shard_key) if isinstance(payload, dict) else None
+
+        i = bisect.bisect(self.hashes, _hash(str(value))) % len(self.hashes)
+        return self.entity_ids[i]
+
+class SubscriptionRouter:
+    """
+    Process-local index of message_name -> subscribed plugin entity_ids.
+
+    The index is loaded with a single query and reused until the shared
+    'subscriptions' version changes. Routes that add or remove subscriptions
+    must call invalidate() so every server process reloads its copy.
+
+    Plugins that subscribe with a shard_group share the messages between them:
+    each message goes to only one connected plugin of the group, picked with a
+    ShardRing. Routes that connect or disconnect a sharded plugin must also
+    call invalidate() so the rings are rebuilt without it. A plugin that has
+    not polled for stale_after seconds is left out of the rings too, as if it
+    had disconnected, so a crashed plugin doesn't keep its share; the index is
+    reloaded when the next member would go stale.
+    """
+
+    def __init__(self, db, version, stale_after=300):
+        self.db = db
+        self.version = version
+        self.stale_after = stale_after
+
+        self.lock = threading.Lock()
+        self.routes = None
+        self.rings = None
+        self.loaded_version = None
+        self.expires = None
+
+    def _index(self):
+        #Called with the lock held.
+        version = self.version.current()
+
+        if self.routes is None or version != self.loaded_version or time.time() >= self.expires:
+            self.routes, self.rings, self.expires = self._load()
+            self.loaded_version = version
+
+    def receivers(self, message_name, payload=None):
+        with self.lock:
+            self._index()
+
+            receivers = list(self.routes.get(message_name, []))
+            for group, members, ring in self.rings.get(message_name, []):
+                receivers.append(ring.owner(payload))
+
+            return receivers
+
+    def is_sharded(self, entity_id):
+        """
+        Whether entity_id is in a shard group, connected or not.
+        """
+        with self.lock:
+            self._index()
+
+            return any(entity_id in members
+                for rings in self.rings.values() for group, members, ring in rings)
+
+    def shard_owner(self, message_name, entity_id, payload):
+        """
+        The plugin that now owns the shard of payload in the group entity_id
+        subscribed to message_name with, or None if it isn't sharded.
+        """
+        with self.lock:
+            self._index()
+
+            for group, members, ring in self.rings.get(message_name, []):
+                if entity_id in members:
+                    return ring.owner(payload)
+
+            return None
+
+    def invalidate(self):
+        with self.lock:
+            self.routes = None
+        self.version.bump()
+
+    def _load(self):
+        """
+        Returns the routes, the rings, and the time.time() the index is good until.
+        """
+        from .models import Plugin, Subscription
+
+        rows = self.db.session.query(Subscription.message_name, Plugin.entity_id,
+            Subscription.shard_key, Subscription.shard_group, Plugin.connected,
+            Plugin.time_last_polled).join(
+            Plugin, Subscription.plugin_id == Plugin.id)
+
+        now = datetime.now()
+        stale_after = timedelta(seconds=self.stale_after)
+        expires = time.time() + self.stale_after
+
+        routes = {}
+        groups = {}
+        for message_name, entity_id, shard_key, shard_group, connected, last_polled in rows:
+            if shard_group:
+                alive = connected and last_polled is not None and now - last_polled < stale_after
+                if alive:
+                    expires = min(expires, time.time() + (last_polled + stale_after - now).total_seconds())
+
+                groups.setdefault((message_name, shard_group), []).append((entity_id, shard_key, alive))
+            else:
+                routes.setdefault(message_name, []).append(entity_id)
+
+        rings = {}
+        for (message_name, shard_group), members in groups.items():
+            members.sort()
+
+            #With nobody alive, keep queueing for the whole group until someone is back.
+            connected = [entity_id for entity_id, shard_key, c in members if c] or [m[0] for m in members]
+
+            ring = ShardRing(members[0][1], connected)
+            rings.setdefault(message_name, []).append((shard_group, {m[0] for m in members}, ring))
+
+        return routes, rings, expires
@@ -1,47 +1,296 @@
+import threading
+from collections import OrderedDict
 from uuid import uuid4
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timedelta
 from flask.sessions import SessionInterface, SessionMixin
 from werkzeug.datastructures import CallbackDict
 
-class MongoSession(CallbackDict, SessionMixin):
+#How long a record of a changed session is kept for the other server
+#processes to drop their cached copy. A process that has not checked for that
+#long clears its whole cache instead.
+INVALIDATION_RETENTION = 3600
 
-    def __init__(self, initial=None, sid=None):
-        CallbackDict.__init__(self, initial)
+#Changes are looked up from this many seconds before the last check, so a
+#record written by a process with a slightly slow clock is not missed.
+INVALIDATION_MARGIN = 5
+
+class ServerSession(CallbackDict, SessionMixin):
+
+    def __init__(self, initial=None, sid=None, expiration=None):
+        def on_update(self):
+            self.modified = True
+
+        CallbackDict.__init__(self, initial, on_update)
         self.sid = sid
+        self.expiration = expiration
         self.modified = False
 
 
-class MongoSessionInterface(SessionInterface):
+class MongoSessionStore:
+    """
+    Sessions kept in the sessions collection, shared by every server process.
+    Expired sessions are removed by the TTL index on expiration (see the indexdb
+    command).
+
+    Sessions changed or deleted in place are recorded in session_invalidations,
+    which the TTL index on time empties after INVALIDATION_RETENTION seconds.
+    """
 
     def __init__(self, app, mongo):
         with app.app_context():
-            self.store = mongo.db.sessions
+            self.collection = mongo.db.sessions
+            self.invalidations = mongo.db.session_invalidations
+
+    def load(self, sid):
+        """Return (data, expiration) for sid, or None."""
+        stored = self.collection.find_one({'_id': sid})
+        if not stored:
+            return None
+
+        return stored['data'], stored['expiration']
+
+    def save(self, sid, data, expiration):
+        self.collection.update({'_id': sid}, {
+            'entity_id': data.get('entity_id'),
+            'data': data,
+            'expiration': expiration,
+        }, upsert=True)
+
+    def delete(self, sid):
+        self.collection.remove({'_id': sid})
+        self.invalidate(sid)
+
+    def invalidate(self, sid):
+        """Record that sid changed, for other processes to drop their copy."""
+        self.invalidations.insert({'sid': sid, 'time': datetime.utcnow()})
+
+    def invalidated_since(self, when):
+        """The sids changed since when."""
+        return [i['sid'] for i in self.invalidations.find({'time': {'$gte': when}}, {'sid': True})]
+
+    def delete_entity(self, entity_id):
+        """Remove every session of entity_id, returning how many."""
+        return self.collection.remove({'entity_id': entity_id})['n']
+
+    def delete_expired(self, now):
+        return self.collection.remove({'expiration': {'$lt': now}})['n']
+
+
+class MemorySessionStore:
+    """
+    Sessions kept in this process's memory, for single process deployments.
+    Nothing survives a restart. Expired sessions are removed by save(), at most
+    once a minute.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.invalidations = OrderedDict()
+        self.last_expired = datetime.utcnow()
+
+    def load(self, sid):
+        with self.lock:
+            stored = self.sessions.get(sid)
+            if not stored:
+                return None
+
+            return dict(stored['data']), stored['expiration']
+
+    def save(self, sid, data, expiration):
+        now = datetime.utcnow()
+        if now - self.last_expired >= timedelta(seconds=60):
+            self.last_expired = now
+            self.delete_expired(now)
+
+        with self.lock:
+            self.sessions[sid] = {'data': dict(data), 'expiration': expiration}
+
+    def delete(self, sid):
+        with self.lock:
+            self.sessions.pop(sid, None)
+        self.invalidate(sid)
+
+    def invalidate(self, sid):
+        now = datetime.utcnow()
+        retention = timedelta(seconds=INVALIDATION_RETENTION)
+
+        with self.lock:
+            self.invalidations.pop(sid, None)
+            self.invalidations[sid] = now
+
+            while self.invalidations and next(iter(self.invalidations.values())) < now - retention:
+                self.invalidations.popitem(last=False)
+
+    def invalidated_since(self, when):
+        with self.lock:
+            return [sid for sid, time in self.invalidations.items() if time >= when]
+
+    def delete_entity(self, entity_id):
+        with self.lock:
+            sids = [s for s, stored in self.sessions.items() if stored['data'].get('entity_id') == entity_id]
+            for sid in sids:
+                del self.sessions[sid]
+
+            return len(sids)
+
+    def delete_expired(self, now):
+        with self.lock:
+            sids = [s for s, stored in self.sessions.items() if stored['expiration'] < now]
+            for sid in sids:
+                del self.sessions[sid]
+
+            return len(sids)
+
+
+class CachedSessionInterface(SessionInterface):
+    """
+    Server-side sessions. The cookie only carries a random session id, the data
+    lives in store, with the cache_size most recently used sessions also held in
+    a process-local LRU so most requests never reach the store.
+
+    Sessions last lifetime seconds from their last use. To avoid a write on
+    every request the expiration is only pushed back once less than half of
+    the lifetime is left.
+
+    A session changed or deleted in place is recorded in the store, and every
+    server process drops its cached copy of that session when it next checks,
+    at most once every version check_interval seconds. rotate() gives a session
+    a new id instead, so nothing holds the new one yet.
+
+    revoke_entity() ends every session of an entity on the server. It bumps the
+    shared 'sessions' version, which clears the LRU of every server process.
+    """
+
+    def __init__(self, store, version, lifetime=86400, cache_size=10000):
+        self.store = store
+        self.version = version
+        self.lifetime = timedelta(seconds=lifetime)
+        self.cache_size = cache_size
+
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+        self.loaded_version = None
+        self.last_checked = datetime.utcnow()
+
+    def _invalidated(self):
+        """
+        The sids changed elsewhere since the last check, or None if the cache
+        must be cleared because the records of some may be gone already.
+        """
+        now = datetime.utcnow()
+        last_checked = self.last_checked
+
+        if now - last_checked < timedelta(seconds=self.version.check_interval):
+            return []
+
+        self.last_checked = now
+        if now - last_checked >= timedelta(seconds=INVALIDATION_RETENTION):
+            return None
+
+        return self.store.invalidated_since(last_checked - timedelta(seconds=INVALIDATION_MARGIN))
+
+    def _cached(self, sid):
+        version = self.version.current()
+        invalidated = self._invalidated()
+
+        with self.lock:
+            if version != self.loaded_version or invalidated is None:
+                self.cache = OrderedDict()
+                self.loaded_version = version
+                return None
+
+            for changed in invalidated:
+                self.cache.pop(changed, None)
+
+            stored = self.cache.get(sid)
+            if stored:
+                self.cache.move_to_end(sid)
+
+            return stored
+
+    def _cache(self, sid, data, expiration):
+        with self.lock:
+            self.cache[sid] = (dict(data), expiration)
+            self.cache.move_to_end(sid)
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _forget(self, sid):
+        with self.lock:
+            self.cache.pop(sid, None)
 
     def open_session(self, app, request):
         sid = request.cookies.get(app.session_cookie_name)
+
         if sid:
-            stored_session = self.store.find_one({'sid': sid})
-            if stored_session:
-                if stored_session.get('expiration') > datetime.now(timezone.utc):
-                    return MongoSession(initial=stored_session['data'],
-                                        sid=stored_session['sid'])
-        sid = str(uuid4())
-        return MongoSession(sid=sid)
+            stored = self._cached(sid)
+
+            #Another process may have pushed the expiration back since we cached it.
+            if stored is None or stored[1] <= datetime.utcnow():
+                stored = self.store.load(sid)
+                if stored is not None:
+                    self._cache(sid, *stored)
+
+            if stored is not None:
+                data, expiration = stored
+                if expiration > datetime.utcnow():
+                    return ServerSession(data, sid=sid, expiration=expiration)
+
+        return ServerSession(sid=str(uuid4()))
 
     def save_session(self, app, session, response):
         domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
         if not session:
-            response.delete_cookie(app.session_cookie_name, domain=domain)
+            if session.modified:
+                self.delete(session.sid)
+                response.delete_cookie(app.session_cookie_name, domain=domain, path=path)
             return
-        if self.get_expiration_time(app, session):
-            expiration = self.get_expiration_time(app, session)
-        else:
-            expiration = datetime.utcnow() + timedelta(hours=1)
-        self.store.update({'sid': session.sid},
-                          {'sid': session.sid,
-                           'data': session,
-                           'expiration': expiration}, True)
+
+        now = datetime.utcnow()
+        expiring = session.expiration is None or session.expiration - now < self.lifetime / 2
+
+        if session.modified or expiring:
+            expiration = now + self.lifetime
+            self.store.save(session.sid, dict(session), expiration)
+            self._cache(session.sid, session, expiration)
+
+            #A session that was already stored may be cached by other processes.
+            if session.modified and session.expiration is not None:
+                self.store.invalidate(session.sid)
+
         response.set_cookie(app.session_cookie_name, session.sid,
                             expires=self.get_expiration_time(app, session),
-                            httponly=True, domain=domain)
+                            httponly=True, domain=domain, path=path)
+
+    def delete(self, sid):
+        self._forget(sid)
+        self.store.delete(sid)
+
+    def rotate(self, session):
+        """
+        Give session a new id, deleting the one it had, so that a session fixed
+        by someone else or cached before is not the one that gets connected.
+        """
+        if session.expiration is not None:
+            self.delete(session.sid)
+
+        session.sid = str(uuid4())
+        session.expiration = None
+        session.modified = True
+
+    def revoke_entity(self, entity_id):
+        """
+        End every session of entity_id in all server processes, returning how
+        many there were.
+        """
+        revoked = self.store.delete_entity(entity_id)
+
+        with self.lock:
+            self.cache = OrderedDict()
+        self.version.bump()
 
+        return revoked
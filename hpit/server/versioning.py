@@ -0,0 +1,98 @@
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+class SharedVersion:
+    """
+    A version token shared between server processes through MongoDB.
+
+    Process-local caches remember the token they were built against and rebuild
+    when it changes. Any process that changes the underlying data calls bump(),
+    which stores a fresh token. Reads hit MongoDB at most once every
+    check_interval seconds, so other processes see a change within that window.
+    """
+
+    def __init__(self, mongo, name, check_interval=1):
+        self.mongo = mongo
+        self.name = name
+        self.check_interval = check_interval
+
+        self.version = None
+        self.last_checked = None
+
+    def current(self):
+        now = time.time()
+
+        if self.last_checked is None or now - self.last_checked >= self.check_interval:
+            if self.mongo is not None:
+                record = self.mongo.db.cache_versions.find_one({'_id': self.name})
+                self.version = record['version'] if record else None
+
+            self.last_checked = now
+
+        return self.version
+
+    def bump(self):
+        self.version = str(uuid4())
+        self.last_checked = time.time()
+
+        if self.mongo is not None:
+            self.mongo.db.cache_versions.update(
+                {'_id': self.name},
+                {'$set': {'version': self.version}},
+                upsert=True
+            )
+
+        return self.version
+
+
+class SharedKeys:
+    """
+    The keys of a process-local cache changed by any server process, shared
+    through MongoDB, for caches that drop single entries rather than all of them.
+
+    changed() records keys in the cache_invalidations collection, which the TTL
+    index on time (see the indexdb command) empties after RETENTION seconds.
+    since_last_check() returns the keys recorded since this process last looked,
+    hitting MongoDB at most once every check_interval seconds. It returns None
+    when the process has not looked for so long that some records may be gone,
+    and the whole cache must be dropped instead.
+    """
+
+    RETENTION = 3600
+
+    #Keys are looked up from this many seconds before the last check, so a
+    #record written by a process with a slightly slow clock is not missed.
+    MARGIN = 5
+
+    def __init__(self, mongo, name, check_interval=1):
+        self.mongo = mongo
+        self.name = name
+        self.check_interval = check_interval
+
+        self.last_checked = datetime.utcnow()
+
+    def changed(self, keys):
+        if self.mongo is not None and keys:
+            now = datetime.utcnow()
+            self.mongo.db.cache_invalidations.insert([{'cache': self.name, 'key': k, 'time': now} for k in keys])
+
+    def since_last_check(self):
+        now = datetime.utcnow()
+        last_checked = self.last_checked
+
+        if now - last_checked < timedelta(seconds=self.check_interval):
+            return []
+
+        self.last_checked = now
+        if self.mongo is None:
+            return []
+        if now - last_checked >= timedelta(seconds=self.RETENTION):
+            return None
+
+        found = self.mongo.db.cache_invalidations.find({
+            'cache': self.name,
+            'time': {'$gte': last_checked - timedelta(seconds=self.MARGIN)},
+        }, {'key': True})
+
+        return [r['key'] for r in found]
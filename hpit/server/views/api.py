@@ -1,22 +1,53 @@
 from uuid import uuid4
 from bson.objectid import ObjectId
 from datetime import datetime,timedelta
-from flask import session, jsonify, abort, request, Response
+from flask import session, jsonify, abort, request, Response, stream_with_context
 import uuid
+import time
 
 from hpit.server.app import ServerApp
+from hpit.server.wire import request_data, respond, respond_stream, to_json
+from werkzeug.http import http_date
 app_instance = ServerApp.get_instance()
 app = app_instance.app
 mongo = app_instance.mongo
 db = app_instance.db
 csrf = app_instance.csrf
+notifier = app_instance.notifier
+router = app_instance.router
+message_bus = app_instance.message_bus
+entities = app_instance.entities
+authorization = app_instance.authorization
+sessions = app_instance.sessions
 
-from hpit.server.models import Plugin, Tutor, Subscription, MessageAuth, ResourceAuth
+from hpit.server.models import Plugin, Tutor, Subscription
 
 from hpit.management.settings_manager import SettingsManager
 settings = SettingsManager.get_server_settings()
 
-import random
+#Longest a poll route may hold a request open, and how often a held request re-checks
+#the database in case the message was queued by another server process.
+LONG_POLL_MAX_WAIT = getattr(settings, 'LONG_POLL_MAX_WAIT', 60)
+LONG_POLL_RECHECK = getattr(settings, 'LONG_POLL_RECHECK', 5)
+
+#Most messages handed out by one poll, and the longest a poller may hold them unacked.
+MESSAGE_BATCH_MAX = getattr(settings, 'MESSAGE_BATCH_MAX', 100)
+MESSAGE_VISIBILITY_MAX = getattr(settings, 'MESSAGE_VISIBILITY_MAX', 3600)
+
+#Most entries accepted by one call to a /batch submission route.
+MESSAGE_SUBMIT_BATCH_MAX = getattr(settings, 'MESSAGE_SUBMIT_BATCH_MAX', 1000)
+
+#The parts of the original message kept on a response, enough for clients to
+#dispatch it. The rest can be asked for with /response/list?full_message=1.
+RESPONSE_MESSAGE_FIELDS = ['message_id', 'message_name', 'sender_entity_id', 'receiver_entity_id', 'session_token']
+
+#Longest a /response/stream connection is held open before the client has to
+#reconnect, and how often an idle stream sends a keep-alive.
+RESPONSE_STREAM_MAX = getattr(settings, 'RESPONSE_STREAM_MAX', 300)
+RESPONSE_STREAM_KEEPALIVE = getattr(settings, 'RESPONSE_STREAM_KEEPALIVE', 15)
+
+#Most messages returned by one page of /plugin/message/history or /plugin/message/preview.
+HISTORY_PAGE_MAX = getattr(settings, 'HISTORY_PAGE_MAX', 500)
 
 def _map_mongo_document(document):
     mapped_doc = {}
@@ -33,6 +64,182 @@ def _map_mongo_document(document):
 
     return mapped_doc
 
+def _message_payloads(documents):
+    """
+    Return the payload for each queued/sent message document, in order.
+
+    Fan-out documents only reference the shared message, so the payloads are
+    fetched in one query. Older documents that still carry their own copy of
+    the payload are used as is.
+    """
+    missing = list({d['message_id'] for d in documents if 'payload' not in d})
+
+    shared = {}
+    if missing:
+        shared = message_bus.message_payloads(missing)
+
+    return [d['payload'] if 'payload' in d else shared.get(d['message_id'], {}) for d in documents]
+
+def _queue_messages(message_name_payloads):
+    """
+    Store a list of (message_name, payload) from the current session's entity and
+    queue them for their subscribers. All the messages are written with one
+    insert and all the fan-out with another. The payload stays on the shared
+    message document and is not copied per receiver.
+
+    Returns the message_ids in the order given.
+    """
+    now = datetime.now()
+
+    messages = [{
+        'sender_entity_id': session['entity_id'],
+        'session_token': session['token'],
+        'time_created': now,
+        'message_name': message_name,
+        'payload': payload,
+    } for message_name, payload in message_name_payloads]
+
+    message_ids = message_bus.add_messages(messages)
+
+    deliveries = []
+    receivers = set()
+    for message_id, message in zip(message_ids, messages):
+        for plugin_entity_id in router.receivers(message['message_name'], message['payload']):
+            receivers.add(plugin_entity_id)
+            deliveries.append({
+                'message_id': message_id,
+                'sender_entity_id': message['sender_entity_id'],
+                'session_token': message['session_token'],
+                'receiver_entity_id': plugin_entity_id,
+                'time_created': now,
+                'message_name': message['message_name'],
+            })
+
+    if deliveries:
+        message_bus.queue(deliveries)
+
+    notifier.notify(list(receivers))
+
+    return message_ids
+
+def _hand_off(entity_id):
+    """
+    Requeue the sharded deliveries a plugin leaving its shard group had not
+    claimed, for the plugins that own their shards now.
+    """
+    queued = message_bus.queued(entity_id)
+    if not queued:
+        return
+
+    payloads = message_bus.message_payloads(list({d['message_id'] for d in queued}))
+
+    receivers = {}
+    for delivery in queued:
+        owner = router.shard_owner(delivery['message_name'], entity_id, payloads.get(delivery['message_id']))
+        if owner is not None and owner != entity_id:
+            receivers[delivery['_id']] = owner
+
+    if receivers and message_bus.reassign(entity_id, receivers):
+        notifier.notify(list(set(receivers.values())))
+
+def _full_messages(responses):
+    """
+    Return the complete original message, payload included, for each response.
+
+    Responses only carry the RESPONSE_MESSAGE_FIELDS of their message. Older
+    responses that embedded the whole message are returned as they are.
+    """
+    slim_ids = [r['message']['_id'] for r in responses if 'payload' not in r['message']]
+
+    sent = {}
+    if slim_ids:
+        plugin_messages = message_bus.sent(slim_ids)
+        for plugin_message, payload in zip(plugin_messages, _message_payloads(plugin_messages)):
+            plugin_message['payload'] = payload
+            sent[plugin_message['_id']] = plugin_message
+
+    return [r['message'] if 'payload' in r['message'] else sent.get(r['message']['_id'], r['message']) for r in responses]
+
+def _response_key(entity_id, session_token):
+    """
+    The notifier key that wakes streams and polls waiting on a session's responses.
+    """
+    return ('responses', entity_id, session_token)
+
+def _response_results(my_responses, full_message=False):
+    """
+    Generate the dict sent to the client for each response, ready for respond_stream().
+    """
+    if full_message:
+        messages = _full_messages(my_responses)
+    else:
+        messages = (t['message'] for t in my_responses)
+
+    return ({'message': m, 'response': t['response']} for t, m in zip(my_responses, messages))
+
+def _queue_responses(message_id_payloads):
+    """
+    Queue responses from the current session's entity for a list of
+    (message_id, payload), back to the senders of those messages. The messages
+    are looked up with one query and the responses written with one insert.
+
+    Returns a response_id for each entry in order, or None where the entity was
+    never sent a message with that message_id.
+    """
+    responder_entity_id = session['entity_id']
+
+    message_ids = [ObjectId(m) if ObjectId.is_valid(m) else None for m, payload in message_id_payloads]
+
+    plugin_messages = message_bus.sent_to(responder_entity_id, [m for m in message_ids if m is not None])
+
+    by_message_id = {}
+    for p in plugin_messages:
+        by_message_id[p['message_id']] = {k: p[k] for k in ['_id'] + RESPONSE_MESSAGE_FIELDS if k in p}
+
+    now = datetime.now()
+    responses = []
+    for message_id, (unused, payload) in zip(message_ids, message_id_payloads):
+        plugin_message = by_message_id.get(message_id)
+        if not plugin_message:
+            responses.append(None)
+            continue
+
+        responses.append({
+            'message_id': plugin_message['message_id'],
+            'session_token':plugin_message["session_token"],
+            'sender_entity_id': responder_entity_id,
+            'receiver_entity_id': plugin_message['sender_entity_id'],
+            'message': plugin_message,
+            'response': payload,
+            'time_created': now,
+        })
+
+    found = [r for r in responses if r]
+    if not found:
+        return [None] * len(responses)
+
+    message_bus.mark_responded([r['message']['_id'] for r in found], now)
+
+    response_ids = iter(message_bus.add_responses(found))
+
+    notifier.notify([_response_key(r['receiver_entity_id'], r['session_token']) for r in found])
+
+    return [next(response_ids) if r else None for r in responses]
+
+def _batch_entries(data):
+    """
+    Return the list of entries posted to a /batch submission route, or None if
+    it is missing, not a list, or too long.
+    """
+    if 'messages' not in data:
+        return None
+
+    entries = data['messages']
+    if not isinstance(entries, list) or len(entries) > MESSAGE_SUBMIT_BATCH_MAX:
+        return None
+
+    return entries
+
 def user_verified(message_name,plugin):
     if "." in message_name:
         message_parts = message_name.split(".")
@@ -47,6 +254,162 @@ def user_verified(message_name,plugin):
         
     
 
+def _shard_peers(plugin, message_owners, shard_group):
+    """
+    The message names, out of message_owners, whose owner is another plugin of
+    plugin's user subscribed to them in shard_group.
+    """
+    owned = {m: o for m, o in message_owners.items() if o is not None and o != plugin.entity_id}
+    if not owned:
+        return []
+
+    rows = db.session.query(Subscription.message_name, Plugin.entity_id).join(
+        Plugin, Subscription.plugin_id == Plugin.id).filter(
+        Plugin.user_id == plugin.user_id,
+        Subscription.shard_group == shard_group,
+        Subscription.message_name.in_(list(owned.keys())))
+
+    return [m for m, entity_id in rows if owned[m] == entity_id]
+
+def _subscribe(plugin, message_names, shard_key=None, shard_group=None):
+    """
+    Subscribe plugin to message_names, returning a dict of message_name -> "OK",
+    "EXISTS" or "invalid message name".
+
+    Unowned message names the plugin may own are granted to it with one commit,
+    then the new subscriptions are added and the existing ones refreshed with
+    another.
+
+    With a shard_group, the plugin shares the messages with the other plugins
+    subscribed in that group, by the payload's shard_key. Joining a group its
+    owner already subscribed in grants the plugin the messages, when both
+    plugins belong to the same user.
+    """
+    results = {}
+
+    #message auth, the first plugin to subscribe to a message name owns it
+    owners = authorization.message_owners(message_names)
+    unowned = []
+    for message_name, owner in owners.items():
+        if owner is not None:
+            continue
+
+        if user_verified(message_name, plugin):
+            unowned.append(message_name)
+        else:
+            results[message_name] = "invalid message name"
+
+    if unowned:
+        authorization.grant_messages([(m, plugin.entity_id) for m in unowned], is_owner=True)
+
+    if shard_group:
+        peers = _shard_peers(plugin, owners, shard_group)
+        if peers:
+            authorization.grant_messages([(m, plugin.entity_id) for m in peers])
+
+    names = list({m for m in message_names if m not in results})
+    if not names:
+        return results
+
+    now = datetime.now()
+    existing = Subscription.query.filter(
+        Subscription.plugin_id == plugin.id,
+        Subscription.message_name.in_(names)
+    )
+    existing_rows = existing.all()
+    existing_names = {s.message_name for s in existing_rows}
+    resharded = any((s.shard_key, s.shard_group) != (shard_key, shard_group) for s in existing_rows)
+
+    if existing_names:
+        existing.update({'time': now, 'shard_key': shard_key, 'shard_group': shard_group}, synchronize_session=False)
+
+    for message_name in names:
+        if message_name in existing_names:
+            results[message_name] = "EXISTS"
+            continue
+
+        subscription = Subscription()
+        subscription.plugin = plugin
+        subscription.message_name = message_name
+        subscription.time = now
+        subscription.shard_key = shard_key
+        subscription.shard_group = shard_group
+        db.session.add(subscription)
+
+        results[message_name] = "OK"
+
+    db.session.commit()
+
+    if len(existing_names) < len(names) or resharded:
+        router.invalidate()
+
+    return results
+
+def _long_poll_timeout():
+    try:
+        wait = float(request.args.get('wait', 0))
+    except ValueError:
+        return 0
+
+    return max(0, min(wait, LONG_POLL_MAX_WAIT))
+
+def _batch_max():
+    try:
+        limit = int(request.args.get('max', MESSAGE_BATCH_MAX))
+    except ValueError:
+        return MESSAGE_BATCH_MAX
+
+    return max(1, min(limit, MESSAGE_BATCH_MAX))
+
+def _visibility_timeout():
+    if 'visibility' not in request.args:
+        return None
+
+    try:
+        visibility = float(request.args['visibility'])
+    except ValueError:
+        return None
+
+    return max(1, min(visibility, MESSAGE_VISIBILITY_MAX))
+
+def _history_page():
+    """
+    Return the (after, limit) asked for with ?after=<id>&limit= on a history
+    route, or None if after is not a valid id.
+    """
+    after = request.args.get('after')
+    if after is not None:
+        if not ObjectId.is_valid(after):
+            return None
+        after = ObjectId(after)
+
+    try:
+        limit = int(request.args.get('limit', HISTORY_PAGE_MAX))
+    except ValueError:
+        limit = HISTORY_PAGE_MAX
+
+    return after, max(1, min(limit, HISTORY_PAGE_MAX))
+
+def _authorized_messages(entity_id, documents):
+    """
+    Keep the documents whose message_name entity_id holds a MessageAuth for.
+    """
+    if not documents:
+        return []
+
+    authorized = authorization.authorized_message_names(entity_id, [d['message_name'] for d in documents])
+
+    return [d for d in documents if d['message_name'] in authorized]
+
+def _next_cursor(documents, limit):
+    """
+    The ?after= for the page following documents, or None if this was the last.
+    """
+    if len(documents) < limit:
+        return None
+
+    return str(documents[-1]['_id'])
+
 def bad_parameter_response(parameter):
     return ("Missing parameter: " + parameter, 401, dict(mimetype="application/json"))
 
@@ -88,7 +451,8 @@ def connect():
     """
     SUPPORTS: POST
 
-    Establishes a RESTful session with HPIT.
+    Establishes a RESTful session with HPIT. The session always gets a new id,
+    sent back in the session cookie.
 
     Accepts: JSON
         - entity_id : string -> Assigned entity id (unique)
@@ -106,10 +470,7 @@ def connect():
     entity_id = request.json['entity_id']
     api_key = request.json['api_key']
     
-    entity = Tutor.query.filter_by(entity_id=entity_id).first()
-
-    if not entity:
-        entity = Plugin.query.filter_by(entity_id=entity_id).first()
+    entity = entities.get(entity_id)
 
     if not entity:
         return not_found_response()
@@ -117,7 +478,8 @@ def connect():
     if not entity.authenticate(api_key):
         return auth_failed_response()
 
-    #Clear the session
+    #Start a new session, under a new id
+    sessions.rotate(session)
     session.clear()
 
     #Renew Session
@@ -126,11 +488,13 @@ def connect():
     session['entity_id'] = entity_id
     session['token'] = str(uuid.uuid4())
     
-    entity.connected = True
-
-    db.session.add(entity)
+    entity.model.query.filter_by(id=entity.id).update({'connected': True})
     db.session.commit()
 
+    #Take back a share of the shard group's messages.
+    if entity.model is Plugin and router.is_sharded(entity_id):
+        router.invalidate()
+
     #All is well
     return ok_response()
 
@@ -166,10 +530,7 @@ def disconnect():
     entity_id = session['entity_id']
     api_key = request.json['api_key']
 
-    entity = Tutor.query.filter_by(entity_id=entity_id).first()
-    
-    if not entity:
-        entity = Plugin.query.filter_by(entity_id=entity_id).first()
+    entity = entities.get(entity_id)
 
     if not entity:
         return not_found_response()
@@ -178,11 +539,14 @@ def disconnect():
     if not entity.authenticate(api_key):
         return auth_failed_response()
         
-    entity.connected = False
-
-    db.session.add(entity)
+    entity.model.query.filter_by(id=entity.id).update({'connected': False})
     db.session.commit()
 
+    #Hand the shard group's messages to the plugins still connected.
+    if entity.model is Plugin and router.is_sharded(entity_id):
+        router.invalidate()
+        _hand_off(entity_id)
+
     session.clear()
 
     return ok_response()
@@ -278,71 +642,69 @@ def subscribe():
     """
     SUPPORTS: POST
 
-    Start listening to a message for the plugin that sends this request.
+    Start listening to a message, or a list of messages, for the plugin that
+    sends this request. Subscribing again to a message refreshes the
+    subscription, see the cleansubscriptions command.
 
     Accepts: JSON
         - message_name - the name of the message to subscribe to
+        or
+        - message_names - a list of the names of the messages to subscribe to
+        - shard_group - (optional) the name of a group of plugins to split the messages
+                        with, each message going to only one connected plugin of the group
+        - shard_key - (with shard_group) the payload field messages are split by, e.g. student_id
 
     Returns: 
         403         - A connection with HPIT must be established first.
         404         - Could not find the plugin stored in the session.
         200:OK      - Mapped the message to the plugin
         200:EXISTS  - The mapping already exists
+        200         - With message_names, a JSON dict of 'subscriptions', mapping
+                      each message name to "OK", "EXISTS" or "invalid message name".
     """
-    if 'message_name' not in request.json:
+    data = request_data()
+
+    if 'message_names' in data:
+        message_names = data['message_names']
+        if not isinstance(message_names, list) or len(message_names) > MESSAGE_SUBMIT_BATCH_MAX:
+            return bad_parameter_response('message_names')
+        if not all(isinstance(m, str) for m in message_names):
+            return bad_parameter_response('message_names')
+    elif 'message_name' in data:
+        message_names = None
+    else:
         return bad_parameter_response('message_name')
 
+    shard_group = data.get('shard_group')
+    shard_key = data.get('shard_key')
+    if shard_group is not None or shard_key is not None:
+        if not isinstance(shard_group, str) or not shard_group:
+            return bad_parameter_response('shard_group')
+        if not isinstance(shard_key, str) or not shard_key:
+            return bad_parameter_response('shard_key')
+
     if 'entity_id' not in session:
         return auth_failed_response()
 
-    message_name = request.json['message_name']
     entity_id = session['entity_id']         
 
     plugin = Plugin.query.filter_by(entity_id=entity_id).first()
 
     if not plugin:
         return not_found_response()
-        
-    #message auth
-    message_auth = MessageAuth.query.filter_by(message_name=message_name).first()
-    if not message_auth: #this will be the owner
-        if user_verified(message_name,plugin):
-            new_message_auth = MessageAuth()
-            new_message_auth.entity_id = str(entity_id)
-            new_message_auth.message_name = message_name
-            new_message_auth.is_owner = True
-            db.session.add(new_message_auth)
-            db.session.commit()
-        else:
-            return jsonify({"error":"invalid message name"})
-            
-    #remove old subscriptions
-    subscriptions = Subscription.query.filter_by(plugin=plugin)
-    for remove_subscription in subscriptions:
-        now = datetime.now()
-        if not remove_subscription.time:
-            db.session.delete(remove_subscription)
-        else:
-            dt = now - remove_subscription.time
-            if dt.days >=1:
-                db.session.delete(remove_subscription)
-    db.session.commit()
-    
-    #add subscription
-    subscription = Subscription.query.filter_by(plugin=plugin, message_name=message_name).first()
-
-    if subscription:
-        return exists_response()
 
-    subscription = Subscription()
-    subscription.plugin = plugin
-    subscription.message_name = message_name
-    subscription.time = datetime.now()
+    if message_names is None:
+        results = _subscribe(plugin, [data['message_name']], shard_key, shard_group)
+        result = results[data['message_name']]
 
-    db.session.add(subscription)
-    db.session.commit()
+        if result == "OK":
+            return ok_response()
+        elif result == "EXISTS":
+            return exists_response()
+        else:
+            return jsonify({"error": result})
 
-    return ok_response()
+    return jsonify({'subscriptions': _subscribe(plugin, message_names, shard_key, shard_group)})
 
 
 @csrf.exempt
@@ -385,6 +747,8 @@ def unsubscribe():
     db.session.delete(subscription)
     db.session.commit()
 
+    router.invalidate()
+
     return ok_response()
 
 
@@ -433,35 +797,36 @@ def plugin_message_history():
 
     DO NOT USE THIS ROUTE TO GET YOUR MESSAGES -- ONLY TO VIEW THEIR HISTORY.
 
+    The history is returned a page at a time, oldest first.
+
+    Accepts: (query string)
+        after       - The 'next' value returned with the previous page. (optional)
+        limit       - Most messages to return, capped at HISTORY_PAGE_MAX. (optional)
+
     Returns: 
+        401         - after is not a valid cursor.
         403         - A connection with HPIT must be established first.
-        200:OK      - A JSON list of dicts of the messages for this plugin.
+        200:OK      - A JSON list of dicts of the messages for this plugin, and
+                      'next', the cursor for the following page or null at the end.
     """
     if 'entity_id' not in session:
         return auth_failed_response()
 
+    page = _history_page()
+    if page is None:
+        return bad_parameter_response('after')
+
     entity_id = session['entity_id']
+    after, limit = page
 
-    my_messages = mongo.db.sent_messages_and_transactions.find({
-        'receiver_entity_id': entity_id,
-        'message_name': {"$ne" : "transaction"}
-    })
-    
-    def is_auth(mname,eid):
-        message_auth = MessageAuth.query.filter_by(message_name=mname,entity_id=str(entity_id)).first()
-        if not message_auth:
-            return False
-        else:
-            return True
-    
-    my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
+    scanned = message_bus.sent_to(entity_id, exclude_message_name="transaction", after=after, limit=limit)
+    my_messages = _authorized_messages(entity_id, scanned)
 
-    result = [{
+    return respond_stream('message-history', ({
         'message_name': t['message_name'],
-        'message': _map_mongo_document(t['payload'])
-        } for t in my_messages]
-
-    return jsonify({'message-history': result})
+        'message': payload
+        } for t, payload in zip(my_messages, _message_payloads(my_messages))),
+        next=_next_cursor(scanned, limit))
 
     
 #@app.route("/plugin/transaction/history")
@@ -510,34 +875,37 @@ def plugin_message_preview():
 
     DO NOT USE THIS ROUTE TO GET YOUR MESSAGES -- ONLY TO PREVIEW THEM.
 
+    The queue is returned a page at a time, oldest first.
+
+    Accepts: (query string)
+        after       - The 'next' value returned with the previous page. (optional)
+        limit       - Most messages to return, capped at HISTORY_PAGE_MAX. (optional)
+
     Returns: 
+        401         - after is not a valid cursor.
         403         - A connection with HPIT must be established first.
-        200:OK      - A JSON list of dicts of the messages for this plugin.
+        200:OK      - A JSON list of dicts of the messages for this plugin, and
+                      'next', the cursor for the following page or null at the end.
     """
     if 'entity_id' not in session:
         return auth_failed_response()
 
+    page = _history_page()
+    if page is None:
+        return bad_parameter_response('after')
+
     entity_id = session['entity_id']
+    after, limit = page
 
-    my_messages = mongo.db.plugin_messages.find({
-        'receiver_entity_id': entity_id,
-    })
-    
-    def is_auth(mname,eid):
-        message_auth = MessageAuth.query.filter_by(message_name=mname,entity_id=str(entity_id)).first()
-        if not message_auth:
-            return False
-        else:
-            return True
-    
-    my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
+    scanned = message_bus.queued(entity_id, after=after, limit=limit)
+    my_messages = _authorized_messages(entity_id, scanned)
 
     result = [{
         'message_name': t['message_name'],
-        'message': _map_mongo_document(t['payload'])
-        } for t in my_messages]
+        'message': _map_mongo_document(payload)
+        } for t, payload in zip(my_messages, _message_payloads(my_messages))]
 
-    return jsonify({'message-preview': result})
+    return jsonify({'message-preview': result, 'next': _next_cursor(scanned, limit)})
 
 
 #@app.route("/plugin/transaction/preview")
@@ -583,6 +951,19 @@ def plugin_message_list():
     and they will not show again. If you wish to see a preview
     of the messages queued for a plugin use the /message-preview route instead.
 
+    Each message is handed to only one poller, so several processes can poll
+    as the same plugin. If a visibility timeout is given, messages are only
+    leased: they must be acked with /plugin/message/ack before it runs out or
+    they will be delivered again.
+
+    Accepts: Query String
+        - wait : number => (optional) Seconds to hold the request open waiting
+            for a message if none are queued (long-poll). Defaults to 0.
+        - max : number => (optional) Most messages to return. Defaults to and
+            is capped at MESSAGE_BATCH_MAX.
+        - visibility : number => (optional) Seconds before unacked messages
+            are redelivered. If omitted, messages are acked when returned.
+
     Returns: 
         403         - A connection with HPIT must be established first.
         200:OK      - A JSON list of dicts of the messages for this plugin.
@@ -591,6 +972,9 @@ def plugin_message_list():
         return auth_failed_response()
 
     entity_id = session['entity_id']
+    deadline = time.time() + _long_poll_timeout()
+    limit = _batch_max()
+    visibility = _visibility_timeout()
 
     #plugin = Plugin.query.filter_by(entity_id=entity_id).first()
 
@@ -601,11 +985,21 @@ def plugin_message_list():
     #db.session.add(plugin)
     #db.session.commit()
 
-    my_messages = mongo.db.plugin_messages.find({
-        'receiver_entity_id': entity_id,
-    })
+    #Polling counts as a heartbeat, shard groups drop plugins that stop.
+    entity = entities.get(entity_id)
+    if entity:
+        entities.touch(entity)
 
-    my_messages = list(my_messages)
+    while True:
+        generation = notifier.generation(entity_id)
+
+        my_messages = message_bus.claim(entity_id, limit, visibility)
+
+        remaining = deadline - time.time()
+        if my_messages or remaining <= 0:
+            break
+
+        notifier.wait(entity_id, generation, min(remaining, LONG_POLL_RECHECK))
 
    
     #def is_auth(mname,eid):
@@ -617,38 +1011,45 @@ def plugin_message_list():
     #
     #my_messages = [m for m in my_messages if is_auth(m["message_name"],entity_id)]
             
-    result = [
-        (t['_id'], t['message_id'], t['message_name'], t['sender_entity_id'],t['time_created'],_map_mongo_document(t['payload']))
-        for t in my_messages
-    ]
+    #time_created has always gone out in the HTTP date format jsonify() uses.
+    return respond_stream('messages', ({
+        'message_id': str(t['message_id']),
+        'message_name': t['message_name'],
+        'sender_entity_id': t['sender_entity_id'],
+        'time_created': http_date(t['time_created']),
+        'message': payload
+        } for t, payload in zip(my_messages, _message_payloads(my_messages))))
 
-    to_remove = [t[0] for t in result]
-    result = [{
-        'message_id': str(t[1]),
-        'message_name': t[2],
-        'sender_entity_id': t[3],
-        'time_created':t[4],
-        'message': t[5]} for t in result]
 
-    #Move sent messages to another collection.
-    if my_messages:
-        for t in my_messages:
-            t['time_received'] = datetime.now() 
+@csrf.exempt
+@app.route("/plugin/message/ack", methods=["POST"])
+def plugin_message_ack():
+    """
+    SUPPORTS: POST
+    Acknowledge messages leased with /plugin/message/list?visibility= so they
+    are not delivered again.
 
-        mongo.db.sent_messages_and_transactions.insert(my_messages)
+    Accepts: JSON
+        - message_ids : list => The message_ids of the messages that were handled
 
-        mongo.db.plugin_messages.remove({
-            '_id': {'$in': to_remove}
-        })
-        
-    #remove old messages
-    if random.choice(range(0,100)) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.plugin_messages.remove({
-            "time_created": {"$lt":yesterday}
-        })
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200:OK      - JSON with the number of messages acked.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    data = request_data()
 
-    return jsonify({'messages': result})
+    if 'message_ids' not in data or not isinstance(data['message_ids'], list):
+        return bad_parameter_response('message_ids')
+
+    entity_id = session['entity_id']
+    message_ids = [ObjectId(m) if ObjectId.is_valid(m) else m for m in data['message_ids']]
+
+    acked = message_bus.ack(entity_id, message_ids)
+
+    return respond(acked=acked)
 
 
 #@app.route("/plugin/transaction/list")
@@ -710,13 +1111,6 @@ def plugin_message_list():
             '_id': {'$in': to_remove}
         })
 
-    #remove old transactions
-    if random.choice([1,2,3,4,5]) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.plugin_transactions.remove({
-            "time_created": {"$lt":yesterday}
-        })
-
     return jsonify({'transactions': result})
     """
 
@@ -740,50 +1134,66 @@ def message():
     """
     if 'entity_id' not in session:
         return auth_failed_response()
+
+    data = request_data()
         
     for x in ['name', 'payload']:
-        if x not in request.json:
+        if x not in data:
             return bad_parameter_response(x)
 
-    sender_entity_id = session['entity_id']
-    message_name = request.json['name']
+    message_name = data['name']
     if message_name== "transaction":
         return bad_parameter_response("name")
         
-    payload = request.json['payload']
+    payload = data['payload']
     if not isinstance(payload,dict):
         return bad_parameter_response("payload")
 
-    message = {
-        'sender_entity_id': sender_entity_id,
-        'session_token':session["token"],
-        'time_created': datetime.now(),
-        'message_name': message_name,
-        'payload': payload,
-    }     
+    message_id = _queue_messages([(message_name, payload)])[0]
+    
+    return respond(message_id=str(message_id))
 
-    message_id = mongo.db.messages_and_transactions.insert(message)
+@csrf.exempt
+@app.route("/message/batch", methods=["POST"])
+def message_batch():
+    """
+    SUPPORTS: POST
+    Submit several messages to the HPIT server in one request. Each message is
+    handled as if it was sent to /message, in order.
 
-    subscriptions = Subscription.query.filter_by(message_name=message_name)
+    Accepts: JSON
+        - messages : list => Objects with the fields taken by /message:
+            - name : string => The name of the message to submit to the server
+            - payload : Object => A JSON Object of the DATA to store in the database
 
-    for subscription in subscriptions:
-        plugin_entity_id = subscription.plugin.entity_id
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200: JSON   
+            - message_ids - The IDs of the messages submitted, in the order given
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
 
-        
-        mongo.db.plugin_messages.insert({
-            'message_id': message_id,
+    data = request_data()
 
-            'sender_entity_id': sender_entity_id,
-            'session_token':session["token"],
-            'receiver_entity_id': plugin_entity_id,
+    entries = _batch_entries(data)
+    if entries is None:
+        return bad_parameter_response("messages")
 
-            'time_created': datetime.now(),
+    for entry in entries:
+        if not isinstance(entry, dict):
+            return bad_parameter_response("messages")
+        if 'name' not in entry or entry['name'] == "transaction":
+            return bad_parameter_response("name")
+        if not isinstance(entry.get('payload'), dict):
+            return bad_parameter_response("payload")
 
-            'message_name': message_name,
-            'payload': payload
-        })
-    
-    return jsonify(message_id=str(message_id))
+    if not entries:
+        return respond(message_ids=[])
+
+    message_ids = _queue_messages([(entry['name'], entry['payload']) for entry in entries])
+
+    return respond(message_ids=[str(message_id) for message_id in message_ids])
 
 @csrf.exempt
 @app.route("/transaction", methods=["POST"])
@@ -804,43 +1214,54 @@ def transaction():
     """
     if 'entity_id' not in session:
         return auth_failed_response()
+
+    data = request_data()
         
-    if "payload" not in request.json:
+    if "payload" not in data:
         return bad_parameter_response("payload")
 
-    sender_entity_id = session['entity_id']
-    message_name = "transaction"
-        
-    payload = request.json['payload']
+    payload = data['payload']
 
-    message = {
-        'sender_entity_id': sender_entity_id,
-        'session_token':session["token"],
-        'time_created': datetime.now(),
-        'message_name': message_name,
-        'payload': payload,
-    }     
+    message_id = _queue_messages([("transaction", payload)])[0] #used to be plugin_transactions
+
+    return respond(message_id=str(message_id))
+
+@csrf.exempt
+@app.route("/transaction/batch", methods=["POST"])
+def transaction_batch():
+    """
+    SUPPORTS: POST
+    Submit several transactions to the HPIT server in one request. Each one is
+    handled as if it was sent to /transaction, in order.
+
+    Accepts: JSON
+        - messages : list => Objects with the field taken by /transaction:
+            - payload : Object => A JSON Object of the DATA to store in the database
 
-    message_id = mongo.db.messages_and_transactions.insert(message)
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200: JSON   
+            - message_ids - The IDs of the transactions submitted, in the order given
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
 
-    subscriptions = Subscription.query.filter_by(message_name=message_name)
+    data = request_data()
 
-    for subscription in subscriptions:
-        plugin_entity_id = subscription.plugin.entity_id
+    entries = _batch_entries(data)
+    if entries is None:
+        return bad_parameter_response("messages")
 
-        mongo.db.plugin_messages.insert({ #used to be plugin_transactions
-            'message_id': message_id,
-            'sender_entity_id': sender_entity_id,
-            'session_token':session["token"],
-            'receiver_entity_id': plugin_entity_id,
+    for entry in entries:
+        if not isinstance(entry, dict) or 'payload' not in entry:
+            return bad_parameter_response("payload")
 
-            'time_created': datetime.now(),
+    if not entries:
+        return respond(message_ids=[])
 
-            'message_name': message_name,
-            'payload': payload
-        })
+    message_ids = _queue_messages([("transaction", entry['payload']) for entry in entries])
 
-    return jsonify(message_id=str(message_id))
+    return respond(message_ids=[str(message_id) for message_id in message_ids])
 
 @csrf.exempt
 @app.route("/response", methods=["POST"])
@@ -862,38 +1283,63 @@ def response():
     """
     if 'entity_id' not in session:
         return auth_failed_response()
+
+    data = request_data()
         
     for x in ['message_id', 'payload']:
-        if x not in request.json:
+        if x not in data:
             return bad_parameter_response(x)
 
-    responder_entity_id = session['entity_id']
-    message_id = request.json['message_id']
-    payload = request.json['payload']
+    message_id = data['message_id']
+    payload = data['payload']
 
-    plugin_message = mongo.db.sent_messages_and_transactions.find_one({
-        'message_id': ObjectId(message_id),
-        'receiver_entity_id': responder_entity_id,
-    })
+    response_id = _queue_responses([(message_id, payload)])[0]
 
-    if not plugin_message:
+    if not response_id:
         return not_found_response()
 
-    mongo.db.sent_messages_and_transactions.update(
-        {'_id': plugin_message['_id']},
-        {"$set": {'time_responded': datetime.now()}}
-    )
+    return respond(response_id=str(response_id))
 
-    response_id = mongo.db.responses.insert({
-        'message_id': plugin_message['message_id'],
-        'session_token':plugin_message["session_token"],
-        'sender_entity_id': responder_entity_id,
-        'receiver_entity_id': plugin_message['sender_entity_id'],
-        'message': plugin_message,
-        'response': payload
-    })
 
-    return jsonify(response_id=str(response_id))
+@csrf.exempt
+@app.route("/response/batch", methods=["POST"])
+def response_batch():
+    """
+    SUPPORTS: POST
+    Submits several responses to earlier messages in one request. Each response
+    is handled as if it was sent to /response.
+
+    Accepts: JSON
+        - responses : list => Objects with the fields taken by /response:
+            - message_id : string => The message id to the message you're responding to.
+            - payload : Object => A JSON Object of the DATA to respond with
+
+    Returns:
+        403         - A connection with HPIT must be established first.
+        200: JSON   
+            - response_ids - The IDs of the responses submitted, in the order given.
+                null where no message with that message_id was sent to you.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
+
+    data = request_data()
+
+    entries = data.get('responses')
+    if not isinstance(entries, list) or len(entries) > MESSAGE_SUBMIT_BATCH_MAX:
+        return bad_parameter_response("responses")
+
+    for entry in entries:
+        for x in ['message_id', 'payload']:
+            if not isinstance(entry, dict) or x not in entry:
+                return bad_parameter_response(x)
+
+    if not entries:
+        return respond(response_ids=[])
+
+    response_ids = _queue_responses([(entry['message_id'], entry['payload']) for entry in entries])
+
+    return respond(response_ids=[str(r) if r else None for r in response_ids])
 
 
 @app.route("/response/list", methods=["GET"])
@@ -902,6 +1348,13 @@ def responses():
     SUPPORTS: GET
     Poll for responses queued to original sender of a message.
 
+    Each response carries the message_id, message_name, sender_entity_id and
+    receiver_entity_id of the message it answers, not the whole message.
+
+    Accepts: Query String
+        - full_message : 1 => (optional) Include the whole original message,
+            payload included, with each response, as older clients expect.
+
     Returns: 
         403         - A connection with HPIT must be established first.
         200:OK      - A JSON list of dicts of the responses for this plugin.
@@ -910,6 +1363,7 @@ def responses():
         return auth_failed_response()
 
     entity_id = session['entity_id']
+    full_message = request.args.get('full_message') == '1'
 
     #entity = Plugin.query.filter_by(entity_id=entity_id).first()
 
@@ -923,10 +1377,7 @@ def responses():
     #db.session.add(entity)
     #db.session.commit()
 
-    my_responses = mongo.db.responses.find({
-        'receiver_entity_id': entity_id,
-        'session_token':session["token"],
-    })
+    my_responses = message_bus.take_responses(entity_id, session["token"])
     
     #def is_auth(r):
     #    if "resource_id" in r["response"]:
@@ -940,36 +1391,67 @@ def responses():
             
     #my_responses = [r for r in my_responses if is_auth(r)]
 
-    my_responses = list(my_responses)
+    return respond_stream('responses', _response_results(my_responses, full_message))
 
-    result = [
-        (t['_id'], _map_mongo_document(t['message']), _map_mongo_document(t['response']))
-        for t in my_responses
-    ]
 
-    to_remove = [t[0] for t in result]
-    result = [{
-        'message': t[1],
-        'response': t[2]} for t in result]
+@app.route("/response/stream", methods=["GET"])
+def response_stream():
+    """
+    SUPPORTS: GET
+    Push responses queued to the original sender of a message as they arrive,
+    as a server-sent events (text/event-stream) stream. Each response is sent
+    as a 'response' event whose data is the JSON the /response/list route
+    returns for a single response. Responses pushed here are marked received
+    just like polled ones, so use either this route or /response/list.
+
+    The stream closes after RESPONSE_STREAM_MAX seconds, clients should reconnect
+    (EventSource does so on its own). Until then it holds a server worker (a
+    uWSGI worker or thread), so size the workers for the open streams on top of
+    the polling traffic. Responses whose event could not be written because the
+    client went away are queued again for the next stream or poll.
+
+    Accepts: Query String
+        - full_message : 1 => (optional) Include the whole original message,
+            as with /response/list.
 
-    #Move sent responses to another collection.
-    if my_responses:
-        for t in my_responses:
-            t['time_response_received'] = datetime.now()
-        mongo.db.sent_responses.insert(my_responses)
+    Returns: 
+        403         - A connection with HPIT must be established first.
+        200:OK      - A text/event-stream of responses for this session.
+    """
+    if 'entity_id' not in session:
+        return auth_failed_response()
 
-        mongo.db.responses.remove({
-            '_id': {'$in': to_remove}
-        })
-        
-    #remove old responses
-    if random.choice(range(0,100)) == 1:
-        yesterday = datetime.now() - timedelta(days=1)
-        mongo.db.responses.remove({
-            "message.time_received": {"$lt":yesterday}
-        })
+    entity_id = session['entity_id']
+    session_token = session['token']
+    full_message = request.args.get('full_message') == '1'
+    key = _response_key(entity_id, session_token)
+
+    def events():
+        deadline = time.time() + RESPONSE_STREAM_MAX
+
+        while True:
+            generation = notifier.generation(key)
+
+            taken = message_bus.take_responses(entity_id, session_token)
+
+            for i, result in enumerate(_response_results(taken, full_message)):
+                try:
+                    yield "event: response\ndata: " + to_json(result) + "\n\n"
+                except GeneratorExit:
+                    #Closed before this event went out, give it and the rest back.
+                    message_bus.return_responses(taken[i:])
+                    raise
 
-    return jsonify({'responses': result})
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            #Responses stored by another server process are picked up on the next keep-alive.
+            if not notifier.wait(key, generation, min(remaining, RESPONSE_STREAM_KEEPALIVE)):
+                yield ": keep-alive\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
  
 """
 @csrf.exempt
@@ -1012,11 +1494,11 @@ def message_owner(message_name):
 
     entity_id = session['entity_id']
 
-    message_auth = MessageAuth.query.filter_by(message_name=message_name,is_owner=True).first()
-    if not message_auth:
+    owner = authorization.message_owner(message_name)
+    if owner is None:
         return not_found_response()
     else:
-        return  jsonify({"owner":message_auth.entity_id})
+        return  jsonify({"owner":owner})
 
 
 @csrf.exempt
@@ -1040,20 +1522,10 @@ def share_message():
     elif not isinstance(other_entity_ids,list):
         return bad_parameter_response("other_entity_ids")
     
-    message_auth = MessageAuth.query.filter_by(message_name=message_name,entity_id=str(entity_id),is_owner=True).first()
-    if not message_auth:
+    if not authorization.is_message_owner(message_name, entity_id):
         return jsonify({"error":"not owner"})
     else:
-        for eid in other_entity_ids:
-            existing_message_auth = MessageAuth.query.filter_by(message_name=message_name, entity_id=str(eid)).first()
-            if not existing_message_auth:
-                new_message_auth = MessageAuth()
-                new_message_auth.entity_id = str(eid)
-                new_message_auth.message_name = message_name
-                new_message_auth.is_owner = False
-                db.session.add(new_message_auth)
-                db.session.commit()
-                
+        authorization.grant_message(message_name, other_entity_ids)
         return ok_response()
 
 
@@ -1070,13 +1542,7 @@ def new_resource():
     
     new_id =  str(uuid.uuid4())
     
-    new_resource_auth = ResourceAuth()
-    new_resource_auth.entity_id = owner_id
-    new_resource_auth.is_owner = True
-    new_resource_auth.resource_id = new_id
-    
-    db.session.add(new_resource_auth)
-    db.session.commit()
+    authorization.add_resource(new_id, owner_id)
     
     return jsonify({"resource_id":new_id})
        
@@ -1102,21 +1568,10 @@ def share_resource():
     elif not isinstance(other_entity_ids,list):
         return bad_parameter_response("other_entity_ids")
     
-    resource_auth = ResourceAuth().query.filter_by(entity_id=entity_id,is_owner=True,resource_id=resource_id).first()
-    
-    if not resource_auth:
+    if not authorization.is_resource_owner(resource_id, entity_id):
         return jsonify({"error":"not owner"})
     else:
-        for eid in other_entity_ids:
-            existing_resource_auth = ResourceAuth().query.filter_by(entity_id=eid,resource_id=resource_id).first()
-            if not existing_resource_auth:
-                new_resource_auth = ResourceAuth()
-                new_resource_auth.entity_id = eid
-                new_resource_auth.resource_id = resource_id
-                new_resource_auth.is_owner = False
-                db.session.add(new_resource_auth)
-                db.session.commit()
-    
+        authorization.grant_resource(resource_id, other_entity_ids)
         return ok_response()
 
 @csrf.exempt
@@ -1126,6 +1581,9 @@ def ping():
     SUPPORTS: POST
     Tell the server a plugin is still connected.
 
+    The heartbeat is buffered and written to the database every
+    HEARTBEAT_FLUSH_INTERVAL seconds.
+
     Returns: 
         403         - A connection with HPIT must be established first.
         200:OK      - All is well
@@ -1136,16 +1594,11 @@ def ping():
 
     entity_id = session['entity_id']
     
-    entity = Plugin.query.filter_by(entity_id=entity_id).first()
-    
-    if not entity:
-        entity = Tutor.query.filter_by(entity_id=entity_id).first()
+    entity = entities.get(entity_id)
 
     if not entity:
         return not_found_response()
 
-    entity.time_last_polled = datetime.now()
-    db.session.add(entity)
-    db.session.commit()
+    entities.touch(entity)
     
     return ok_response()
@@ -331,6 +331,8 @@ def plugin_edit(plugin_id):
             db.session.add(plugin)
             db.session.commit()
 
+            app_instance.entities.invalidate()
+
             return redirect(url_for('plugins'))
 
     return render_template('plugin_edit.html', form=plugin_form, isadmin=current_user.administrator)
@@ -353,6 +355,9 @@ def plugin_genkey(plugin_id):
 
     db.session.add(plugin)
     db.session.commit()
+
+    app_instance.entities.invalidate()
+    app_instance.sessions.revoke_entity(plugin.entity_id)
     
     connected_dict = {plugin.entity_id:False}
 
@@ -375,6 +380,10 @@ def plugin_delete(plugin_id):
     db.session.delete(plugin)
     db.session.commit()
 
+    app_instance.router.invalidate()
+    app_instance.entities.invalidate()
+    app_instance.sessions.revoke_entity(plugin.entity_id)
+
     return redirect(url_for('plugins'))
 
 
@@ -497,6 +506,8 @@ def tutor_edit(tutor_id):
             db.session.add(tutor)
             db.session.commit()
 
+            app_instance.entities.invalidate()
+
             return redirect(url_for('tutors'))
 
     return render_template('tutor_edit.html', form=tutor_form)
@@ -519,6 +530,9 @@ def tutor_genkey(tutor_id):
 
     db.session.add(tutor)
     db.session.commit()
+
+    app_instance.entities.invalidate()
+    app_instance.sessions.revoke_entity(tutor.entity_id)
     
     connected_dict = {tutor.entity_id:False}
 
@@ -540,6 +554,9 @@ def tutor_delete(tutor_id):
     db.session.delete(tutor)
     db.session.commit()
 
+    app_instance.entities.invalidate()
+    app_instance.sessions.revoke_entity(tutor.entity_id)
+
     return redirect(url_for('tutors'))
 
 
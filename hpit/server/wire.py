@@ -0,0 +1,94 @@
+import json
+from datetime import datetime
+from bson import BSON
+from bson.errors import InvalidBSON
+from bson.objectid import ObjectId
+from flask import request, jsonify, Response, stream_with_context
+
+BSON_MIMETYPE = 'application/bson'
+
+def request_data():
+    """
+    Return the body of the current request as a dict.
+
+    Bodies sent as application/bson are decoded with bson, anything else is read
+    as JSON. A body that is missing or can't be decoded gives an empty dict, so
+    routes report the missing parameters.
+    """
+    if request.mimetype == BSON_MIMETYPE:
+        try:
+            return BSON(request.get_data()).decode()
+        except (InvalidBSON, TypeError, ValueError):
+            return {}
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return {}
+
+    return data
+
+def wants_bson():
+    return request.accept_mimetypes.best_match(['application/json', BSON_MIMETYPE]) == BSON_MIMETYPE
+
+def respond(*args, **kwargs):
+    """
+    Like jsonify(), but answers with BSON if the client accepts application/bson
+    ahead of application/json.
+    """
+    if not wants_bson():
+        return jsonify(*args, **kwargs)
+
+    return Response(BSON.encode(dict(*args, **kwargs)), mimetype=BSON_MIMETYPE)
+
+class MongoJSONEncoder(json.JSONEncoder):
+    """
+    JSON encoder for documents straight out of MongoDB. ObjectIds become their hex
+    string and datetimes their ISO 8601 form, at any depth.
+    """
+
+    def default(self, o):
+        if isinstance(o, ObjectId):
+            return str(o)
+        if isinstance(o, datetime):
+            return o.isoformat()
+
+        return json.JSONEncoder.default(self, o)
+
+_encoder = MongoJSONEncoder(separators=(',', ':'))
+
+def respond_stream(name, items, **extra):
+    """
+    Answer with {name: [items...]}, encoding each item as it is written to the
+    response instead of building the whole list and document first. Any extra
+    keyword arguments are added to the document after the list.
+
+    items can be any iterable, such as a generator over a cursor. Clients that
+    ask for BSON get a BSON document, which can't be streamed.
+    """
+    if wants_bson():
+        document = dict(extra)
+        document[name] = list(items)
+        return Response(BSON.encode(document), mimetype=BSON_MIMETYPE)
+
+    def chunks():
+        yield '{' + json.dumps(name) + ':['
+
+        separator = ''
+        for item in items:
+            yield separator + _encoder.encode(item)
+            separator = ','
+
+        yield ']'
+
+        for key, value in extra.items():
+            yield ',' + json.dumps(key) + ':' + _encoder.encode(value)
+
+        yield '}'
+
+    return Response(stream_with_context(chunks()), mimetype='application/json')
+
+def to_json(document):
+    """
+    Encode a document with MongoJSONEncoder.
+    """
+    return _encoder.encode(document)
@@ -0,0 +1,519 @@
+import asyncio
+import inspect
+import json
+import signal
+from urllib.parse import urljoin
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from hpitclient.exceptions import PluginPollError, BadCallbackException, InvalidMessageNameException
+from hpitclient.exceptions import AuthenticationError, ResourceNotFoundError, InternalServerError
+
+JSON_HTTP_HEADERS = {'content-type': 'application/json'}
+
+#The most messages or responses sent in one batch request. HPIT accepts up to MESSAGE_SUBMIT_BATCH_MAX.
+SEND_BATCH_MAX = 1000
+
+#Seconds to wait before reopening the response stream after a connection failure.
+STREAM_RECONNECT_WAIT = 5
+
+class AsyncPlugin:
+    """
+    An HPIT plugin that runs on an asyncio event loop, for plugins that spend
+    their time waiting on HPIT or a database. It has the same interface as
+    hpitclient's Plugin, so existing plugins are ported by changing their base
+    class, with these differences:
+
+        - subscribe(), unsubscribe(), register_transaction_callback(), send(),
+          send_transaction(), send_response() and send_log_entry() don't block.
+          They return a future that coroutines may await for the result and
+          plain callbacks may ignore.
+        - Callbacks, message or response, may be coroutine functions. Each runs
+          in its own task, so one waiting on the database doesn't hold up the
+          others. Plain callbacks run on the event loop and must not block.
+        - _get_data() and _post_data() are coroutines returning the decoded
+          JSON. MongoDB is reached through hpit.utils.mongo.shared_motor_client().
+
+    Sends and responses are posted to HPIT in batches, and responses are pushed
+    to the plugin over /response/stream, so hundreds of sends can be waiting on
+    their responses at once without any threads. At most max_callbacks message
+    callbacks run at once; the plugin stops polling while it is at the limit.
+
+    Run the plugin with run(), or await start() on a running loop. A failing
+    callback stops the plugin and is raised from start(), as it is from
+    Plugin.start().
+    """
+
+    def __init__(self, entity_id, api_key, wildcard_callback=None):
+        self.entity_id = str(entity_id)
+        self.api_key = str(api_key)
+        self.wildcard_callback = wildcard_callback
+        self.transaction_callback = None
+        self.callbacks = {}
+        self.response_callbacks = {}
+
+        self.run_loop = True
+        self.connected = False
+        self.session = None
+        self.error = None
+
+        #Seconds HPIT holds each poll for messages open while none are queued.
+        self.poll_wait = 10
+        self.max_callbacks = 1000
+        self.max_connections = 20
+
+        self.tasks = set()
+        self.callback_tasks = set()
+        self.outgoing = {}
+        self.sends_in_flight = 0
+        self.unmatched_responses = {}
+        self.stopped = None
+
+        self.set_hpit_root_url('https://www.hpit-project.org')
+
+        self._add_hooks(
+            'pre_connect', 'post_connect', 'pre_disconnect', 'post_disconnect',
+            'pre_poll_messages', 'post_poll_messages',
+            'pre_dispatch_messages', 'post_dispatch_messages')
+
+    def set_hpit_root_url(self, root_url):
+        self._hpit_root_url = root_url
+
+    def _add_hooks(self, *hooks):
+        for hook in hooks:
+            if not hasattr(self, hook):
+                setattr(self, hook, None)
+
+    async def _try_hook(self, hook_name):
+        """
+        Call a hook, awaiting it if it is a coroutine function. As with Plugin,
+        a false result stops the plugin.
+        """
+        hook = getattr(self, hook_name, None)
+        if not hook:
+            return True
+
+        result = hook()
+        if inspect.isawaitable(result):
+            result = await result
+
+        return result
+
+    def _check_status(self, response):
+        if response.status == 403:
+            raise AuthenticationError("Request could not be authenticated")
+        elif response.status == 404:
+            raise ResourceNotFoundError("Requested resource not found")
+        elif response.status == 500:
+            raise InternalServerError("Internal server error")
+
+    async def _request(self, method, url, data=None, params=None):
+        url = urljoin(self._hpit_root_url, url)
+
+        failure_count = 0
+        while True:
+            try:
+                if data is not None:
+                    request = self.session.request(method, url, data=json.dumps(data), headers=JSON_HTTP_HEADERS, params=params)
+                else:
+                    request = self.session.request(method, url, params=params)
+
+                async with request as response:
+                    self._check_status(response)
+                    return await response.json()
+
+            except aiohttp.ClientConnectionError:
+                failure_count += 1
+                if failure_count == 3:
+                    raise
+
+    async def _post_data(self, url, data=None):
+        return await self._request('POST', url, data)
+
+    async def _get_data(self, url, params=None):
+        return await self._request('GET', url, params=params)
+
+    async def connect(self):
+        """
+        Open the HTTP session and register a connection with the HPIT server.
+        """
+        if aiohttp is None:
+            raise ImportError("The asyncio plugin runtime needs aiohttp: pip install aiohttp")
+
+        if self.session is None:
+            #HPIT knows the plugin by its session cookie, keep it even if HPIT is reached by IP address.
+            self.session = aiohttp.ClientSession(
+                cookie_jar=aiohttp.CookieJar(unsafe=True),
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300))
+
+        await self._try_hook('pre_connect')
+        await self._post_data('connect', {
+            'entity_id': self.entity_id,
+            'api_key': self.api_key
+        })
+
+        self.connected = True
+        await self._try_hook('post_connect')
+
+        return self.connected
+
+    async def disconnect(self):
+        await self._try_hook('pre_disconnect')
+
+        await self._post_data('disconnect', {
+            'entity_id': self.entity_id,
+            'api_key': self.api_key
+        })
+
+        self.connected = False
+        await self._try_hook('post_disconnect')
+
+        await self.session.close()
+        self.session = None
+
+        return self.connected
+
+    def _spawn(self, awaitable, group=None):
+        task = asyncio.ensure_future(awaitable)
+        self.tasks.add(task)
+        if group is not None:
+            group.add(task)
+
+        def done(task):
+            self.tasks.discard(task)
+            if group is not None:
+                group.discard(task)
+
+            if not task.cancelled() and task.exception() is not None:
+                self._fail(task.exception())
+
+        task.add_done_callback(done)
+        return task
+
+    def _fail(self, error):
+        if self.error is None:
+            self.error = error
+
+        self.stop()
+
+    def _run_callback(self, callback, payload, group=None):
+        try:
+            result = callback(payload)
+        except Exception as e:
+            self._fail(e)
+            return
+
+        if inspect.isawaitable(result):
+            self._spawn(result, group)
+
+    def send_log_entry(self, text):
+        """
+        Send a log entry to the HPIT server.
+        """
+        logger = getattr(self, 'logger', None)
+        if logger:
+            logger.debug(text)
+
+        return self._spawn(self._post_data('log', {'log_entry': text}))
+
+    def subscribe(self, messages, shard_key=None, shard_group=None):
+        """
+        Subscribe to messages, given as a dict of message name to callback, in
+        one request to HPIT. With a shard_group, the messages are split between
+        the plugins of the group by the payload's shard_key.
+        """
+        for message_name, callback in messages.items():
+            self.callbacks[message_name] = callback
+
+        data = {'message_names': list(messages)}
+        if shard_group:
+            data['shard_key'] = shard_key
+            data['shard_group'] = shard_group
+
+        return self._spawn(self._post_data('plugin/subscribe', data))
+
+    def unsubscribe(self, *message_names):
+        message_names = [m for m in message_names if m in self.callbacks]
+
+        for message_name in message_names:
+            del self.callbacks[message_name]
+
+        return self._spawn(asyncio.gather(*[
+            self._post_data('plugin/unsubscribe', {'message_name': message_name})
+            for message_name in message_names]))
+
+    def register_transaction_callback(self, callback):
+        """
+        Set a callback for transactions and start listening for them.
+        """
+        if not hasattr(callback, "__call__"):
+            raise BadCallbackException("The callback submitted is not callable.")
+
+        self.transaction_callback = callback
+        return self._spawn(self._post_data('plugin/subscribe', {'message_name': "transaction"}))
+
+    async def list_subscriptions(self):
+        subscriptions = (await self._get_data('plugin/subscription/list'))['subscriptions']
+
+        for sub in subscriptions:
+            if sub not in self.callbacks:
+                self.callbacks[sub] = None
+
+        return self.callbacks
+
+    async def secure_resource(self, owner_id):
+        response = await self._post_data('new-resource', {'owner_id': owner_id})
+        return response.get('resource_id', False)
+
+    def _queue(self, route, entry, callback=None):
+        """
+        Queue entry to be posted to route with the next batch. The returned
+        future gets the id HPIT gives it.
+        """
+        future = asyncio.Future()
+
+        if route not in self.outgoing:
+            self.outgoing[route] = []
+            self._spawn(self._flush(route))
+
+        self.outgoing[route].append((entry, callback, future))
+        self.sends_in_flight += 1
+
+        return future
+
+    async def _flush(self, route):
+        """
+        Post the entries queued for route, in batches, until none are left. Entries
+        queued while a batch is in flight go out with the next one.
+        """
+        field, result_field = {
+            'message/batch': ('messages', 'message_ids'),
+            'transaction/batch': ('messages', 'message_ids'),
+            'response/batch': ('responses', 'response_ids'),
+        }[route]
+
+        queue = self.outgoing[route]
+        try:
+            while queue:
+                batch = queue[:SEND_BATCH_MAX]
+                del queue[:SEND_BATCH_MAX]
+
+                try:
+                    result = await self._post_data(route, {field: [entry for entry, callback, future in batch]})
+                except Exception as e:
+                    for entry, callback, future in batch:
+                        future.set_exception(e)
+                    raise
+                finally:
+                    self.sends_in_flight -= len(batch)
+
+                for (entry, callback, future), result_id in zip(batch, result[result_field]):
+                    if callback:
+                        self._add_response_callback(result_id, callback)
+                    future.set_result(result_id)
+
+                if not self.sends_in_flight:
+                    self._drop_unmatched_responses()
+        finally:
+            del self.outgoing[route]
+
+    def send(self, message_name, payload, callback=None):
+        """
+        Send a message to HPIT. callback, if given, is called with the response
+        of each plugin that handles it. Returns a future of the message_id.
+        """
+        if message_name == "transaction":
+            raise InvalidMessageNameException("Cannot use message_name 'transaction'.  Use send_transaction() method for datashop transactions.")
+
+        return self._queue('message/batch', {'name': message_name, 'payload': payload}, callback)
+
+    def send_transaction(self, payload, callback=None):
+        return self._queue('transaction/batch', {'payload': payload}, callback)
+
+    def send_response(self, message_id, payload):
+        """
+        Send a response to a message handled by this plugin. Returns a future of
+        the response_id.
+        """
+        return self._queue('response/batch', {'message_id': message_id, 'payload': payload})
+
+    def _add_response_callback(self, message_id, callback):
+        self.response_callbacks[message_id] = callback
+
+        #Responses that beat the message_id back from HPIT.
+        for payload in self.unmatched_responses.pop(message_id, []):
+            self._run_callback(callback, payload)
+
+    def _drop_unmatched_responses(self):
+        for message_id in self.unmatched_responses:
+            self.send_log_entry('No callback registered for message id: ' + message_id)
+
+        self.unmatched_responses = {}
+
+    def _dispatch_response(self, res):
+        try:
+            message_id = res['message']['message_id']
+            payload = res['response']
+        except KeyError:
+            self.send_log_entry('Invalid response from HPIT. No message id or response payload supplied.')
+            return
+
+        if message_id in self.response_callbacks:
+            self._run_callback(self.response_callbacks[message_id], payload)
+        elif self.sends_in_flight:
+            #Its send may not have got its message_id back yet.
+            self.unmatched_responses.setdefault(message_id, []).append(payload)
+        else:
+            self.send_log_entry('No callback registered for message id: ' + message_id)
+
+    def _callback(self, message_name):
+        if message_name == "transaction" and self.transaction_callback:
+            return self.transaction_callback
+
+        if message_name in self.callbacks:
+            if self.callbacks[message_name] is None:
+                raise PluginPollError("No callback registered for message: <" + message_name + ">")
+
+            return self.callbacks[message_name]
+
+        return self.wildcard_callback
+
+    async def _dispatch(self, message_data):
+        """
+        Start the callback of each message received.
+        """
+        if not await self._try_hook('pre_dispatch_messages'):
+            return False
+
+        for message_item in message_data:
+            message_name = message_item['message_name']
+            payload = message_item['message']
+
+            #Inject the message_id into the payload
+            payload['message_id'] = message_item['message_id']
+            payload['sender_entity_id'] = message_item['sender_entity_id']
+
+            callback = self._callback(message_name)
+            if callback is not None:
+                self._run_callback(callback, payload, self.callback_tasks)
+
+        if not await self._try_hook('post_dispatch_messages'):
+            return False
+
+        return True
+
+    async def _poll_messages(self):
+        while self.run_loop:
+            if len(self.callback_tasks) >= self.max_callbacks:
+                await asyncio.wait(list(self.callback_tasks), return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            if not await self._try_hook('pre_poll_messages'):
+                break
+
+            messages = (await self._get_data('plugin/message/list', {
+                'wait': str(self.poll_wait),
+                'max': str(self.max_callbacks - len(self.callback_tasks))
+            }))['messages']
+
+            if not await self._try_hook('post_poll_messages'):
+                break
+
+            if not await self._dispatch(messages):
+                break
+
+        self.stop()
+
+    def _parse_events(self, buffer):
+        """
+        Split the complete server-sent events off buffer, returning the
+        (event, data) pairs and the rest of buffer.
+        """
+        events = []
+        while b'\n\n' in buffer:
+            block, buffer = buffer.split(b'\n\n', 1)
+
+            event = None
+            data = []
+            for line in block.decode('utf-8').split('\n'):
+                if line.startswith('event:'):
+                    event = line[6:].strip()
+                elif line.startswith('data:'):
+                    data.append(line[5:].strip())
+
+            if event and data:
+                events.append((event, '\n'.join(data)))
+
+        return events, buffer
+
+    async def _stream_responses(self):
+        """
+        Dispatch responses as HPIT pushes them. HPIT closes the stream every
+        RESPONSE_STREAM_MAX seconds, so it is reopened until the plugin stops.
+        """
+        url = urljoin(self._hpit_root_url, 'response/stream')
+
+        while self.run_loop:
+            try:
+                async with self.session.get(url) as response:
+                    self._check_status(response)
+
+                    buffer = b''
+                    async for chunk in response.content.iter_any():
+                        events, buffer = self._parse_events(buffer + chunk)
+
+                        for event, data in events:
+                            if event == 'response':
+                                self._dispatch_response(json.loads(data))
+
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(STREAM_RECONNECT_WAIT)
+
+    async def start(self):
+        """
+        Connect to HPIT, then handle messages and responses until the plugin is
+        stopped.
+        """
+        self.stopped = asyncio.Event()
+        self.run_loop = True
+
+        await self.connect()
+        await self.list_subscriptions()
+
+        pollers = [self._spawn(self._poll_messages()), self._spawn(self._stream_responses())]
+
+        try:
+            await self.stopped.wait()
+        finally:
+            for poller in pollers:
+                poller.cancel()
+            await asyncio.gather(*pollers, return_exceptions=True)
+
+            #Let running callbacks finish and their sends go out.
+            while self.tasks:
+                await asyncio.gather(*list(self.tasks), return_exceptions=True)
+
+            await self.disconnect()
+
+        if self.error is not None:
+            raise self.error
+
+    def stop(self, signum=None, frame=None):
+        self.run_loop = False
+
+        if self.stopped is not None:
+            self.stopped.set()
+
+    def run(self):
+        """
+        Run the plugin on the event loop until it stops or gets SIGTERM.
+        """
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(signal.SIGTERM, self.stop)
+        loop.add_signal_handler(signal.SIGINT, self.stop)
+
+        loop.run_until_complete(self.start())
@@ -0,0 +1,92 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from hpitclient.exceptions import PluginPollError
+
+class ConcurrentDispatcher:
+    """
+    Runs a plugin's message callbacks on a pool of worker threads instead of one
+    after another, for plugins whose callbacks spend their time waiting on I/O.
+
+    Messages are spread over the workers by a key. Messages with the same key go
+    to the same worker, so they are handled one at a time in the order they were
+    polled. order_by names the payload field used as the key, either one field
+    for every message or a dict of message_name -> field. Messages without one
+    are keyed by their message_id, so they spread over all the workers.
+
+    dispatch() waits for the whole poll to be handled before returning, so a
+    plugin never has more than one poll of messages in hand.
+
+    Install it with install(plugin), which replaces the plugin's _dispatch().
+    """
+
+    def __init__(self, plugin, workers, order_by=None):
+        self.plugin = plugin
+        self.order_by = order_by
+
+        #One single threaded executor per worker keeps each key's messages in order.
+        self.workers = [ThreadPoolExecutor(1) for i in range(max(1, workers))]
+
+    @classmethod
+    def install(cls, plugin, workers, order_by=None):
+        dispatcher = cls(plugin, workers, order_by)
+        plugin._dispatch = dispatcher.dispatch
+        return dispatcher
+
+    def key(self, message_name, payload):
+        field = self.order_by
+        if isinstance(field, dict):
+            field = field.get(message_name)
+
+        if field and field in payload:
+            return str(payload[field])
+
+        return str(payload['message_id'])
+
+    def callback(self, message_name):
+        """
+        Return the callback for message_name, the wildcard callback, or None.
+        """
+        plugin = self.plugin
+
+        if message_name in plugin.callbacks:
+            if plugin.callbacks[message_name] is None:
+                raise PluginPollError("No callback registered for message: <" + message_name + ">")
+
+            return plugin.callbacks[message_name]
+
+        return plugin.wildcard_callback
+
+    def dispatch(self, message_data):
+        plugin = self.plugin
+
+        if not plugin._try_hook('pre_dispatch_messages'):
+            return False
+
+        futures = []
+        for message_item in message_data:
+            message_name = message_item['message_name']
+            payload = message_item['message']
+
+            #Inject the message_id into the payload
+            payload['message_id'] = message_item['message_id']
+            payload['sender_entity_id'] = message_item['sender_entity_id']
+
+            callback = self.callback(message_name)
+            if callback is None:
+                continue
+
+            worker = self.workers[hash(self.key(message_name, payload)) % len(self.workers)]
+            futures.append(worker.submit(callback, payload))
+
+        #Re-raise the first callback failure, as sequential dispatch would.
+        for future in futures:
+            future.result()
+
+        if not plugin._try_hook('post_dispatch_messages'):
+            return False
+
+        return True
+
+    def shutdown(self):
+        for worker in self.workers:
+            worker.shutdown()
@@ -0,0 +1,97 @@
+"""
+Shared handling of get_student_model_fragment, answered by the knowledge
+tracing, problem management and hint factory plugins.
+
+Besides student_id, the message may carry, keyed by fragment name:
+    - fields        - the fields wanted in each row of that fragment
+    - changed_since - the version of an earlier reply of that fragment, to get
+                      only the rows written since
+Each reply carries the version to ask changed_since of next time, and the key
+field that identifies its rows, so rows changed since can be merged into the
+rows already held (see StudentManagementPlugin).
+"""
+from datetime import datetime, timedelta
+
+from bson.objectid import ObjectId
+import bson
+
+#Rows are stamped with an ObjectId from the clock of the process that wrote
+#them. A version starts this many seconds before the read, so a write racing
+#the read, or stamped by a slightly slow clock, is sent again next time
+#instead of being missed.
+VERSION_MARGIN = 5
+
+def new_version():
+    """
+    The version to stamp a row with when writing it.
+    """
+    return ObjectId()
+
+def fragment_version():
+    """
+    The version to hand back with a fragment read now.
+    """
+    return str(ObjectId.from_datetime(datetime.utcnow() - timedelta(seconds=VERSION_MARGIN)))
+
+def fragment_options(message, name):
+    """
+    The fields (a list, or None for every field) and changed_since (an
+    ObjectId, or None for every row) message asks of fragment name. Raises
+    ValueError if either is malformed.
+    """
+    fields = message.get("fields") or {}
+    changed_since = message.get("changed_since") or {}
+    if not isinstance(fields, dict) or not isinstance(changed_since, dict):
+        raise ValueError("'fields' and 'changed_since' must map fragment names to values")
+
+    fields = fields.get(name)
+    if fields is not None:
+        if not isinstance(fields, list) or not all(isinstance(f, str) for f in fields):
+            raise ValueError("'fields' must be a list of field names")
+
+    since = changed_since.get(name)
+    if since is not None:
+        try:
+            since = ObjectId(str(since))
+        except bson.errors.InvalidId:
+            raise ValueError("'changed_since' must be a version given with a fragment")
+
+    return fields, since
+
+def fragment_find(collection, query, fields, since, version_field="fragment_version"):
+    """
+    Find the rows of a fragment: only the given fields, and only rows stamped
+    since, if given. The version field itself is left out.
+
+    Returns the cursor and the version of the read.
+    """
+    version = fragment_version()
+
+    if since is not None:
+        query = dict(query)
+        query[version_field] = {"$gte": since}
+
+    if fields is not None:
+        projection = {f: True for f in fields}
+        projection.setdefault("_id", False)
+    else:
+        projection = {version_field: False}
+
+    return collection.find(query, projection), version
+
+def fragment_response(name, fragment, key, version, since):
+    """
+    The reply to get_student_model_fragment. Replies made for a changed_since
+    echo it, so the receiver knows the fragment holds only the changes.
+    """
+    response = {
+        "name": name,
+        "fragment": fragment,
+        "key": key,
+        "version": version,
+    }
+
+    if since is not None:
+        response["changed_since"] = str(since)
+
+    return response
@@ -0,0 +1,141 @@
+"""
+Fits Bayesian knowledge tracing parameters per skill to the transactions the
+problem management plugin records, for the knowledge tracing plugin to start
+new students from. Used by the fitkt command and tools/kt_fit_benchmark.py.
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+
+#The coarse grid searched first, then refined around its best point. Guess and
+#mistake stay below 0.5, so knowing a skill always makes a correct step likelier.
+GRID = {
+    'probability_known': numpy.arange(0.1, 1.0, 0.1),
+    'probability_learned': numpy.arange(0.1, 1.0, 0.1),
+    'probability_guess': numpy.arange(0.05, 0.5, 0.1),
+    'probability_mistake': numpy.arange(0.05, 0.5, 0.1),
+}
+GRID_STEP = 0.1
+REFINEMENTS = 2
+
+PARAMETERS = ['probability_known', 'probability_learned', 'probability_guess', 'probability_mistake']
+BOUNDS = [(0.01, 0.99), (0.01, 0.99), (0.01, 0.49), (0.01, 0.49)]
+
+#Most parameter sets x students held in one array while computing likelihoods.
+CHUNK_ELEMENTS = 2000000
+
+def transaction_sequences(transactions):
+    """
+    Group transactions, in the order they happened, into the outcomes of each
+    student on each skill. Only correct and incorrect outcomes are kept.
+
+    Returns (sender_entity_id, skill_id) -> list of per student lists of outcomes.
+    """
+    sequences = {}
+    for transaction in transactions:
+        outcome = str(transaction.get('outcome', '')).lower()
+        if outcome not in ('correct', 'incorrect'):
+            continue
+
+        correct = outcome == 'correct'
+        sender_entity_id = transaction['edit_allowed_id']
+        student_id = transaction['student_id']
+
+        for skill_id in (transaction.get('skill_ids') or {}).values():
+            students = sequences.setdefault((sender_entity_id, skill_id), {})
+            students.setdefault(student_id, []).append(correct)
+
+    return {key: list(students.values()) for key, students in sequences.items()}
+
+def _pad(sequences):
+    """
+    Lay sequences out as a students x steps array of outcomes, with a mask of
+    the steps each student actually took.
+    """
+    steps = max(len(sequence) for sequence in sequences)
+
+    outcomes = numpy.zeros((len(sequences), steps), dtype=bool)
+    mask = numpy.zeros((len(sequences), steps), dtype=bool)
+    for i, sequence in enumerate(sequences):
+        outcomes[i, :len(sequence)] = sequence
+        mask[i, :len(sequence)] = True
+
+    return outcomes, mask
+
+def log_likelihood(outcomes, mask, params):
+    """
+    The log-likelihood of the outcomes under each row of params (known, learned,
+    guess, mistake), tracing every student under every parameter set at once.
+    """
+    known = numpy.repeat(params[:, 0:1], outcomes.shape[0], axis=1)
+    learned = params[:, 1:2]
+    guess = params[:, 2:3]
+    mistake = params[:, 3:4]
+
+    total = numpy.zeros(params.shape[0])
+    for step in range(outcomes.shape[1]):
+        correct = outcomes[:, step]
+        taken = mask[:, step]
+
+        p_correct = known * (1 - mistake) + (1 - known) * guess
+        p_outcome = numpy.where(correct, p_correct, 1 - p_correct)
+        total += numpy.where(taken, numpy.log(p_outcome), 0).sum(axis=1)
+
+        #The same update as KnowledgeTracingPlugin._kt_trace_batch
+        posterior = numpy.where(correct, known * (1 - mistake), known * mistake) / p_outcome
+        known = numpy.where(taken, posterior + (1 - posterior) * learned, known)
+
+    return total
+
+def _best(outcomes, mask, grid):
+    chunk = max(1, CHUNK_ELEMENTS // outcomes.shape[0])
+
+    likelihoods = numpy.concatenate([
+        log_likelihood(outcomes, mask, grid[start:start + chunk])
+        for start in range(0, grid.shape[0], chunk)])
+
+    best = numpy.argmax(likelihoods)
+    return grid[best], likelihoods[best]
+
+def fit_skill(sequences):
+    """
+    Grid search the BKT parameters that best explain sequences, each the outcomes
+    of one student on the skill in order. The coarse grid is refined REFINEMENTS
+    times around its best point, halving the step each time.
+    """
+    outcomes, mask = _pad(sequences)
+
+    grid = numpy.array(list(itertools.product(*[GRID[name] for name in PARAMETERS])))
+    best, likelihood = _best(outcomes, mask, grid)
+
+    step = GRID_STEP
+    for refinement in range(REFINEMENTS):
+        step = step / 2
+        grid = numpy.array(list(itertools.product(*[
+            numpy.unique(numpy.clip(value + numpy.array([-step, 0, step]), low, high))
+            for value, (low, high) in zip(best, BOUNDS)])))
+        best, likelihood = _best(outcomes, mask, grid)
+
+    fitted = {name: round(float(value), 4) for name, value in zip(PARAMETERS, best)}
+    fitted['log_likelihood'] = float(likelihood)
+    fitted['observations'] = int(mask.sum())
+
+    return fitted
+
+def fit_skills(sequences, processes=None, min_observations=0):
+    """
+    Fit every skill of sequences, as returned by transaction_sequences(), on a
+    pool of processes. Skills with fewer than min_observations outcomes are
+    left out.
+
+    Returns (sender_entity_id, skill_id) -> fitted parameters.
+    """
+    keys = [key for key, students in sequences.items() if sum(len(s) for s in students) >= min_observations]
+
+    #Fit the biggest skills first so a big one doesn't hold up the end of the run.
+    keys.sort(key=lambda key: -sum(len(s) for s in sequences[key]))
+
+    with ProcessPoolExecutor(processes) as executor:
+        fitted = executor.map(fit_skill, [sequences[key] for key in keys])
+        return dict(zip(keys, fitted))
@@ -0,0 +1,46 @@
+import threading
+from pymongo import MongoClient
+
+from hpit.management.settings_manager import SettingsManager
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def shared_mongo_client(uri=None):
+    """
+    Return the MongoClient for uri, MONGODB_URI from the plugin settings by default.
+
+    There is one client per uri in each process, so plugins hosted together (see
+    the --host mode of entity_daemon) share one connection pool instead of each
+    opening their own. MongoClient is thread safe. The pool holds at most
+    MONGO_MAX_POOL_SIZE connections.
+    """
+    settings = SettingsManager.get_plugin_settings()
+
+    if uri is None:
+        uri = settings.MONGODB_URI
+
+    with _clients_lock:
+        if uri not in _clients:
+            _clients[uri] = MongoClient(uri, max_pool_size=getattr(settings, 'MONGO_MAX_POOL_SIZE', 100))
+
+        return _clients[uri]
+
+def shared_motor_client(uri=None):
+    """
+    Return the asyncio MongoDB client (motor) for uri, for plugins running on
+    the asyncio runtime (see hpit.utils.async_plugin). As with
+    shared_mongo_client() there is one client per uri in each process.
+    """
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    settings = SettingsManager.get_plugin_settings()
+
+    if uri is None:
+        uri = settings.MONGODB_URI
+
+    with _clients_lock:
+        if ('motor', uri) not in _clients:
+            _clients[('motor', uri)] = AsyncIOMotorClient(uri, maxPoolSize=getattr(settings, 'MONGO_MAX_POOL_SIZE', 100))
+
+        return _clients[('motor', uri)]
@@ -70,3 +70,27 @@ class TestBaseManager(unittest.TestCase):
         pass
 
 
+
+
+    def test_start_plugin_hosts(self):
+        """
+        BaseManager.start() Test plan:
+            - plugins without a host should get their own process
+            - plugins with the same host should be started together
+        """
+        configuration = {
+            'plugins': [
+                {'entity_id': '1', 'active': False},
+                {'entity_id': '2', 'active': False, 'host': 'shared'},
+                {'entity_id': '3', 'active': False, 'host': 'shared'},
+            ]
+        }
+
+        self.subject.spin_up_entity = MagicMock()
+        self.subject.spin_up_host = MagicMock()
+
+        with patch('hpit.management.entity_manager.time.sleep'), patch('hpit.management.entity_manager.os.makedirs'):
+            self.subject.start(None, configuration)
+
+        self.subject.spin_up_entity.assert_called_once_with(configuration['plugins'][0], 'plugin')
+        self.subject.spin_up_host.assert_called_once_with('shared', configuration['plugins'][1:])
@@ -3,6 +3,7 @@ from mock import *
 from pymongo import MongoClient
 from pymongo.collection import Collection
 from bson.objectid import ObjectId
+from datetime import datetime
 
 from hpit.plugins import KnowledgeTracingPlugin
 
@@ -65,7 +66,7 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         KnowledgeTracingPlugin.kt_batch_trace() Test plan:
             - pass without skill_list, student id, should respond error
             - pass with bogus skill_list, should repond error
-            - mock _kt_trace should be called with each skill
+            - mock _kt_trace_batch should be called once with every traced skill
             - response should be called with skill_name : response dict
         """
         #no params
@@ -87,17 +88,17 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         self.test_subject.send_response.reset_mock()
         
         #good skills, not init
-        def side_effect_trace(kt_config,correct):
-            return {
+        def side_effect_trace(kt_configs,correct):
+            return [{
                 'skill_id': kt_config["skill_id"],
                 'student_id': kt_config['student_id'],
                 'probability_known': 5,
                 'probability_learned': 5,
                 'probability_guess': 5,
                 'probability_mistake': 5,     
-            }
+            } for kt_config in kt_configs]
             
-        self.test_subject._kt_trace = MagicMock(side_effect=side_effect_trace)      
+        self.test_subject._kt_trace_batch = MagicMock(side_effect=side_effect_trace)      
         
         msg["skill_list"] = {"444":True,"555":False}
         self.test_subject.kt_batch_trace(msg)
@@ -128,7 +129,10 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         
         #skills exist
         self.test_subject.kt_batch_trace(msg)
-        self.test_subject._kt_trace.call_count.should.equal(2)
+        self.test_subject._kt_trace_batch.call_count.should.equal(2)
+        kt_configs, correct = self.test_subject._kt_trace_batch.call_args[0]
+        kt_configs.should.have.length_of(2)
+        dict(zip([c["skill_id"] for c in kt_configs], correct)).should.equal({"444":True,"555":False})
         self.test_subject.send_response.assert_called_with("2",{
                 "traced_skills":{
                     "444" : {
@@ -247,6 +251,58 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         nose.tools.assert_almost_equal(value["probability_known"],expected_value,places=5)
         nose.tools.assert_equal(value["student_id"],"123")
         nose.tools.assert_equal(value["skill_id"],"444")
+
+    def test_default_values_priors(self):
+        """
+        KnowledgeTracingPlugin._default_values() Test plan:
+            - should use the defaults for skills without fitted priors
+            - should use the fitted priors of the sender's skill when there are some
+        """
+        self.test_subject._default_values("3","444","4")["probability_known"].should.equal(0.75)
+
+        self.test_subject.priors_db.insert({
+            "sender_entity_id":"3",
+            "skill_id":"555",
+            "probability_known": .2,
+            "probability_learned": .1,
+            "probability_guess": .15,
+            "probability_mistake": .05,
+        })
+        self.test_subject.priors = {}
+
+        self.test_subject._default_values("3","555","4").should.equal({
+            'sender_entity_id': "3",
+            'skill_id': "555",
+            'student_id': "4",
+            'probability_known': .2,
+            'probability_learned': .1,
+            'probability_guess': .15,
+            'probability_mistake': .05,
+        })
+        self.test_subject._default_values("5","555","4")["probability_known"].should.equal(0.75)
+
+    def test_kt_trace_batch(self):
+        """
+        KnowledgeTracingPlugin._kt_trace_batch() Test plan:
+            - each skill should be traced as _kt_trace would, in the order given
+            - a zero denominator should give a posterior of probability_learned
+        """
+        insert_doc = {
+            "student_id":"123",
+            "probability_known": .7,
+            "probability_learned": .2,
+            "probability_guess": .3,
+            "probability_mistake": .4,
+        }
+        kt_configs = [dict(insert_doc,skill_id="444"),dict(insert_doc,skill_id="555"),dict(insert_doc,skill_id="666",probability_known=0,probability_guess=0)]
+
+        values = self.test_subject._kt_trace_batch(kt_configs,[True,False,True])
+
+        [v["skill_id"] for v in values].should.equal(["444","555","666"])
+        nose.tools.assert_almost_equal(values[0]["probability_known"],(.42 / .51) + ( (1 - (.42 / .51)) * .2),places=5)
+        nose.tools.assert_almost_equal(values[1]["probability_known"],(.28 / .49) + ( (1 - (.28 / .49)) * .2),places=5)
+        nose.tools.assert_almost_equal(values[2]["probability_known"],.2,places=5)
+        self.test_subject._kt_trace_batch([],[]).should.equal([])
         
     def test_kt_set_initial_no_sender_entity_id(self):
         """
@@ -507,10 +563,11 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         """ 
         msg = {"message_id":"1","sender_entity_id":"2","student_id":"3"}
         self.test_subject.get_student_model_fragment(msg)
-        self.test_subject.send_response.assert_called_with("1",{
-            "name":"knowledge_tracing",
-            "fragment":[],
-        })
+        response = self.test_subject.send_response.call_args[0][1]
+        response["name"].should.equal("knowledge_tracing")
+        response["fragment"].should.equal([])
+        response["key"].should.equal("skill_id")
+        response.should.contain("version")
         
     def test_get_student_model_fragment_full_db(self):
         """
@@ -549,9 +606,7 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         
         #should return values 1 and 2 from above
         self.test_subject.get_student_model_fragment(msg)
-        self.test_subject.send_response.assert_called_with("1",{
-            "name":"knowledge_tracing",
-            "fragment":[{
+        self.test_subject.send_response.call_args[0][1]["fragment"].should.equal([{
                 'skill_id': "567",
                 'probability_known': 1,
                 'probability_learned': 1,
@@ -567,8 +622,45 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
                 'probability_mistake': 1,
                 'student_id': "123",
                 }
-            ],
+            ])
+        
+    def test_get_student_model_fragment_changed_since(self):
+        """
+        KnowledgeTracingPlugin.get_student_model_fragment() changed_since and fields:
+            - should only return the asked fields
+            - should only return the rows written since the version given
+            - a bad changed_since should be an error
+        """
+        skill_id = str(ObjectId())
+        self.test_subject.db.insert({
+            'sender_entity_id': "2",
+            'skill_id': skill_id,
+            'probability_known': 1,
+            'probability_learned': 1,
+            'probability_guess': 0,
+            'probability_mistake': 0,
+            'student_id': "123",
+            'kt_version': ObjectId.from_datetime(datetime(2014, 1, 1)),
         })
+        msg = {"message_id":"1","sender_entity_id":"2","student_id":"123","fields":{"knowledge_tracing":["skill_id","probability_known"]}}
+
+        self.test_subject.get_student_model_fragment(msg)
+        response = self.test_subject.send_response.call_args[0][1]
+        response["fragment"].should.equal([{'skill_id': skill_id, 'probability_known': 1}])
+
+        msg["changed_since"] = {"knowledge_tracing": response["version"]}
+        self.test_subject.get_student_model_fragment(msg)
+        response = self.test_subject.send_response.call_args[0][1]
+        response["fragment"].should.equal([])
+        response["changed_since"].should.equal(msg["changed_since"]["knowledge_tracing"])
+
+        self.test_subject.kt_reset({"message_id":"2","sender_entity_id":"2","skill_id":skill_id,"student_id":"123"})
+        self.test_subject.get_student_model_fragment(msg)
+        self.test_subject.send_response.call_args[0][1]["fragment"].should.equal([{'skill_id': skill_id, 'probability_known': 0.75}])
+
+        msg["changed_since"] = {"knowledge_tracing": "bogus"}
+        self.test_subject.get_student_model_fragment(msg)
+        self.test_subject.send_response.call_args[0][1].should.contain("error")
         
     def test_transaction_callback_method(self):
         """
@@ -688,6 +780,7 @@ class TestKnowledgeTracingPlugin(unittest.TestCase):
         })
         """
         self.test_subject.send_response.called.should.equal(True) #can't check params because of float precision
+        self.test_subject.cache.flush()
         expected_value = (.5025 / .585) + ( (1 - (.5025 / .585)) * .33)
         thing  = self.test_subject.db.find_one({'sender_entity_id':"2",'student_id':"123","skill_id":"skill1_id"})
         nose.tools.assert_almost_equal(thing["probability_known"],expected_value,places=5)
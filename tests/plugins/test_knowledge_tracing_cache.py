@@ -0,0 +1,117 @@
+import sure
+import unittest
+from mock import *
+from pymongo import MongoClient
+
+from hpit.plugins.knowledge_tracing_cache import KnowledgeTracingCache
+
+from hpit.management.settings_manager import SettingsManager
+settings = SettingsManager.get_plugin_settings()
+
+class TestKnowledgeTracingCache(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.db = MongoClient()[settings.MONGO_DBNAME].hpit_knowledge_tracing
+
+        #Counts correct steps, so replays are easy to check.
+        def tracer(kt_configs, correct):
+            return [dict(kt_config, probability_known=kt_config['probability_known'] + (1 if c else 0)) for kt_config, c in zip(kt_configs, correct)]
+
+        self.tracer = MagicMock(side_effect=tracer)
+        self.test_subject = KnowledgeTracingCache(self.db, self.tracer, size=10)
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        client = MongoClient()
+        client.drop_database(settings.MONGO_DBNAME)
+
+        self.test_subject = None
+        self.db = None
+
+    def default(self, skill_id):
+        return {'sender_entity_id': "3", 'skill_id': skill_id, 'student_id': "4", 'probability_known': 0}
+
+    def test_trace(self):
+        """
+        KnowledgeTracingCache.trace() Test plan:
+            - new skills should get the default row, untraced
+            - known skills should be traced from the cache without querying
+            - flush() should write every dirty row in one bulk write
+        """
+        traces, new_rows = self.test_subject.trace("3", "4", {"a": True, "b": True}, self.default)
+        traces.should.equal([])
+        new_rows.should.have.length_of(2)
+        self.db.find().count().should.equal(0)
+
+        self.test_subject.flush().should.equal(2)
+        self.db.find().count().should.equal(2)
+
+        self.db.find = MagicMock(side_effect=self.db.find)
+        traces, new_rows = self.test_subject.trace("3", "4", {"a": True, "b": False}, self.default)
+        self.db.find.called.should.equal(False)
+        sorted((t['skill_id'], t['probability_known']) for t in traces).should.equal([("a", 1), ("b", 0)])
+        del self.db.find
+
+        self.test_subject.flush().should.equal(2)
+        self.db.find_one({'skill_id': "a"})['probability_known'].should.equal(1)
+        self.test_subject.flush().should.equal(0)
+
+    def test_flush_conflict(self):
+        """
+        KnowledgeTracingCache.flush() Test plan:
+            - a row changed by another process should not be overwritten
+            - the outcomes traced since the last flush should be replayed on the stored row
+        """
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.flush()
+
+        self.db.update({'skill_id': "a"}, {'$set': {'probability_known': 10, 'kt_version': self.test_subject.new_version()}})
+
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.flush().should.equal(0)
+        self.db.find_one({'skill_id': "a"})['probability_known'].should.equal(10)
+
+        self.test_subject.flush().should.equal(1)
+        self.db.find_one({'skill_id': "a"})['probability_known'].should.equal(12)
+
+    def test_invalidate(self):
+        """
+        KnowledgeTracingCache.invalidate() Test plan:
+            - the row should be reloaded on its next trace
+        """
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.flush()
+
+        self.db.update({'skill_id': "a"}, {'$set': {'probability_known': 5}})
+        self.test_subject.invalidate("3", "a", "4")
+
+        traces, new_rows = self.test_subject.trace("3", "4", {"a": True}, self.default)
+        traces[0]['probability_known'].should.equal(6)
+
+    def test_evict_then_retrace(self):
+        """
+        KnowledgeTracingCache Test plan:
+            - a dirty row pushed out of the LRU and traced again before the next
+              flush should be put back, not reloaded from the stored row
+            - both outcomes should be written
+        """
+        self.test_subject.size = 1
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.flush()
+
+        self.test_subject.trace("3", "4", {"a": True}, self.default)
+        self.test_subject.trace("3", "4", {"b": True}, self.default)
+        list(self.test_subject.evicted.keys()).should.equal([("3", "a", "4")])
+
+        traces, new_rows = self.test_subject.trace("3", "4", {"a": True}, self.default)
+        traces[0]['probability_known'].should.equal(2)
+        self.test_subject.evicted.should.have.length_of(1)
+
+        self.test_subject.flush().should.equal(2)
+        self.db.find_one({'skill_id': "a"})['probability_known'].should.equal(2)
@@ -5,6 +5,7 @@ from pymongo.collection import Collection
 from bson.objectid import ObjectId
 
 from hpit.plugins import ProblemGeneratorPlugin
+from hpit.plugins.problem_generator.problem_generator import generate_problems
 
 class TestProblemGeneratorPlugin(unittest.TestCase):
 
@@ -218,6 +219,25 @@ class TestProblemGeneratorPlugin(unittest.TestCase):
         self.test_subject.generate_problem.assert_called_with('arithmetic', "addition", "AddTwoTwoDigitNumbers", thing=1)
 
 
+    def test_generate_problem_callback_process_pool(self):
+        """
+        ProblemGeneratorPlugin.generate_problem_callback() Test - With a process pool
+        """
+        self.test_subject.send_response = MagicMock()
+        self.test_subject.process_pool = MagicMock()
+        self.test_subject.process_pool.submit.return_value.result.return_value = [{'problem_text': 'problem'}]
+
+        self.test_subject.generate_problem_callback({
+            'message_id': "1",
+            'sender_entity_id': "2",
+            'subject': 'arithmetic',
+            'count': 2
+        })
+
+        self.test_subject.process_pool.submit.assert_called_with(generate_problems, 'arithmetic', None, None, 2, {})
+        self.test_subject.send_response.assert_called_with("1", {'problems': [{'problem_text': 'problem'}]})
+
+
     def test_generate_problem_no_subject(self):
         """
         ProblemGeneratorPlugin.generate_problem() Test - No Subject
@@ -1343,10 +1343,17 @@ class TestProblemManagementPlugin(unittest.TestCase):
         problems = [p for p in cur]
         
         self.test_subject.get_student_model_fragment_callback(msg)
-        self.test_subject.send_response.assert_called_with("1",{
-              "name" : "problem_management",
-              "fragment" : problems
-        })
+        response = self.test_subject.send_response.call_args[0][1]
+        response["name"].should.equal("problem_management")
+        response["fragment"].should.equal(problems)
+        response["key"].should.equal("problem_id")
+
+        #changed since that read, only the fields asked for
+        self.test_subject.worked_db.update({"student_id":"2","problem_id":"456"},{"$set":{"fragment_version":ObjectId()}})
+        msg["changed_since"] = {"problem_management": response["version"]}
+        msg["fields"] = {"problem_management": ["problem_id"]}
+        self.test_subject.get_student_model_fragment_callback(msg)
+        self.test_subject.send_response.call_args[0][1]["fragment"].should.equal([{"problem_id":"456"}])
         
     def test_get_student_model_fragment_callback_no_student_id(self):
         """
@@ -1365,10 +1372,9 @@ class TestProblemManagementPlugin(unittest.TestCase):
         """
         msg = {"message_id":"1","student_id":"2"}
         self.test_subject.get_student_model_fragment_callback(msg)
-        self.test_subject.send_response.assert_called_with("1",{
-              "name":"problem_management",
-              "fragment": [],
-        })
+        response = self.test_subject.send_response.call_args[0][1]
+        response["name"].should.equal("problem_management")
+        response["fragment"].should.equal([])
         
     def test_transaction_callback_method(self):
         """
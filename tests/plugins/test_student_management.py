@@ -409,6 +409,15 @@ class TestStudentManagementPlugin(unittest.TestCase):
             "student_id":str(sid),
             'update': False
         },"3")
+
+        #with fragments cached, ask for the changes since
+        self.test_subject.fragment_cache[str(sid)] = {"knowledge_tracing": {"version": "a", "rows": {}}}
+        self.test_subject.get_student_model_callback(msg)
+        self.test_subject.send.assert_called_with("get_student_model_fragment",{
+            "student_id":str(sid),
+            'update': False,
+            'changed_since': {"knowledge_tracing": "a"},
+        },"3")
     
     
     def test_get_populate_student_model_callback_function(self):
@@ -480,6 +489,56 @@ class TestStudentManagementPlugin(unittest.TestCase):
         func({"name":"knowledge_tracing","fragment":"some_data","cached":False})
         self.test_subject.send_response.call_count.should.equal(0)
         
+    def test_merge_fragment(self):
+        """
+        StudentManagementPlugin._merge_fragment() Test plan:
+            - unversioned fragments should be returned as they are, not cached
+            - a full fragment should replace what is cached
+            - changes should be merged into the cached rows by key, keeping the oldest version
+            - changes for a student no longer cached should raise KeyError, not pass as the whole fragment
+            - the cache should hold at most fragment_cache_size students
+            - pinned students should not be evicted
+        """
+        self.test_subject._merge_fragment("1", {"name":"hint_factory","fragment":"some_data"}).should.equal(("some_data", False))
+        self.test_subject.fragment_cache.should.equal({})
+
+        self.test_subject._merge_fragment("1", {
+            "name":"knowledge_tracing","key":"skill_id","version":"b",
+            "fragment":[{"skill_id":"1","probability_known":0.5},{"skill_id":"2","probability_known":0.5}],
+        }).should.equal(([{"skill_id":"1","probability_known":0.5},{"skill_id":"2","probability_known":0.5}], False))
+        self.test_subject._cached_versions("1").should.equal({"knowledge_tracing":"b"})
+
+        self.test_subject._merge_fragment("1", {
+            "name":"knowledge_tracing","key":"skill_id","version":"c","changed_since":"b",
+            "fragment":[{"skill_id":"2","probability_known":0.9},{"skill_id":"3","probability_known":0.1}],
+        }).should.equal(([
+            {"skill_id":"1","probability_known":0.5},
+            {"skill_id":"2","probability_known":0.9},
+            {"skill_id":"3","probability_known":0.1},
+        ], True))
+        self.test_subject._cached_versions("1").should.equal({"knowledge_tracing":"c"})
+
+        self.test_subject._merge_fragment("1", {
+            "name":"knowledge_tracing","key":"skill_id","version":"d","changed_since":"a",
+            "fragment":[],
+        })[1].should.equal(True)
+        self.test_subject._cached_versions("1").should.equal({"knowledge_tracing":"c"})
+
+        self.test_subject._merge_fragment.when.called_with("2", {
+            "name":"knowledge_tracing","key":"skill_id","version":"c","changed_since":"b",
+            "fragment":[{"skill_id":"2","probability_known":0.9}],
+        }).should.throw(KeyError)
+        self.test_subject._cached_versions("2").should.equal({})
+
+        self.test_subject.fragment_cache_size = 1
+        self.test_subject._pin_fragments("m1", "1").should.equal({"knowledge_tracing":"c"})
+        self.test_subject._merge_fragment("3", {"name":"knowledge_tracing","key":"skill_id","version":"c","fragment":[]})
+        list(self.test_subject.fragment_cache.keys()).should.equal(["1", "3"])
+
+        self.test_subject._unpin_fragments("m1")
+        self.test_subject._merge_fragment("4", {"name":"knowledge_tracing","key":"skill_id","version":"c","fragment":[]})
+        list(self.test_subject.fragment_cache.keys()).should.equal(["4"])
+
     def test_kill_timeout(self):
         """
         StudentManagementPlugin.kill_timeout() Test plan:
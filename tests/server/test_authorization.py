@@ -0,0 +1,115 @@
+import sure
+import unittest
+from mock import *
+
+from hpit.server.authorization import AuthorizationService
+from hpit.server.versioning import SharedVersion, SharedKeys
+
+class TestAuthorizationService(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.version = SharedVersion(None, "authorization", 0)
+        self.changes = SharedKeys(None, "authorization", 0)
+        self.test_subject = AuthorizationService(MagicMock(), self.version, self.changes)
+        self.test_subject._load_messages = MagicMock(side_effect=lambda names: {
+            n: ({"1234": True, "5678": False} if n == "test_event" else {}) for n in names
+        })
+        self.test_subject._load_resource = MagicMock(return_value={"1234": True})
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject = None
+        self.version = None
+        self.changes = None
+
+    def test_message_grants_cached(self):
+        """
+        AuthorizationService message checks Test plan:
+            - should report the owner and who holds grants
+            - names with no grants should be cached too
+            - should load each name once
+        """
+        self.test_subject.message_owner("test_event").should.equal("1234")
+        self.test_subject.message_owner("other_event").should.equal(None)
+        self.test_subject.is_message_owner("test_event", "1234").should.equal(True)
+        self.test_subject.is_message_owner("test_event", "5678").should.equal(False)
+
+        self.test_subject.authorized_message_names("5678", ["test_event", "other_event", "test_event"]).should.equal({"test_event"})
+        self.test_subject.authorized_message_names("9999", ["test_event"]).should.equal(set())
+
+        self.test_subject._load_messages.call_count.should.equal(2)
+
+    def test_resource_grants_cached(self):
+        """
+        AuthorizationService.is_resource_owner() Test plan:
+            - should report ownership
+            - should load each resource once
+        """
+        self.test_subject.is_resource_owner("123", "1234").should.equal(True)
+        self.test_subject.is_resource_owner("123", "5678").should.equal(False)
+        self.test_subject._load_resource.call_count.should.equal(1)
+
+    def test_invalidate(self):
+        """
+        AuthorizationService.invalidate() Test plan:
+            - should force a reload on the next check
+            - a version bumped by another process should also force a reload
+        """
+        self.test_subject.message_owner("test_event")
+        self.test_subject.invalidate()
+        self.test_subject.message_owner("test_event")
+        self.test_subject._load_messages.call_count.should.equal(2)
+
+        self.version.version = "changed elsewhere"
+        self.test_subject.message_owner("test_event")
+        self.test_subject._load_messages.call_count.should.equal(3)
+
+    def test_grants_forget_only_their_keys(self):
+        """
+        AuthorizationService grants Test plan:
+            - granting a message should only reload that message
+            - granting a resource should only reload that resource
+            - neither should bump the shared version, but both should record their keys
+            - keys changed by another process should be dropped, and only those
+        """
+        self.changes.changed = MagicMock()
+        self.test_subject.message_owner("test_event")
+        self.test_subject.message_owner("other_event")
+        self.test_subject.is_resource_owner("123", "1234")
+        self.test_subject.is_resource_owner("456", "1234")
+
+        self.test_subject.grant_message("test_event", ["9999"])
+        self.test_subject.grant_resource("123", ["9999"])
+        self.changes.changed.assert_called_with(["resource:123"])
+        self.version.version.should.equal(None)
+
+        self.test_subject.message_owner("test_event")
+        self.test_subject.message_owner("other_event")
+        self.test_subject.is_resource_owner("123", "1234")
+        self.test_subject.is_resource_owner("456", "1234")
+        self.test_subject._load_messages.call_count.should.equal(3)
+        self.test_subject._load_resource.call_count.should.equal(3)
+
+        self.changes.since_last_check = MagicMock(return_value=["message:other_event"])
+        self.test_subject.message_owner("test_event")
+        self.test_subject.message_owner("other_event")
+        self.test_subject._load_messages.call_count.should.equal(4)
+
+    def test_add_resource(self):
+        """
+        AuthorizationService.add_resource() Test plan:
+            - should write the owner's grant
+            - should cache the new resource without loading it or recording any change
+        """
+        self.changes.changed = MagicMock()
+        self.test_subject.add_resource("789", "1234")
+
+        self.test_subject.db.session.commit.call_count.should.equal(1)
+        self.test_subject.is_resource_owner("789", "1234").should.equal(True)
+        self.test_subject._load_resource.call_count.should.equal(0)
+        self.changes.changed.call_count.should.equal(0)
@@ -0,0 +1,83 @@
+import sure
+import unittest
+from datetime import datetime
+from mock import *
+
+from hpit.server.entities import EntityRegistry, CachedEntity
+from hpit.server.versioning import SharedVersion
+
+class TestEntityRegistry(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.version = SharedVersion(None, "entities", 0)
+        self.test_subject = EntityRegistry(MagicMock(), self.version, 60)
+        self.entity = CachedEntity(MagicMock(), 1, "1234", "Test", "for testing.", "salt", "hash")
+        self.test_subject._load = MagicMock(return_value=self.entity)
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject = None
+
+    def test_get_cached(self):
+        """
+        EntityRegistry.get() Test plan:
+            - should only load an entity once
+            - misses should not be cached
+            - invalidate() should force a reload
+        """
+        self.test_subject.get("1234").should.equal(self.entity)
+        self.test_subject.get("1234").should.equal(self.entity)
+        self.test_subject._load.call_count.should.equal(1)
+
+        self.test_subject._load.return_value = None
+        self.test_subject.get("5678").should.equal(None)
+        self.test_subject.get("5678").should.equal(None)
+        self.test_subject._load.call_count.should.equal(3)
+
+        self.test_subject._load.return_value = self.entity
+        self.test_subject.invalidate()
+        self.test_subject.get("1234")
+        self.test_subject._load.call_count.should.equal(4)
+
+    def test_touch(self):
+        """
+        EntityRegistry.touch() Test plan:
+            - heartbeats should be buffered and a flush timer started
+            - flush() should write them with one update per model and commit
+            - flush() should stop the timer
+        """
+        self.test_subject.touch(self.entity)
+        self.test_subject.touch(self.entity)
+        self.entity.model.query.filter.call_count.should.equal(0)
+        len(self.test_subject.heartbeats).should.equal(1)
+        self.test_subject.timer.should_not.equal(None)
+
+        self.test_subject.flush()
+        self.entity.model.query.filter.call_count.should.equal(1)
+        self.test_subject.db.session.commit.call_count.should.equal(1)
+        len(self.test_subject.heartbeats).should.equal(0)
+        self.test_subject.timer.should.equal(None)
+
+    def test_flush_by_time(self):
+        """
+        EntityRegistry.flush() Test plan:
+            - entities polled at different times should keep their own poll time
+            - entities polled in the same second should share one update
+        """
+        model = self.entity.model
+        self.test_subject.heartbeats = {
+            (model, "1"): datetime(2014, 1, 1, 0, 0, 0, 100),
+            (model, "2"): datetime(2014, 1, 1, 0, 0, 0, 900),
+            (model, "3"): datetime(2014, 1, 1, 0, 0, 4),
+        }
+
+        self.test_subject.flush()
+        model.query.filter.call_count.should.equal(2)
+
+        updates = [c[0][0]['time_last_polled'] for c in model.query.filter.return_value.update.call_args_list]
+        sorted(updates).should.equal([datetime(2014, 1, 1, 0, 0, 0), datetime(2014, 1, 1, 0, 0, 4)])
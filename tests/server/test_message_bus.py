@@ -0,0 +1,134 @@
+import sure
+import unittest
+from datetime import datetime, timedelta
+
+from hpit.server.message_bus import MemoryMessageBus
+
+class TestMemoryMessageBus(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.test_subject = MemoryMessageBus()
+
+        self.message_id = self.test_subject.add_messages([{
+            'sender_entity_id': "1234",
+            'session_token': "token",
+            'time_created': datetime.now(),
+            'message_name': "test",
+            'payload': {"test": "test"},
+        }])[0]
+
+        self.test_subject.queue([{
+            'message_id': self.message_id,
+            'sender_entity_id': "1234",
+            'session_token': "token",
+            'receiver_entity_id': receiver,
+            'time_created': datetime.now(),
+            'message_name': "test",
+        } for receiver in ["5678", "5678", "9999"]])
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject = None
+
+    def test_message_payloads(self):
+        """
+        MemoryMessageBus.message_payloads() Test plan:
+            - should return payloads for known message ids only
+        """
+        self.test_subject.message_payloads([self.message_id, "bogus"]).should.equal({self.message_id: {"test": "test"}})
+
+    def test_claim_auto_ack(self):
+        """
+        MemoryMessageBus.claim() without a visibility timeout:
+            - should respect the limit
+            - claimed deliveries should leave the queue and be recorded as sent
+            - other receivers' queues should be untouched
+        """
+        self.test_subject.claim("5678", 1).should.have.length_of(1)
+        self.test_subject.claim("5678", 10).should.have.length_of(1)
+        self.test_subject.claim("5678", 10).should.equal([])
+
+        self.test_subject.queued("5678").should.equal([])
+        self.test_subject.queued("9999").should.have.length_of(1)
+        self.test_subject.sent_to("5678").should.have.length_of(2)
+
+    def test_queued_paging(self):
+        """
+        MemoryMessageBus.queued() Test plan:
+            - limit should cap the page
+            - after should return the deliveries following it
+        """
+        first = self.test_subject.queued("5678", limit=1)
+        first.should.have.length_of(1)
+
+        rest = self.test_subject.queued("5678", after=first[0]['_id'])
+        rest.should.have.length_of(1)
+        rest[0]['_id'].should.be.greater_than(first[0]['_id'])
+
+    def test_claim_visibility(self):
+        """
+        MemoryMessageBus.claim() with a visibility timeout:
+            - leased deliveries should not be handed out again until the lease runs out
+            - ack should remove them
+        """
+        self.test_subject.claim("5678", 10, 60).should.have.length_of(2)
+        self.test_subject.claim("5678", 10, 60).should.equal([])
+
+        for delivery in self.test_subject.deliveries["5678"].values():
+            delivery['claimed_until'] = datetime.now() - timedelta(seconds=1)
+        self.test_subject.claim("5678", 10, 60).should.have.length_of(2)
+        self.test_subject.sent_to("5678").should.have.length_of(2)
+
+        self.test_subject.ack("5678", [self.message_id]).should.equal(2)
+        self.test_subject.queued("5678").should.equal([])
+
+    def test_reassign(self):
+        """
+        MemoryMessageBus.reassign() Test plan:
+            - should move deliveries to their new receiver
+            - deliveries still leased should stay put
+        """
+        leased, free = self.test_subject.queued("5678")
+        self.test_subject.deliveries["5678"][leased['_id']]['claimed_until'] = datetime.now() + timedelta(seconds=60)
+
+        self.test_subject.reassign("5678", {leased['_id']: "4321", free['_id']: "4321"}).should.equal(1)
+
+        [d['_id'] for d in self.test_subject.queued("5678")].should.equal([leased['_id']])
+        moved = self.test_subject.queued("4321")
+        [d['_id'] for d in moved].should.equal([free['_id']])
+        moved[0]['receiver_entity_id'].should.equal("4321")
+        self.test_subject.claim("4321", 10).should.have.length_of(1)
+
+    def test_responses(self):
+        """
+        MemoryMessageBus.add_responses() and take_responses() Test plan:
+            - responses should only be taken by the receiver's matching session
+            - taken responses should not come back
+            - returned responses should be taken again
+        """
+        sent = self.test_subject.claim("5678", 1)[0]
+        self.test_subject.mark_responded([sent['_id']], datetime.now())
+        self.test_subject.sent([sent['_id']])[0].should.contain('time_responded')
+
+        self.test_subject.add_responses([{
+            'message_id': self.message_id,
+            'session_token': "token",
+            'sender_entity_id': "5678",
+            'receiver_entity_id': "1234",
+            'message': {'_id': sent['_id'], 'message_id': self.message_id},
+            'response': {"ok": True},
+            'time_created': datetime.now(),
+        }])
+
+        self.test_subject.take_responses("1234", "other token").should.equal([])
+        taken = self.test_subject.take_responses("1234", "token")
+        taken.should.have.length_of(1)
+        self.test_subject.take_responses("1234", "token").should.equal([])
+
+        self.test_subject.return_responses(taken)
+        self.test_subject.take_responses("1234", "token").should.equal(taken)
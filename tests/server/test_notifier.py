@@ -0,0 +1,97 @@
+import sure
+import unittest
+import threading
+import time
+
+from hpit.server.notifier import MessageNotifier
+
+class TestMessageNotifier(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.test_subject = MessageNotifier()
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject = None
+
+    def test_wait_timeout(self):
+        """
+        MessageNotifier.wait() Timeout:
+            - with nothing notified, wait should return False after the timeout
+            - the key should not linger once nobody is waiting on it
+        """
+        generation = self.test_subject.generation("1234")
+        self.test_subject.wait("1234", generation, 0.05).should.equal(False)
+
+        self.test_subject.conditions.should_not.contain("1234")
+        self.test_subject.waiters.should_not.contain("1234")
+
+    def test_notify_before_wait(self):
+        """
+        MessageNotifier.wait() Notified between snapshot and wait:
+            - a notification that lands after the snapshot should not be lost
+        """
+        generation = self.test_subject.generation("1234")
+        self.test_subject.notify(["1234"])
+
+        start = time.time()
+        self.test_subject.wait("1234", generation, 5).should.equal(True)
+        (time.time() - start < 1).should.equal(True)
+
+    def test_notify_wakes_waiter(self):
+        """
+        MessageNotifier.notify() Test plan:
+            - a thread waiting on a key should wake up when that key is notified
+            - notifying a different key should not wake it
+        """
+        result = {}
+
+        def waiter():
+            generation = self.test_subject.generation("1234")
+            result["woken"] = self.test_subject.wait("1234", generation, 5)
+
+        thread = threading.Thread(target=waiter)
+        thread.start()
+        time.sleep(0.05)
+
+        self.test_subject.notify(["5678"])
+        time.sleep(0.05)
+        thread.is_alive().should.equal(True)
+
+        self.test_subject.notify(["1234"])
+        thread.join(1)
+
+        thread.is_alive().should.equal(False)
+        result["woken"].should.equal(True)
+
+    def test_notify_while_another_waits(self):
+        """
+        MessageNotifier.wait() Test plan:
+            - a notification seen by one waiter should still wake a poller that
+              snapshotted before it, after that waiter has left
+            - keys notified longer than PRUNE_AGE ago should be forgotten
+        """
+        generation = self.test_subject.generation("1234")
+
+        thread = threading.Thread(target=self.test_subject.wait, args=("1234", generation, 5))
+        thread.start()
+        time.sleep(0.05)
+
+        self.test_subject.notify(["1234"])
+        thread.join(1)
+        thread.is_alive().should.equal(False)
+
+        start = time.time()
+        self.test_subject.wait("1234", generation, 5).should.equal(True)
+        (time.time() - start < 1).should.equal(True)
+
+        self.test_subject.notified["1234"] -= self.test_subject.PRUNE_AGE
+        self.test_subject.last_pruned -= self.test_subject.PRUNE_AGE
+        self.test_subject.notify(["5678"])
+        self.test_subject.generations.should_not.contain("1234")
+        self.test_subject.generations.should.contain("5678")
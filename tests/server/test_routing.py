@@ -0,0 +1,138 @@
+import sure
+import unittest
+import time
+from datetime import datetime, timedelta
+from mock import *
+
+from hpit.server.routing import SubscriptionRouter, ShardRing
+from hpit.server.versioning import SharedVersion
+
+class TestSubscriptionRouter(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.version = SharedVersion(None, "subscriptions", 0)
+        self.test_subject = SubscriptionRouter(None, self.version)
+        self.test_subject._load = MagicMock(return_value=({"test_event": ["1234", "5678"]}, {}, float('inf')))
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject = None
+        self.version = None
+
+    def test_receivers_cached(self):
+        """
+        SubscriptionRouter.receivers() Test plan:
+            - should load the index once and reuse it
+            - unknown message names should route to nobody
+            - callers should get a copy they can't use to corrupt the index
+        """
+        self.test_subject.receivers("test_event").should.equal(["1234", "5678"])
+        self.test_subject.receivers("other_event").should.equal([])
+
+        self.test_subject.receivers("test_event").append("9999")
+        self.test_subject.receivers("test_event").should.equal(["1234", "5678"])
+
+        self.test_subject._load.call_count.should.equal(1)
+
+    def test_invalidate(self):
+        """
+        SubscriptionRouter.invalidate() Test plan:
+            - should force a reload on the next lookup
+            - a version bumped by another process should also force a reload
+        """
+        self.test_subject.receivers("test_event")
+        self.test_subject.invalidate()
+        self.test_subject.receivers("test_event")
+        self.test_subject._load.call_count.should.equal(2)
+
+        self.version.version = "changed elsewhere"
+        self.test_subject.receivers("test_event")
+        self.test_subject._load.call_count.should.equal(3)
+
+    def test_receivers_sharded(self):
+        """
+        SubscriptionRouter.receivers() with a shard group Test plan:
+            - each message should go to the plain subscribers and one plugin of the group
+            - the same shard_key value should always go to the same plugin
+            - shard_owner() and is_sharded() should know the group's members
+        """
+        ring = ShardRing("student_id", ["kt1", "kt2"])
+        self.test_subject._load.return_value = (
+            {"test_event": ["1234"]},
+            {"test_event": [("kt", {"kt1", "kt2", "kt3"}, ring)]},
+            float('inf'))
+
+        owners = set()
+        for student_id in range(20):
+            receivers = self.test_subject.receivers("test_event", {"student_id": str(student_id)})
+            receivers.should.have.length_of(2)
+            receivers[0].should.equal("1234")
+            receivers[1].should.equal(ring.owner({"student_id": str(student_id)}))
+            owners.add(receivers[1])
+
+        owners.should.equal({"kt1", "kt2"})
+
+        self.test_subject.shard_owner("test_event", "kt3", {"student_id": "1"}).should.equal(ring.owner({"student_id": "1"}))
+        self.test_subject.shard_owner("test_event", "1234", {"student_id": "1"}).should.equal(None)
+        self.test_subject.is_sharded("kt3").should.equal(True)
+        self.test_subject.is_sharded("1234").should.equal(False)
+
+    def test_crashed_member(self):
+        """
+        SubscriptionRouter._load() with a crashed shard plugin Test plan:
+            - a plugin still marked connected that stopped polling should be left out of the ring
+            - it should still count as a member of the group
+            - the index should be reloaded once the next member could go stale
+        """
+        now = datetime.now()
+        db = MagicMock()
+        db.session.query.return_value.join.return_value = [
+            ("test_event", "kt1", "student_id", "kt", True, now),
+            ("test_event", "kt2", "student_id", "kt", True, now - timedelta(seconds=600)),
+            ("test_event", "1234", None, None, True, now),
+        ]
+        router = SubscriptionRouter(db, self.version, 300)
+
+        routes, rings, expires = router._load()
+        routes.should.equal({"test_event": ["1234"]})
+
+        group, members, ring = rings["test_event"][0]
+        members.should.equal({"kt1", "kt2"})
+        set(ring.owner({"student_id": str(i)}) for i in range(50)).should.equal({"kt1"})
+        (expires - time.time()).should.be.greater_than(290)
+        (expires - time.time()).should.be.lower_than(301)
+
+        self.test_subject._load.return_value = ({}, {}, time.time() - 1)
+        self.test_subject.receivers("test_event")
+        self.test_subject.receivers("test_event")
+        self.test_subject._load.call_count.should.equal(2)
+
+class TestShardRing(unittest.TestCase):
+
+    def test_owner(self):
+        """
+        ShardRing.owner() Test plan:
+            - the shards should come out about even
+            - a plugin joining should only take keys from the others, about 1/K of them
+            - messages without the key should all go to one plugin
+        """
+        payloads = [{"student_id": str(i)} for i in range(10000)]
+
+        before = ShardRing("student_id", ["a", "b", "c"])
+        after = ShardRing("student_id", ["a", "b", "c", "d"])
+
+        owners = [before.owner(p) for p in payloads]
+        for entity_id in ["a", "b", "c"]:
+            owners.count(entity_id).should.be.greater_than(2000)
+
+        moved = [(o, after.owner(p)) for o, p in zip(owners, payloads) if after.owner(p) != o]
+        set(new for old, new in moved).should.equal({"d"})
+        len(moved).should.be.greater_than(1500)
+        len(moved).should.be.lower_than(3500)
+
+        before.owner({}).should.equal(before.owner(None))
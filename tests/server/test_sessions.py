@@ -0,0 +1,140 @@
+import sure
+import unittest
+from mock import *
+
+from flask import Flask, session
+
+from hpit.server.sessions import CachedSessionInterface, MemorySessionStore
+from hpit.server.versioning import SharedVersion
+
+class TestCachedSessionInterface(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.store = MemorySessionStore()
+        self.version = SharedVersion(None, "sessions", 0)
+        self.test_subject = CachedSessionInterface(self.store, self.version)
+
+        self.app = Flask(__name__)
+        self.app.session_interface = self.test_subject
+
+        @self.app.route("/connect/<entity_id>")
+        def connect(entity_id):
+            session['entity_id'] = entity_id
+            return "OK"
+
+        @self.app.route("/whoami")
+        def whoami():
+            return session.get('entity_id', "nobody")
+
+        @self.app.route("/disconnect")
+        def disconnect():
+            session.clear()
+            return "OK"
+
+        self.test_client = self.app.test_client()
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_client = None
+        self.app = None
+        self.test_subject = None
+        self.store = None
+        self.version = None
+
+    def test_session_cached(self):
+        """
+        CachedSessionInterface Test plan:
+            - data set in one request should be there in the next
+            - unmodified sessions should be served from the cache, not the store
+            - clearing the session should remove it from the store
+        """
+        self.test_client.get("/connect/1234")
+        self.store.sessions.should.have.length_of(1)
+
+        self.store.load = MagicMock(side_effect=self.store.load)
+        self.store.save = MagicMock(side_effect=self.store.save)
+
+        self.test_client.get("/whoami").data.should.equal(b"1234")
+        self.test_client.get("/whoami").data.should.equal(b"1234")
+        self.store.load.call_count.should.equal(0)
+        self.store.save.call_count.should.equal(0)
+
+        self.test_client.get("/disconnect")
+        self.store.sessions.should.equal({})
+        self.test_client.get("/whoami").data.should.equal(b"nobody")
+
+    def test_revoke_entity(self):
+        """
+        CachedSessionInterface.revoke_entity() Test plan:
+            - should end the entity's sessions, even if they are cached
+            - should leave other entities' sessions alone
+        """
+        other_client = self.app.test_client()
+
+        self.test_client.get("/connect/1234")
+        other_client.get("/connect/5678")
+        self.test_client.get("/whoami").data.should.equal(b"1234")
+
+        self.test_subject.revoke_entity("1234").should.equal(1)
+
+        self.test_client.get("/whoami").data.should.equal(b"nobody")
+        other_client.get("/whoami").data.should.equal(b"5678")
+
+    def test_other_process_revocation(self):
+        """
+        CachedSessionInterface Test plan:
+            - a session deleted by another process should be dropped once the version changes
+        """
+        self.test_client.get("/connect/1234")
+        self.store.sessions.clear()
+        self.test_client.get("/whoami").data.should.equal(b"1234")
+
+        self.version.version = "changed elsewhere"
+        self.test_client.get("/whoami").data.should.equal(b"nobody")
+
+    def test_other_process_invalidation(self):
+        """
+        CachedSessionInterface Test plan:
+            - a session ended in another process should be dropped from the cache
+            - ending it should not change the version
+            - other cached sessions should still be served from the cache
+        """
+        other_process = CachedSessionInterface(self.store, SharedVersion(None, "sessions", 0))
+        other_client = self.app.test_client()
+
+        self.test_client.get("/connect/1234")
+        other_client.get("/connect/5678")
+        self.test_client.get("/whoami").data.should.equal(b"1234")
+
+        sid = [s for s, stored in self.store.sessions.items() if stored['data']['entity_id'] == "1234"][0]
+        other_process.delete(sid)
+        self.version.version.should.equal(None)
+
+        self.store.load = MagicMock(side_effect=self.store.load)
+        self.test_client.get("/whoami").data.should.equal(b"nobody")
+        other_client.get("/whoami").data.should.equal(b"5678")
+        self.store.load.call_count.should.equal(1)
+
+    def test_rotate(self):
+        """
+        CachedSessionInterface.rotate() Test plan:
+            - connecting again should store the session under a new id
+            - the old id should be deleted
+        """
+        self.app.view_functions['connect'] = lambda entity_id: (
+            self.test_subject.rotate(session), session.__setitem__('entity_id', entity_id), "OK")[-1]
+
+        self.test_client.get("/connect/1234")
+        first = list(self.store.sessions)
+
+        self.test_client.get("/connect/1234")
+        second = list(self.store.sessions)
+
+        second.should.have.length_of(1)
+        second.should_not.equal(first)
+        self.test_client.get("/whoami").data.should.equal(b"1234")
@@ -0,0 +1,32 @@
+import sure
+import unittest
+import json
+from datetime import datetime
+from bson.objectid import ObjectId
+
+from hpit.server.wire import MongoJSONEncoder, to_json
+
+class TestMongoJSONEncoder(unittest.TestCase):
+
+    def test_encode(self):
+        """
+        MongoJSONEncoder Test plan:
+            - ObjectIds and datetimes should be encoded at any depth
+            - everything else should encode as with the json module
+        """
+        oid = ObjectId()
+        now = datetime(2014, 10, 1, 12, 30)
+
+        document = {
+            '_id': oid,
+            'time_created': now,
+            'payload': {'nested': [oid, now], 'plain': 1},
+        }
+
+        json.loads(to_json(document)).should.equal({
+            '_id': str(oid),
+            'time_created': now.isoformat(),
+            'payload': {'nested': [str(oid), now.isoformat()], 'plain': 1},
+        })
+
+        json.dumps.when.called_with(object(), cls=MongoJSONEncoder).should.throw(TypeError)
@@ -98,6 +98,11 @@ class TestServerAPI(unittest.TestCase):
         
         client = MongoClient()
         client.drop_database(settings.MONGO_DBNAME)
+
+        #the tables were just recreated, so nothing cached by an earlier test applies
+        app_instance.router.invalidate()
+        app_instance.entities.invalidate()
+        app_instance.authorization.invalidate()
         
     def tearDown(self):
         """ teardown any state that was previously setup with a setup_method
@@ -122,7 +127,6 @@ class TestServerAPI(unittest.TestCase):
             -if not found, should issue a not_found_response
             -send in bum secret, to fail, issuing auth_failed response
             -make sure session conatins entity name, description and id
-            -mock db.session.add, called with entity
             -mock db.session.commit, ensure called
             -make sure an ok response is returned
         """
@@ -158,7 +162,6 @@ class TestServerAPI(unittest.TestCase):
             response.data.should.contain(b'OK')
                 
             
-        db.session.add.call_count.should.equal(2)
         db.session.commit.call_count.should.equal(2)
         
         db.session.add = olddbsessionadd
@@ -174,7 +177,6 @@ class TestServerAPI(unittest.TestCase):
             - if entity does not exist, not found response
             - if can't authenticate with secret, return auth_failed
             
-            - db.session.add should be mocked and called
             - db.session.commit should be mocked and called
             - session should be empty
             - ok response returned     
@@ -213,7 +215,6 @@ class TestServerAPI(unittest.TestCase):
             len(flask.session.keys()).should.equal(0)
             response.data.should.contain(b'OK')
             
-        db.session.add.call_count.should.equal(4)
         db.session.commit.call_count.should.equal(4)
         
         db.session.add = olddbsessionadd
@@ -391,15 +392,96 @@ class TestServerAPI(unittest.TestCase):
         self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test_company.test_message"}),content_type="application/json")
         MessageAuth.query.filter_by(message_name="test_company.test_message",entity_id=str(self.plugin_entity_id),is_owner=True).first().should_not.equal(None)
         
-        #test that old subscriptions are eliminated
+        #test that subscribing again refreshes a subscription, old ones are left for cleansubscriptions
         self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"stale_message"}),content_type="application/json")
         subscription = Subscription.query.filter_by(message_name="stale_message").first()
         subscription.time = datetime.now() - timedelta(days=1)
         db.session.commit()
         
         self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"fresh_message"}),content_type="application/json")
-        Subscription.query.filter_by(message_name="stale_message").first().should.equal(None)
+        Subscription.query.filter_by(message_name="stale_message").first().should_not.equal(None)
+
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"stale_message"}),content_type="application/json")
+        db.session.expire_all()
+        subscription = Subscription.query.filter_by(message_name="stale_message").first()
+        (datetime.now() - subscription.time).should.be.lower_than(timedelta(hours=1))
         
+    def test_subscribe_bulk(self):
+        """
+        api.subscribe() with message_names Test plan:
+            - if message_names is not a list, then bad_parameter response
+            - should report each message as OK, EXISTS or invalid
+            - should add one subscription per valid message, and own the new ones
+        """
+        self.connect_helper("plugin")
+
+        response = self.test_client.post("/plugin/subscribe",data = json.dumps({"message_names":"test_message"}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: message_names')
+
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test_message"}),content_type="application/json")
+
+        response = self.test_client.post("/plugin/subscribe",data = json.dumps({
+            "message_names":["test_message", "other_message", "boguscompany.test_message"]
+        }),content_type="application/json")
+        json.loads(response.data.decode('utf-8'))['subscriptions'].should.equal({
+            "test_message": "EXISTS",
+            "other_message": "OK",
+            "boguscompany.test_message": "invalid message name",
+        })
+
+        plugin = Plugin.query.filter_by(entity_id=self.plugin_entity_id).first()
+        Subscription.query.filter_by(plugin=plugin).count().should.equal(2)
+        MessageAuth.query.filter_by(message_name="other_message",entity_id=str(self.plugin_entity_id),is_owner=True).first().should_not.equal(None)
+
+        self.disconnect_helper("plugin")
+        
+    def test_subscribe_sharded(self):
+        """
+        api.subscribe() with a shard_group Test plan:
+            - shard_group without a shard_key should be a bad parameter
+            - another plugin of the user joining the owner's group should be granted the message
+            - each message should be queued for only one plugin of the group
+            - a plugin disconnecting should hand its queued messages to the others
+        """
+        other = Plugin()
+        other.name = "Other plugin"
+        other.description = "for testing."
+        other.entity_id = str(uuid4())
+        other_secret_key = other.generate_key()
+        other.user = self.user
+        db.session.add(other)
+        db.session.commit()
+        other_entity_id = other.entity_id
+
+        self.connect_helper("plugin")
+
+        response = self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test_message","shard_group":"kt"}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter: shard_key')
+
+        response = self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test_message","shard_group":"kt","shard_key":"student_id"}),content_type="application/json")
+        response.data.should.contain(b'OK')
+
+        other_client = app.test_client()
+        other_client.post("/connect",data = json.dumps({"entity_id":other_entity_id,"api_key":other_secret_key}),content_type="application/json")
+        response = other_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test_message","shard_group":"kt","shard_key":"student_id"}),content_type="application/json")
+        response.data.should.contain(b'OK')
+        MessageAuth.query.filter_by(message_name="test_message",entity_id=other_entity_id,is_owner=False).first().should_not.equal(None)
+
+        for student_id in range(20):
+            self.test_client.post("/message",data = json.dumps({"name":"test_message","payload":{"student_id":str(student_id)}}),content_type="application/json")
+
+        plugin_messages = MongoClient()[settings.MONGO_DBNAME].plugin_messages
+        plugin_messages.find({'message_name':"test_message"}).count().should.equal(20)
+        plugin_messages.find({'receiver_entity_id':self.plugin_entity_id}).count().should.be.greater_than(0)
+        plugin_messages.find({'receiver_entity_id':other_entity_id}).count().should.be.greater_than(0)
+
+        other_client.post("/disconnect",data = json.dumps({"entity_id":other_entity_id,"api_key":other_secret_key}),content_type="application/json")
+
+        plugin_messages.find({'receiver_entity_id':other_entity_id}).count().should.equal(0)
+        plugin_messages.find({'receiver_entity_id':self.plugin_entity_id}).count().should.equal(20)
+
+        self.disconnect_helper("plugin")
+
     def test_unsubscribe(self):
         """
         api.unsubscribe() Test plan:
@@ -506,6 +588,51 @@ class TestServerAPI(unittest.TestCase):
        
         self.disconnect_helper("plugin")
 
+    def test_plugin_message_history_paging(self):
+        """
+        api.plugin_message_history() Test plan:
+            - a bad after cursor should return a bad parameter
+            - with limit, should return one page and a next cursor
+            - following next should return the rest, with a null cursor
+            - messages without a MessageAuth should be left out
+        """
+        self.connect_helper("plugin")
+        response = self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"some_message"}),content_type="application/json")
+
+        response = self.test_client.get("/plugin/message/history?after=bad")
+        response.data.should.contain(b'Missing parameter: after')
+
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].sent_messages_and_transactions.insert([
+            {
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Page payload 1"},
+            },
+            {
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"unauthorized_message",
+                'payload':{"msg":"Unauthorized payload"},
+            },
+            {
+                'receiver_entity_id':self.plugin_entity_id,
+                'message_name':"some_message",
+                'payload':{"msg":"Page payload 2"},
+            }
+        ])
+
+        response = self.test_client.get("/plugin/message/history?limit=2")
+        page = json.loads(response.data.decode('utf-8'))
+        [m['message']['msg'] for m in page['message-history']].should.equal(["Page payload 1"])
+        page['next'].should_not.equal(None)
+
+        response = self.test_client.get("/plugin/message/history?limit=2&after=" + page['next'])
+        page = json.loads(response.data.decode('utf-8'))
+        [m['message']['msg'] for m in page['message-history']].should.equal(["Page payload 2"])
+        page['next'].should.equal(None)
+
+        self.disconnect_helper("plugin")
+
     def test_plugin_transaction_history(self):
         """
         api.plugin_transaction_history() Test plan:
@@ -716,6 +843,92 @@ class TestServerAPI(unittest.TestCase):
         response.data.should_not.contain(b'OLD')
         response.data.should_not.contain(b'OLD2')
 
+    def test_plugin_message_list_long_poll(self):
+        """
+        api.plugin_message_list() long-poll:
+            - with ?wait= and nothing queued, should hold then return an empty list
+            - with ?wait= and a message queued, should return it right away
+            - a message sent while the poll is held should wake it up
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+
+        start = datetime.now()
+        response = self.test_client.get("/plugin/message/list?wait=1")
+        (datetime.now() - start >= timedelta(seconds=1)).should.equal(True)
+        json.loads(response.get_data().decode('utf-8'))["messages"].should.equal([])
+
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"msg":"queued"}}),content_type="application/json")
+        start = datetime.now()
+        response = self.test_client.get("/plugin/message/list?wait=10")
+        (datetime.now() - start < timedelta(seconds=5)).should.equal(True)
+        response.data.should.contain(b'queued')
+
+        oldnotify = app_instance.notifier.notify
+        app_instance.notifier.notify = MagicMock(wraps=oldnotify)
+        self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"msg":"wake"}}),content_type="application/json")
+        app_instance.notifier.notify.assert_called_with([self.plugin_entity_id])
+        app_instance.notifier.notify = oldnotify
+
+        self.disconnect_helper("plugin")
+
+    def test_plugin_message_list_claim_ack(self):
+        """
+        api.plugin_message_list() and api.plugin_message_ack() Test plan:
+            - ?max= should bound the batch
+            - with ?visibility= messages should stay queued but not be handed out again
+            - once the visibility timeout runs out they should be redelivered
+            - acked messages should be removed from the queue
+            - ack without message_ids should be a bad parameter
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        for i in range(3):
+            self.test_client.post("/message",data = json.dumps({"name":"test","payload":{"msg":"claim" + str(i)}}),content_type="application/json")
+
+        client = MongoClient()
+
+        response = self.test_client.get("/plugin/message/list?max=2&visibility=60")
+        messages = json.loads(response.get_data().decode('utf-8'))["messages"]
+        len(messages).should.equal(2)
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(3)
+
+        response = self.test_client.get("/plugin/message/list?visibility=60")
+        third = json.loads(response.get_data().decode('utf-8'))["messages"]
+        len(third).should.equal(1)
+        third[0]["message"]["msg"].should.equal("claim2")
+
+        response = self.test_client.get("/plugin/message/list?visibility=60")
+        json.loads(response.get_data().decode('utf-8'))["messages"].should.equal([])
+
+        response = self.test_client.post("/plugin/message/ack",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+
+        message_ids = [m["message_id"] for m in messages]
+        response = self.test_client.post("/plugin/message/ack",data = json.dumps({"message_ids":message_ids}),content_type="application/json")
+        json.loads(response.get_data().decode('utf-8'))["acked"].should.equal(2)
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(1)
+
+        client[settings.MONGO_DBNAME].plugin_messages.update({}, {"$set": {"claimed_until": datetime.now() - timedelta(seconds=1)}}, multi=True)
+        response = self.test_client.get("/plugin/message/list")
+        response.data.should.contain(b'claim2')
+        client[settings.MONGO_DBNAME].plugin_messages.count().should.equal(0)
+        client[settings.MONGO_DBNAME].sent_messages_and_transactions.count().should.equal(3)
+
+        #expired messages are left for the TTL index, never delivered
+        client[settings.MONGO_DBNAME].plugin_messages.insert({
+            'receiver_entity_id':self.plugin_entity_id,
+            'message_name':"test",
+            'payload':{"msg":"expired"},
+            'message_id':"1",
+            'sender_entity_id':"1",
+            'time_created':datetime.now() - timedelta(days=2),
+        })
+        response = self.test_client.get("/plugin/message/list")
+        response.data.should_not.contain(b'expired')
+
+        self.disconnect_helper("plugin")
+
     def test_plugin_transaction_list(self):
         """
         api.plugin_transaction_list() Test plan:
@@ -771,7 +984,7 @@ class TestServerAPI(unittest.TestCase):
             - payload param should be dict
             - message should be written to db, sender id correctly set
             - if a subscription exists
-                - message should be written to plugin_messages
+                - message should be written to plugin_messages, without a copy of the payload
                 - receiver_entity_id should be the subscription plugin_entity_id
                 - sender_id same as sender's entity_id
             -response should have message_id
@@ -811,11 +1024,34 @@ class TestServerAPI(unittest.TestCase):
                 'sender_entity_id':self.plugin_entity_id,
                 'receiver_entity_id':self.plugin_entity_id,
                 'message_name':"test",
-                'payload': {"test":"test"},
+                'payload': {'$exists': False},
             }     
         ).count().should.equal(1)
         
         
+    def test_message_bson(self):
+        """
+        api.message() BSON:
+            - a BSON body should be accepted
+            - a client accepting BSON should get a BSON reply
+            - a client that doesn't should still get JSON
+        """
+        from bson import BSON
+        self.connect_helper("plugin")
+
+        response = self.test_client.post("/message",data = BSON.encode({"name":"test","payload":{"test":"bson"}}),content_type="application/bson",headers={"Accept":"application/bson"})
+        response.mimetype.should.equal("application/bson")
+        message_id = BSON(response.get_data()).decode()["message_id"]
+
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].messages_and_transactions.find_one({"_id":ObjectId(message_id)})["payload"].should.equal({"test":"bson"})
+
+        response = self.test_client.post("/message",data = BSON.encode({"name":"test","payload":{"test":"bson"}}),content_type="application/bson")
+        response.mimetype.should.equal("application/json")
+
+        response = self.test_client.post("/message",data = b'not bson',content_type="application/bson")
+        response.data.should.contain(b'Missing parameter:')
+
     def test_transaction(self):
         """
         api.transaction() Test plan:
@@ -823,7 +1059,7 @@ class TestServerAPI(unittest.TestCase):
             - request should have payload params, otherwise bad response
             - message should be written to db, sender id correctly set
             - if a subscription exists
-                - message should be written to plugin_transactions
+                - message should be written to plugin_transactions, without a copy of the payload
                 - receiver_entity_id should be the subscription plugin_entity_id
                 - sender_id same as sender's entity_id
             -response should have transaction_id
@@ -857,11 +1093,73 @@ class TestServerAPI(unittest.TestCase):
                 'sender_entity_id':self.plugin_entity_id,
                 'receiver_entity_id':self.plugin_entity_id,
                 'message_name':"transaction",
-                'payload': {"test":"test"},
+                'payload': {'$exists': False},
             }     
         ).count().should.equal(1)
         
 
+    def test_message_batch(self):
+        """
+        api.message_batch() Test plan:
+            - if not connected, should return an auth_failed
+            - messages should be a list, each with a name and dict payload
+            - message_ids should come back in the order the messages were sent
+            - every message should be queued for its subscribers
+        """
+        response = self.test_client.post("/message/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+
+        self.connect_helper("plugin")
+        response = self.test_client.post("/message/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[{"name":"test"}]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[{"name":"transaction","payload":{}}]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[
+            {"name":"test","payload":{"n":1}},
+            {"name":"other","payload":{"n":2}},
+            {"name":"test","payload":{"n":3}},
+        ]}),content_type="application/json")
+        message_ids = json.loads(response.get_data().decode('utf-8'))["message_ids"]
+        len(message_ids).should.equal(3)
+
+        client = MongoClient()
+        for message_id, n in zip(message_ids, [1, 2, 3]):
+            client[settings.MONGO_DBNAME].messages_and_transactions.find_one({"_id":ObjectId(message_id)})["payload"].should.equal({"n":n})
+
+        client[settings.MONGO_DBNAME].plugin_messages.find({"receiver_entity_id":self.plugin_entity_id}).count().should.equal(2)
+
+    def test_transaction_batch(self):
+        """
+        api.transaction_batch() Test plan:
+            - if not connected, should return an auth_failed
+            - every entry needs a payload
+            - every transaction should be queued for transaction subscribers
+        """
+        response = self.test_client.post("/transaction/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+
+        self.connect_helper("plugin")
+        response = self.test_client.post("/transaction/batch",data = json.dumps({"messages":[{}]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"transaction"}),content_type="application/json")
+
+        response = self.test_client.post("/transaction/batch",data = json.dumps({"messages":[
+            {"payload":{"n":1}},
+            {"payload":{"n":2}},
+        ]}),content_type="application/json")
+        len(json.loads(response.get_data().decode('utf-8'))["message_ids"]).should.equal(2)
+
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].plugin_messages.find({"message_name":"transaction"}).count().should.equal(2)
+
     def test_response(self):
         """
         api.response() Test plan:
@@ -909,6 +1207,117 @@ class TestServerAPI(unittest.TestCase):
         ).count().should.equal(1)
         self.disconnect_helper("plugin")
         
+    def test_response_batch(self):
+        """
+        api.response_batch() Test plan:
+            - if not connected, should return an auth_failed
+            - responses should be a list, each with a message_id and payload
+            - a response should be written for every message sent to the plugin
+            - unknown message_ids should give a null response_id
+        """
+        response = self.test_client.post("/response/batch",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        response = self.test_client.post("/response/batch",data = json.dumps({"responses":[{"message_id":"1"}]}),content_type="application/json")
+        response.data.should.contain(b'Missing parameter:')
+        self.disconnect_helper("plugin")
+
+        self.connect_helper("tutor")
+        response = self.test_client.post("/message/batch",data = json.dumps({"messages":[
+            {"name":"test","payload":{"n":1}},
+            {"name":"test","payload":{"n":2}},
+        ]}),content_type="application/json")
+        message_ids = json.loads(response.get_data().decode('utf-8'))["message_ids"]
+        self.disconnect_helper("tutor")
+
+        self.connect_helper("plugin")
+        self.test_client.get("/plugin/message/list")
+        response = self.test_client.post("/response/batch",data = json.dumps({"responses":[
+            {"message_id":message_ids[1],"payload":{"r":2}},
+            {"message_id":str(ObjectId()),"payload":{"r":0}},
+            {"message_id":message_ids[0],"payload":{"r":1}},
+        ]}),content_type="application/json")
+        response_ids = json.loads(response.get_data().decode('utf-8'))["response_ids"]
+        response_ids[1].should.equal(None)
+
+        client = MongoClient()
+        client[settings.MONGO_DBNAME].responses.find_one({"_id":ObjectId(response_ids[0])})["response"].should.equal({"r":2})
+        client[settings.MONGO_DBNAME].responses.find_one({"_id":ObjectId(response_ids[2])})["response"].should.equal({"r":1})
+        client[settings.MONGO_DBNAME].responses.find({"receiver_entity_id":self.tutor_entity_id}).count().should.equal(2)
+        self.disconnect_helper("plugin")
+
+    def test_response_list_full_message(self):
+        """
+        api.responses() full_message:
+            - responses should not store a copy of the original payload
+            - by default the listed message should only carry the dispatch fields
+            - with ?full_message=1 the whole original message should come back
+        """
+        self.connect_helper("plugin")
+        self.test_client.post("/plugin/subscribe",data = json.dumps({"message_name":"test"}),content_type="application/json")
+        self.disconnect_helper("plugin")
+
+        with app.test_client() as c:
+            c.post("/connect",data = json.dumps({"entity_id":self.tutor_entity_id,"api_key":self.tutor_secret_key}),content_type="application/json")
+            c.post("/message/batch",data = json.dumps({"messages":[
+                {"name":"test","payload":{"big":"payload 1"}},
+                {"name":"test","payload":{"big":"payload 2"}},
+            ]}),content_type="application/json")
+
+            self.connect_helper("plugin")
+            messages = json.loads(self.test_client.get("/plugin/message/list").get_data().decode('utf-8'))["messages"]
+            self.test_client.post("/response",data = json.dumps({"message_id":messages[0]["message_id"],"payload":{"ok":1}}),content_type="application/json")
+
+            client = MongoClient()
+            client[settings.MONGO_DBNAME].responses.find({"message.payload":{"$exists":True}}).count().should.equal(0)
+
+            response = c.get("/response/list")
+            listed = json.loads(response.get_data().decode('utf-8'))["responses"]
+            len(listed).should.equal(1)
+            listed[0]["message"].should_not.contain("payload")
+            listed[0]["message"]["message_id"].should.equal(messages[0]["message_id"])
+            listed[0]["message"]["message_name"].should.equal("test")
+
+            self.test_client.post("/response",data = json.dumps({"message_id":messages[1]["message_id"],"payload":{"ok":2}}),content_type="application/json")
+            response = c.get("/response/list?full_message=1")
+            listed = json.loads(response.get_data().decode('utf-8'))["responses"]
+            listed[0]["message"]["payload"].should.equal({"big":"payload 2"})
+
+    def test_response_stream(self):
+        """
+        api.response_stream() Test plan:
+            - if not connected, should return an auth_failed
+            - queued responses should be pushed as server-sent events
+            - pushed responses should be marked received
+        """
+        response = self.test_client.get("/response/stream")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+
+        import hpit.server.views.api as api_module
+        oldstreammax = api_module.RESPONSE_STREAM_MAX
+        api_module.RESPONSE_STREAM_MAX = 0
+
+        with app.test_client() as c:
+            c.post("/connect",data = json.dumps({"entity_id":self.tutor_entity_id,"api_key":self.tutor_secret_key}),content_type="application/json")
+            client = MongoClient()
+            client[settings.MONGO_DBNAME].responses.insert({
+                "receiver_entity_id":self.tutor_entity_id,
+                "session_token":flask.session["token"],
+                "message":{"message_id":"1"},
+                "response":{"res":"pushed"},
+                "time_created":datetime.now(),
+            })
+
+            response = c.get("/response/stream")
+            response.mimetype.should.equal("text/event-stream")
+            response.data.should.contain(b'event: response')
+            response.data.should.contain(b'pushed')
+            client[settings.MONGO_DBNAME].responses.count().should.equal(0)
+
+        api_module.RESPONSE_STREAM_MAX = oldstreammax
+
     def test_response_list(self):
         """
         api.response_list() Test plan:
@@ -1260,3 +1669,27 @@ class TestServerAPI(unittest.TestCase):
         
         
         
+
+    def test_ping(self):
+        """
+        api.ping() Test plan:
+            - if not connected, should return auth_failed
+            - should return ok without writing the heartbeat straight away
+            - the heartbeat should land in time_last_polled once flushed
+        """
+        response = self.test_client.post("/ping",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'Could not authenticate. Invalid entity_id/api_key combination.')
+
+        self.connect_helper("plugin")
+        before = datetime.now()
+        app_instance.entities.flush() #start a fresh flush interval
+
+        olddbsessioncommit = db.session.commit
+        db.session.commit = MagicMock()
+        response = self.test_client.post("/ping",data = json.dumps({}),content_type="application/json")
+        response.data.should.contain(b'OK')
+        db.session.commit.call_count.should.equal(0)
+        db.session.commit = olddbsessioncommit
+
+        app_instance.entities.flush()
+        (Plugin.query.filter_by(entity_id=self.plugin_entity_id).first().time_last_polled >= before).should.equal(True)
@@ -0,0 +1,122 @@
+import sure
+import unittest
+import asyncio
+from mock import *
+
+from hpitclient.exceptions import InvalidMessageNameException
+
+from hpit.utils.async_plugin import AsyncPlugin
+
+class TestAsyncPlugin(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.test_subject = AsyncPlugin(1234, 4567)
+        self.test_subject.send_log_entry = MagicMock()
+        self.posted = []
+
+        async def post_data(url, data=None):
+            self.posted.append((url, data))
+            if url == 'message/batch':
+                return {'message_ids': [str(len(self.posted)) + "-" + str(i) for i in range(len(data['messages']))]}
+            return {}
+
+        self.test_subject._post_data = post_data
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        self.test_subject = None
+        self.posted = None
+
+    def message(self, message_id, message_name):
+        return {
+            'message_name': message_name,
+            'message_id': message_id,
+            'sender_entity_id': "8888",
+            'message': {},
+        }
+
+    def test_dispatch(self):
+        """
+        AsyncPlugin._dispatch() Test plan:
+            - should call plain and coroutine callbacks, with message_id and sender injected
+            - transactions should go to the transaction callback
+            - messages without a callback should be skipped
+        """
+        handled = []
+
+        def plain_callback(payload):
+            handled.append(("plain", payload['message_id'], payload['sender_entity_id']))
+
+        async def coroutine_callback(payload):
+            await asyncio.sleep(0)
+            handled.append(("coroutine", payload['message_id'], payload['sender_entity_id']))
+
+        self.test_subject.callbacks = {"plain": plain_callback, "coroutine": coroutine_callback}
+        self.test_subject.transaction_callback = MagicMock()
+
+        async def run():
+            result = await self.test_subject._dispatch([
+                self.message("1", "coroutine"),
+                self.message("2", "plain"),
+                self.message("3", "transaction"),
+                self.message("4", "unknown"),
+            ])
+            await asyncio.gather(*list(self.test_subject.callback_tasks))
+            return result
+
+        self.loop.run_until_complete(run()).should.equal(True)
+
+        handled.should.equal([("plain", "2", "8888"), ("coroutine", "1", "8888")])
+        self.test_subject.transaction_callback.assert_called_once_with({'message_id': "3", 'sender_entity_id': "8888"})
+        self.test_subject.error.should.be(None)
+
+    def test_send(self):
+        """
+        AsyncPlugin.send() Test plan:
+            - sends queued together should go to HPIT in one batch
+            - should resolve to the message_ids
+            - responses should reach the callbacks, even one that beats its message_id back
+            - should reject the transaction message name
+        """
+        responses = []
+
+        async def run():
+            futures = [self.test_subject.send("test_message", {"n": i}, responses.append) for i in range(3)]
+            self.test_subject._dispatch_response({'message': {'message_id': "1-0"}, 'response': {"early": True}})
+
+            message_ids = await asyncio.gather(*futures)
+            self.test_subject._dispatch_response({'message': {'message_id': "1-2"}, 'response': {"n": 2}})
+
+            return message_ids
+
+        self.loop.run_until_complete(run()).should.equal(["1-0", "1-1", "1-2"])
+
+        self.posted.should.equal([('message/batch', {'messages': [
+            {'name': "test_message", 'payload': {"n": 0}},
+            {'name': "test_message", 'payload': {"n": 1}},
+            {'name': "test_message", 'payload': {"n": 2}},
+        ]})])
+        responses.should.equal([{"early": True}, {"n": 2}])
+
+        self.test_subject.send.when.called_with("transaction", {}).should.throw(InvalidMessageNameException)
+
+    def test_parse_events(self):
+        """
+        AsyncPlugin._parse_events() Test plan:
+            - should return the complete events and keep the rest for the next chunk
+            - should skip keep-alive comments
+        """
+        events, rest = self.test_subject._parse_events(b': keep-alive\n\nevent: response\ndata: {"a": 1}\n\nevent: resp')
+
+        events.should.equal([("response", '{"a": 1}')])
+        rest.should.equal(b'event: resp')
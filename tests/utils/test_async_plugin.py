@@ -0,0 +1,9 @@
+import sys
+import unittest
+
+#The asyncio runtime, and so its tests, use async/await, which older Pythons
+#can't even parse. The tests live in a module only imported past this check.
+if sys.version_info < (3, 5):
+    raise unittest.SkipTest("The asyncio runtime needs Python 3.5 or later.")
+
+from .async_plugin_cases import TestAsyncPlugin
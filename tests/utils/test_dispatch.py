@@ -0,0 +1,78 @@
+import sure
+import unittest
+import threading
+from mock import *
+
+from hpit.utils.dispatch import ConcurrentDispatcher
+
+class TestConcurrentDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        """ setup any state tied to the execution of the given method in a
+        class.  setup_method is invoked for every test method of a class.
+        """
+        self.plugin = MagicMock()
+        self.plugin.callbacks = {}
+        self.plugin.wildcard_callback = None
+        self.plugin._try_hook.return_value = True
+
+        self.test_subject = ConcurrentDispatcher.install(self.plugin, 4, {"test_message": "student_id"})
+
+    def tearDown(self):
+        """ teardown any state that was previously setup with a setup_method
+        call.
+        """
+        self.test_subject.shutdown()
+        self.test_subject = None
+        self.plugin = None
+
+    def message(self, message_id, student_id, message_name="test_message"):
+        return {
+            'message_name': message_name,
+            'message_id': message_id,
+            'sender_entity_id': "1234",
+            'message': {'student_id': student_id},
+        }
+
+    def test_install(self):
+        """
+        ConcurrentDispatcher.install() Test plan:
+            - should replace the plugin's _dispatch
+        """
+        self.plugin._dispatch.should.equal(self.test_subject.dispatch)
+
+    def test_dispatch_order(self):
+        """
+        ConcurrentDispatcher.dispatch() Test plan:
+            - every message should reach its callback, with message_id and sender injected
+            - messages with the same key should be handled in poll order
+            - messages without a callback should be skipped
+        """
+        handled = []
+        lock = threading.Lock()
+
+        def callback(payload):
+            with lock:
+                handled.append((payload['student_id'], payload['message_id']))
+            return True
+
+        self.plugin.callbacks = {"test_message": callback}
+
+        messages = [self.message(str(i), "student" + str(i % 3)) for i in range(30)]
+        messages.append(self.message("other", "student0", "unknown_message"))
+
+        self.test_subject.dispatch(messages).should.equal(True)
+
+        handled.should.have.length_of(30)
+        for student in ["student0", "student1", "student2"]:
+            ids = [int(m) for s, m in handled if s == student]
+            ids.should.equal(sorted(ids))
+
+    def test_dispatch_error(self):
+        """
+        ConcurrentDispatcher.dispatch() Test plan:
+            - a callback failure should be raised once the poll has been handled
+        """
+        self.plugin.callbacks = {"test_message": MagicMock(side_effect=ValueError())}
+
+        self.test_subject.dispatch.when.called_with([self.message("1", "student0")]).should.throw(ValueError)
@@ -0,0 +1,55 @@
+import sure
+import unittest
+from mock import *
+
+from bson.objectid import ObjectId
+
+from hpit.utils.fragments import fragment_options, fragment_find, fragment_response
+
+class TestFragments(unittest.TestCase):
+
+    def test_fragment_options(self):
+        """
+        fragment_options() Test plan:
+            - without options, every field and every row
+            - should pick the options of the fragment asked for
+            - malformed options should raise ValueError
+        """
+        fragment_options({}, "knowledge_tracing").should.equal((None, None))
+
+        since = ObjectId()
+        fragment_options({
+            "fields": {"knowledge_tracing": ["skill_id"], "hint_factory": ["state"]},
+            "changed_since": {"knowledge_tracing": str(since)},
+        }, "knowledge_tracing").should.equal((["skill_id"], since))
+
+        fragment_options.when.called_with({"fields": ["skill_id"]}, "knowledge_tracing").should.throw(ValueError)
+        fragment_options.when.called_with({"fields": {"knowledge_tracing": "skill_id"}}, "knowledge_tracing").should.throw(ValueError)
+        fragment_options.when.called_with({"changed_since": {"knowledge_tracing": "bogus"}}, "knowledge_tracing").should.throw(ValueError)
+
+    def test_fragment_find(self):
+        """
+        fragment_find() Test plan:
+            - should project the fields asked for, leaving out _id unless asked
+            - without fields, should leave out only the version field
+            - with since, should only find rows stamped since
+            - should return a version from before the read
+        """
+        collection = MagicMock()
+        since = ObjectId()
+
+        cursor, version = fragment_find(collection, {"student_id": "1"}, ["skill_id"], None)
+        collection.find.assert_called_with({"student_id": "1"}, {"skill_id": True, "_id": False})
+        ObjectId(version).should.be.lower_than(ObjectId())
+
+        fragment_find(collection, {"student_id": "1"}, None, since, "kt_version")
+        collection.find.assert_called_with({"student_id": "1", "kt_version": {"$gte": since}}, {"kt_version": False})
+
+    def test_fragment_response(self):
+        """
+        fragment_response() Test plan:
+            - should echo changed_since only when given
+        """
+        fragment_response("hint_factory", [], "_id", "v", None).should.equal({
+            "name": "hint_factory", "fragment": [], "key": "_id", "version": "v"})
+        fragment_response("hint_factory", [], "_id", "v", "a")["changed_since"].should.equal("a")
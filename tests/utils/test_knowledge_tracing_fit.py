@@ -0,0 +1,68 @@
+import sure
+import unittest
+import numpy
+
+from hpit.utils.knowledge_tracing_fit import transaction_sequences, fit_skill, fit_skills
+
+class TestKnowledgeTracingFit(unittest.TestCase):
+
+    def simulate(self, parameters, students, steps):
+        random = numpy.random.RandomState(0)
+        known_prior, learned, guess, mistake = parameters
+
+        sequences = []
+        for student in range(students):
+            known = random.rand() < known_prior
+            sequence = []
+            for step in range(steps):
+                sequence.append(bool(random.rand() >= mistake if known else random.rand() < guess))
+                known = known or random.rand() < learned
+            sequences.append(sequence)
+
+        return sequences
+
+    def test_transaction_sequences(self):
+        """
+        transaction_sequences() Test plan:
+            - should group outcomes by sender, skill and student, in order
+            - should skip outcomes other than correct and incorrect
+        """
+        transactions = [
+            {'edit_allowed_id': "1", 'student_id': "a", 'skill_ids': {"add": "s1", "carry": "s2"}, 'outcome': "Correct"},
+            {'edit_allowed_id': "1", 'student_id': "a", 'skill_ids': {"add": "s1"}, 'outcome': "hint"},
+            {'edit_allowed_id': "1", 'student_id': "b", 'skill_ids': {"add": "s1"}, 'outcome': "incorrect"},
+            {'edit_allowed_id': "1", 'student_id': "a", 'skill_ids': {"add": "s1"}, 'outcome': "incorrect"},
+            {'edit_allowed_id': "2", 'student_id': "a", 'skill_ids': {"add": "s1"}, 'outcome': "correct"},
+        ]
+
+        sequences = transaction_sequences(transactions)
+
+        sorted(sequences.keys()).should.equal([("1", "s1"), ("1", "s2"), ("2", "s1")])
+        sorted(sequences[("1", "s1")]).should.equal([[False], [True, False]])
+        sequences[("1", "s2")].should.equal([[True]])
+
+    def test_fit_skill(self):
+        """
+        fit_skill() Test plan:
+            - should recover the parameters the sequences were simulated with
+        """
+        fitted = fit_skill(self.simulate((0.3, 0.2, 0.2, 0.1), 1000, 10))
+
+        fitted['observations'].should.equal(10000)
+        for name, simulated in [('probability_known', 0.3), ('probability_learned', 0.2), ('probability_guess', 0.2), ('probability_mistake', 0.1)]:
+            abs(fitted[name] - simulated).should.be.lower_than(0.1)
+
+    def test_fit_skills(self):
+        """
+        fit_skills() Test plan:
+            - should fit each skill with enough observations
+        """
+        sequences = {
+            ("1", "s1"): self.simulate((0.3, 0.2, 0.2, 0.1), 100, 10),
+            ("1", "s2"): [[True, False]],
+        }
+
+        fitted = fit_skills(sequences, 2, min_observations=10)
+
+        list(fitted.keys()).should.equal([("1", "s1")])
+        fitted[("1", "s1")].should.equal(fit_skill(sequences[("1", "s1")]))
@@ -0,0 +1,81 @@
+"""
+Benchmarks the knowledge tracing fit (see the fitkt command) on synthetic
+transactions, by default a million rows: 200 skills, 500 students each, 10
+steps per student. Each skill's transactions are simulated from random BKT
+parameters, and the report shows how long grouping and fitting took and how
+far the fitted parameters landed from the ones simulated.
+
+Usage, from the project directory:
+    python3 -m tools.kt_fit_benchmark [--skills 200] [--students 500] [--steps 10] [--processes N]
+"""
+
+import argparse
+import time
+
+import numpy
+
+from hpit.utils.knowledge_tracing_fit import transaction_sequences, fit_skills, PARAMETERS
+
+def simulate(random, parameters, students, steps):
+    """
+    Simulate the outcomes of students x steps on one skill, all students at once.
+    """
+    known_prior, learned, guess, mistake = parameters
+
+    known = random.rand(students) < known_prior
+    outcomes = numpy.zeros((students, steps), dtype=bool)
+    for step in range(steps):
+        luck = random.rand(students)
+        outcomes[:, step] = numpy.where(known, luck >= mistake, luck < guess)
+        known |= random.rand(students) < learned
+
+    return outcomes
+
+def transactions(random, skills, students, steps):
+    """
+    Yield synthetic hpit_transactions documents, and fill skills with the
+    parameters each skill was simulated with.
+    """
+    for skill in range(len(skills)):
+        parameters = (random.uniform(0.1, 0.9), random.uniform(0.05, 0.5), random.uniform(0.05, 0.4), random.uniform(0.05, 0.3))
+        skills[skill] = parameters
+
+        outcomes = simulate(random, parameters, students, steps)
+        for student in range(students):
+            for step in range(steps):
+                yield {
+                    'edit_allowed_id': "benchmark",
+                    'student_id': str(student),
+                    'skill_ids': {"skill" + str(skill): str(skill)},
+                    'outcome': "correct" if outcomes[student, step] else "incorrect",
+                }
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the knowledge tracing fit.")
+    parser.add_argument('--skills', type=int, default=200)
+    parser.add_argument('--students', type=int, default=500)
+    parser.add_argument('--steps', type=int, default=10)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    arguments = parser.parse_args()
+
+    random = numpy.random.RandomState(arguments.seed)
+    skills = [None] * arguments.skills
+    rows = arguments.skills * arguments.students * arguments.steps
+
+    start = time.time()
+    sequences = transaction_sequences(transactions(random, skills, arguments.students, arguments.steps))
+    grouped = time.time()
+
+    fitted = fit_skills(sequences, arguments.processes)
+    done = time.time()
+
+    errors = numpy.array([
+        [abs(fitted[("benchmark", str(skill))][name] - simulated) for name, simulated in zip(PARAMETERS, skills[skill])]
+        for skill in range(arguments.skills)])
+
+    print("Rows:               " + str(rows))
+    print("Simulate and group: {:.1f}s".format(grouped - start))
+    print("Fit:                {:.1f}s ({:.0f} rows/s)".format(done - grouped, rows / (done - grouped)))
+    for name, error in zip(PARAMETERS, errors.mean(axis=0)):
+        print("Mean error {:20s} {:.3f}".format(name + ":", error))